@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmarks of the poll pipeline
+
+Runs the real poller, rollup, notification and detector code against
+simulated smart plugs (see `laundrymeter.simulation`) and a temporary
+SQLite database:
+
+* `ticks`: Latency and throughput of `update_washing_mashine` with the
+  `washingmachine` table prefilled to several sizes, from empty to a full
+  year of readings (6.3M rows), including the time per SQL statement type.
+* `retention`: Time of the rollup/retention job catching up on a prefilled
+  table and afterwards in steady state.
+* `notifications`: Time to queue and to deliver notifications to many
+  subscribers, with simulated Telegram and SMTP latency.
+* `detectors`: Accuracy of all detectors on synthetic wash cycles.
+* `serialization`: Rows per second of history dumps, with the marshmallow
+  schema against the precompiled serializer.
+* `transfer`: Rows per second of `export-readings` and `import-readings`
+  (see `laundrymeter.transfer`) in both file formats.
+* `prediction`: Time per remaining-time prediction against a library of
+  thousands of synthetic cycle profiles, and its error on held-out cycles.
+* `startup`: Time to import the package and create the app with each set
+  of roles (see `laundrymeter.roles`), in fresh interpreters, and the
+  threads and optional libraries each of them starts with.
+
+Every scenario runs in a fresh process. The results are written as JSON;
+pass a previous result with `--compare` to list regressions:
+
+    python -m benchmarks.pipeline --sizes empty,day,month --output bench.json
+    python -m benchmarks.pipeline --compare bench.json
+
+"""
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+SIZES = {
+    'empty': 0,
+    'day': 17280,
+    'week': 120960,
+    'month': 518400,
+    'year': 6307200,
+}
+
+
+def make_app(tmp: str, **config):
+    """Create an app on a temporary database without any background tasks."""
+    from laundrymeter import create_app, leader
+
+    # Holding the leader lock keeps the app a follower: no poller, bot or dispatcher
+    lock_path = os.path.join(tmp, 'leader.lock')
+    leader.FileLock(lock_path).acquire()
+    app = create_app(dict({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'db.sqlite'),
+                           'ARCHIVE_PATH': os.path.join(tmp, 'archive'),
+                           'STATE_PATH': os.path.join(tmp, 'state'),
+                           'METRICS_PATH': os.path.join(tmp, 'metrics'),
+                           'LEADER_LOCK_PATH': lock_path,
+                           'LEADER_RETRY_INTERVAL': 3600,
+                           'TELEGRAM_BOT_TOKEN': '123456:benchmark', # The bot is set up, but never started
+                           'TESTING': True}, **config))
+    app.logger.setLevel(logging.WARNING)
+    with app.app_context():
+        from laundrymeter import db_helper
+        db_helper.init_db()
+    return app
+
+def prefill(app, machine_id: str, rows: int, end: datetime, chunk: int = 20000) -> float:
+    """Insert `rows` synthetic readings of a machine ending at `end`.
+
+    Returns:
+        The seconds the insert took.
+    """
+    from laundrymeter import detectors, simulation
+    from laundrymeter.models import WashingMachine, db
+
+    if not rows:
+        return 0.0
+    interval = app.config['POLL_INTERVAL']
+    trace, _ = simulation.synthetic_trace(50, interval)
+    power = np.resize(trace, rows)
+    t = detectors.seconds(end) - interval * np.arange(rows, 0, -1)
+    running = detectors.create(app.config).replay(t, power)
+    flips = np.flatnonzero(np.concatenate(([True], running[1:] != running[:-1])))
+    last_changed = t[flips[np.searchsorted(flips, np.arange(rows), side='right') - 1]]
+    total = np.cumsum(power) * interval / 3600 / 1000
+
+    began = time.perf_counter()
+    with app.app_context():
+        for lo in range(0, rows, chunk):
+            db.session.execute(WashingMachine.__table__.insert(), [
+                {'machine_id': machine_id,
+                 'timestamp': detectors.EPOCH + timedelta(seconds=float(t[i])),
+                 'running': bool(running[i]),
+                 'last_changed': detectors.EPOCH + timedelta(seconds=float(last_changed[i])),
+                 'voltage': 230.0,
+                 'current': float(power[i]) / 230,
+                 'power': float(power[i]),
+                 'total_power': float(total[i]),
+                 'valid_until': detectors.EPOCH + timedelta(seconds=float(t[i])),
+                 'repeat_count': 1} for i in range(lo, min(lo + chunk, rows))])
+            db.session.commit()
+    return time.perf_counter() - began
+
+def summarize(seconds: list) -> dict:
+    """Return latency percentiles of a list of durations."""
+    seconds = np.array(seconds)
+    return {'count': int(len(seconds)),
+            'mean': float(seconds.mean()),
+            'p50': float(np.percentile(seconds, 50)),
+            'p95': float(np.percentile(seconds, 95)),
+            'p99': float(np.percentile(seconds, 99)),
+            'max': float(seconds.max())}
+
+def statement_times() -> dict:
+    """Return the count and total seconds per SQL statement type recorded so far."""
+    from laundrymeter import metrics
+    return {json.loads(key)[0]: {'count': sum(value[0]), 'seconds': value[1]}
+            for key, value in metrics.db_seconds.dump().items()}
+
+
+def bench_ticks(size: str, options: dict) -> dict:
+    """Time poll ticks with the table prefilled to a size."""
+    from laundrymeter import wm_poller, simulation, metrics, notifications
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plugs = [{'id': 'machine-{}'.format(i), 'ip': 'sim:synthetic'} for i in range(options['machines'])]
+        app = make_app(tmp, SMART_PLUGS=plugs, RAW_RETENTION_DAYS=366)
+        now = datetime.utcnow()
+        prefill_seconds = sum(prefill(app, plug['id'], SIZES[size] // len(plugs), now) for plug in plugs)
+
+        wm_poller.configure(app)
+        notifications.dispatcher = notifications.Dispatcher(app, bot=FakeBot(0), smtp=FakeSMTP) # Not started
+        trace, _ = simulation.synthetic_trace(4, app.config['POLL_INTERVAL'], idle_minutes=5)
+        for machine in wm_poller.machines.values():
+            machine.plug = simulation.SimulatedPlug(trace, app.config['POLL_INTERVAL'],
+                                                    latency=options['plug_latency'],
+                                                    jitter=options['plug_jitter'],
+                                                    failure_rate=options['failure_rate'], seed=0)
+        metrics.db_seconds._values.clear()
+
+        ticks = []
+        began = time.perf_counter()
+        for _ in range(options['ticks']):
+            start = time.perf_counter()
+            wm_poller.update_washing_mashine()
+            ticks.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - began
+        wm_poller.executor.shutdown()
+
+        return {'rows': SIZES[size],
+                'prefill_seconds': prefill_seconds,
+                'tick_seconds': summarize(ticks),
+                'ticks_per_second': options['ticks'] / elapsed,
+                'statements': statement_times()}
+
+def bench_retention(size: str, options: dict) -> dict:
+    """Time the rollup/retention job on a prefilled table."""
+    from laundrymeter import wm_poller
+    from laundrymeter.models import WashingMachine
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp, SMART_PLUGS=[{'id': 'default', 'ip': 'sim:synthetic'}])
+        prefill(app, 'default', SIZES[size], datetime.utcnow())
+        wm_poller.configure(app)
+
+        start = time.perf_counter()
+        wm_poller.update_rollups()
+        catch_up = time.perf_counter() - start
+        start = time.perf_counter()
+        wm_poller.update_rollups()
+        steady = time.perf_counter() - start
+        with app.app_context():
+            remaining = WashingMachine.query.count()
+        wm_poller.executor.shutdown()
+        return {'rows': SIZES[size], 'catch_up_seconds': catch_up, 'steady_seconds': steady, 'raw_rows_left': remaining}
+
+class FakeBot:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def send_message(self, chat_id, text):
+        time.sleep(self.latency)
+
+class FakeSMTP:
+    latency = 0
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def starttls(self):
+        time.sleep(FakeSMTP.latency)
+
+    def login(self, user, password):
+        time.sleep(FakeSMTP.latency)
+
+    def sendmail(self, sender, recipient, message):
+        time.sleep(FakeSMTP.latency)
+
+def bench_notifications(subscribers: int, options: dict) -> dict:
+    """Time queueing and delivering a notification to many subscribers."""
+    from laundrymeter import notifications
+    from laundrymeter.models import Notification, User, db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        with app.app_context():
+            db.session.execute(User.__table__.insert(), [
+                {'username': 'user{}'.format(i), 'name': 'User {}'.format(i), 'email': 'user{}@example.org'.format(i),
+                 'notify_email': True, 'notify_telegram': True, 'telegram_chat_id': i} for i in range(subscribers)])
+            db.session.commit()
+
+            FakeSMTP.latency = options['smtp_latency']
+            dispatcher = notifications.Dispatcher(app, bot=FakeBot(options['telegram_latency']), smtp=FakeSMTP)
+            now = datetime.utcnow()
+            start = time.perf_counter()
+            queued = notifications.enqueue('The laundry is ready!', now, app.config)
+            enqueue = time.perf_counter() - start
+
+            start = time.perf_counter()
+            while dispatcher.dispatch(datetime.utcnow()) == 0:
+                pass
+            deliver = time.perf_counter() - start
+            left = Notification.query.count()
+            dispatcher.executor.shutdown()
+        return {'subscribers': subscribers, 'queued': queued, 'enqueue_seconds': enqueue,
+                'deliver_seconds': deliver, 'undelivered': left}
+
+def bench_detectors(cycles: int, options: dict) -> dict:
+    """Replay synthetic wash cycles through all detectors."""
+    from laundrymeter import detectors, replay, simulation
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        interval = app.config['POLL_INTERVAL']
+        power, truth = simulation.synthetic_trace(cycles, interval, seed=1)
+        t = np.arange(len(power)) * float(interval)
+        results = replay.run(dict(app.config), t, power, list(detectors.DETECTORS))
+        return {'true_cycles': len(truth), 'detectors': results}
+
+def bench_serialization(rows: int, options: dict) -> dict:
+    """Dump a history of raw readings with the marshmallow schema and the precompiled serializer."""
+    from laundrymeter import history, serializers
+    from laundrymeter.models import WashingMachine, WashingMachineSchema, db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        prefill(app, 'default', rows, datetime.utcnow())
+        with app.app_context():
+            variants = {
+                'schema': (lambda: WashingMachine.query.filter_by(machine_id='default').all(),
+                           lambda rows: WashingMachineSchema().dumps(rows, many=True)),
+                'serializer_dicts': (lambda: list(history.iter_rows(WashingMachine, 'default')),
+                                     serializers.wm_debug.dumps_dicts),
+                'serializer_tuples': (lambda: (serializers.wm_debug.query()
+                                               .filter(WashingMachine.machine_id == 'default').all()),
+                                      lambda rows: serializers.wm_debug.dumps(rows, many=True)),
+            }
+            results = {'rows': rows}
+            for name, (fetch, dump) in variants.items():
+                start = time.perf_counter()
+                fetched = fetch()
+                fetched_at = time.perf_counter()
+                text = dump(fetched)
+                end = time.perf_counter()
+                assert len(json.loads(text)) == rows
+                db.session.expunge_all()
+                results[name] = {'fetch_seconds': fetched_at - start, 'dump_seconds': end - fetched_at,
+                                 'rows_per_second': rows / (end - start),
+                                 'dump_rows_per_second': rows / (end - fetched_at)}
+            return results
+
+def bench_transfer(rows: int, options: dict) -> dict:
+    """Export prefilled readings in both formats and import them into an empty database."""
+    from laundrymeter import transfer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('source', 'target-csv', 'target-ndjson'):
+            os.makedirs(os.path.join(tmp, name))
+        source = make_app(os.path.join(tmp, 'source'))
+        prefill(source, 'default', rows, datetime.utcnow())
+        batch = source.config['TRANSFER_BATCH_SIZE']
+        results = {'rows': rows}
+        for fmt in transfer.FORMATS:
+            path = os.path.join(tmp, 'readings.' + fmt)
+            with source.app_context():
+                start = time.perf_counter()
+                with transfer.open_file(path, 'w') as out:
+                    chunks = transfer.export_chunks(dict(source.config), 'default', datetime(1970, 1, 1),
+                                                    datetime.utcnow(), batch)
+                    exported = transfer.WRITERS[fmt](chunks, out)
+                export_seconds = time.perf_counter() - start
+            target = make_app(os.path.join(tmp, 'target-' + fmt))
+            with target.app_context():
+                start = time.perf_counter()
+                with transfer.open_file(path, 'r') as f:
+                    imported = transfer.import_rows(dict(target.config), transfer.READERS[fmt](f, batch))
+                import_seconds = time.perf_counter() - start
+            assert exported == imported == rows
+            results[fmt] = {'export_seconds': export_seconds, 'import_seconds': import_seconds,
+                            'export_rows_per_second': rows / export_seconds,
+                            'import_rows_per_second': rows / import_seconds,
+                            'bytes_per_row': os.path.getsize(path) / rows}
+        return results
+
+def bench_prediction(count: int, options: dict) -> dict:
+    """Predict the remaining time of held-out synthetic cycles against a library of `count` profiles."""
+    from laundrymeter import profiles, simulation
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        config = dict(app.config)
+    interval = config['POLL_INTERVAL']
+    held_out = 50
+    power, bounds = simulation.synthetic_trace(count + held_out, interval, idle_minutes=1, seed=2)
+
+    traces, durations = [], []
+    start = datetime(2018, 1, 1)
+    for first, last in bounds:
+        trace = profiles.Trace(start, config['PROFILE_RESOLUTION'], profiles.max_samples(config))
+        for i in range(first, last + 1):
+            trace.add(start + timedelta(seconds=(i - first) * interval), float(power[i]))
+        traces.append(trace)
+        durations.append((last - first) * interval)
+
+    library = profiles.Library(profiles.max_samples(config), count)
+    began = time.perf_counter()
+    library.extend([trace.profile(duration) for trace, duration in zip(traces[:count], durations[:count])],
+                   durations[:count])
+    build = time.perf_counter() - began
+
+    seconds, errors = [], []
+    for trace, duration in zip(traces[count:], durations[count:]):
+        for complete in range(0, int(duration // config['PROFILE_RESOLUTION'])):
+            samples = trace.samples(complete)
+            began = time.perf_counter()
+            predicted = library.predict(samples, config['PREDICT_NEIGHBORS'])
+            seconds.append(time.perf_counter() - began)
+            errors.append(abs(predicted - duration) / 60)
+    return {'profiles': count, 'build_seconds': build, 'predict_seconds': summarize(seconds),
+            'error_minutes': {'mean': float(np.mean(errors)), 'p50': float(np.median(errors))}}
+
+# Role sets of the startup benchmark
+STARTUP_ROLES = {
+    'cli': 'cli',
+    'api': 'api',
+    'background': 'poller,bot',
+    'all': 'api,poller,bot',
+}
+
+# Run in a fresh interpreter: argv[1] is the config as JSON, argv[2] the roles
+STARTUP_SCRIPT = """
+import json, sys, threading, time
+began = time.perf_counter()
+from laundrymeter import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(sys.argv[1]), roles=sys.argv[2])
+created = time.perf_counter()
+print(json.dumps({'import_seconds': imported - began, 'create_seconds': created - imported,
+                  'threads': threading.active_count(),
+                  'libraries': sorted(name for name in ('apscheduler', 'flask_restplus', 'ldap3', 'pyHS100', 'telegram')
+                                      if name in sys.modules)}))
+sys.stdout.flush()
+import os
+os._exit(0) # Don't wait for the background tasks to shut down
+"""
+
+def bot_api() -> ThreadingHTTPServer:
+    """Start a stand-in for the Telegram Bot API answering every method, without any updates."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            method = self.path.rsplit('/', 1)[-1]
+            if method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+            elif method == 'getUpdates':
+                time.sleep(1) # Like a long poll without updates
+                result = []
+            else:
+                result = True
+            data = json.dumps({'ok': True, 'result': result}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_startup(runs: int, options: dict) -> dict:
+    """Start fresh interpreters creating the app with each set of roles."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = bot_api()
+    results = {}
+    for name, roles in STARTUP_ROLES.items():
+        process_seconds, import_seconds, create_seconds = [], [], []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                config = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'db.sqlite'),
+                          'ARCHIVE_PATH': os.path.join(tmp, 'archive'),
+                          'STATE_PATH': os.path.join(tmp, 'state'),
+                          'METRICS_PATH': os.path.join(tmp, 'metrics'),
+                          'LEADER_LOCK_PATH': os.path.join(tmp, 'leader.lock'),
+                          'SMART_PLUGS': [{'id': 'default', 'ip': 'sim:synthetic'}],
+                          'TELEGRAM_BOT_TOKEN': '123456:benchmark',
+                          'TELEGRAM_API_URL': 'http://127.0.0.1:{}/bot'.format(server.server_port),
+                          'TESTING': True}
+                began = time.perf_counter()
+                output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(config), roles],
+                                                 cwd=root, stderr=subprocess.DEVNULL)
+                process_seconds.append(time.perf_counter() - began)
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            import_seconds.append(result['import_seconds'])
+            create_seconds.append(result['create_seconds'])
+        results[name] = {'roles': roles,
+                         'process_seconds': summarize(process_seconds),
+                         'import_seconds': summarize(import_seconds),
+                         'create_seconds': summarize(create_seconds),
+                         'threads': result['threads'],
+                         'libraries': result['libraries']}
+    server.shutdown()
+    server.server_close()
+    return results
+
+def isolated(func, *args) -> dict:
+    """Run a benchmark in a fresh process."""
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(func, args)
+
+def flatten(results, prefix: str = '') -> dict:
+    """Flatten nested results into {'a/b/c': number}."""
+    if isinstance(results, dict):
+        flat = {}
+        for key, value in results.items():
+            flat.update(flatten(value, prefix + '/' + str(key) if prefix else str(key)))
+        return flat
+    if isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix: results}
+    return {}
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return the timings that got slower than the baseline by more than `tolerance`."""
+    new, old = flatten(results['results']), flatten(baseline['results'])
+    regressions = []
+    for key, value in sorted(new.items()):
+        timing = 'seconds' in key and '/statements/' not in key
+        if timing and old.get(key) and value > old[key] * (1 + tolerance):
+            regressions.append({'metric': key, 'baseline': old[key], 'value': value, 'ratio': value / old[key]})
+    return regressions
+
+def revision() -> str:
+    """Return the git revision of the benchmarked code, None outside of a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(SIZES), help='Table sizes to benchmark: ' + ', '.join(SIZES))
+    parser.add_argument('--ticks', type=int, default=200, help='Poll ticks timed per size.')
+    parser.add_argument('--machines', type=int, default=1, help='Number of simulated machines.')
+    parser.add_argument('--plug-latency', type=float, default=0.05, help='Seconds every plug query takes.')
+    parser.add_argument('--plug-jitter', type=float, default=0.02, help='Random additional plug latency.')
+    parser.add_argument('--failure-rate', type=float, default=0.01, help='Probability of a plug query failing.')
+    parser.add_argument('--subscribers', default='10,100,1000', help='Subscriber counts of the notification benchmark.')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Seconds every Telegram message takes.')
+    parser.add_argument('--smtp-latency', type=float, default=0.02, help='Seconds every SMTP command takes.')
+    parser.add_argument('--cycles', type=int, default=200, help='Synthetic wash cycles of the detector benchmark.')
+    parser.add_argument('--history-rows', type=int, default=100000, help='Readings dumped by the serialization benchmark.')
+    parser.add_argument('--transfer-rows', type=int, default=200000, help='Readings exported and imported by the transfer benchmark.')
+    parser.add_argument('--profiles', type=int, default=2000, help='Cycle profiles in the library of the prediction benchmark.')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Fresh interpreters started per role set.')
+    parser.add_argument('--only', default='ticks,retention,notifications,detectors,serialization,transfer,prediction,startup',
+                        help='Benchmarks to run.')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout.')
+    parser.add_argument('--compare', help='Previous results to list regressions against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against --compare.')
+    args = parser.parse_args(argv)
+    options = vars(args)
+    only = args.only.split(',')
+    sizes = args.sizes.split(',')
+
+    results = {}
+    if 'ticks' in only:
+        results['ticks'] = {size: isolated(bench_ticks, size, options) for size in sizes}
+    if 'retention' in only:
+        results['retention'] = {size: isolated(bench_retention, size, options) for size in sizes}
+    if 'notifications' in only:
+        results['notifications'] = {count: isolated(bench_notifications, int(count), options)
+                                    for count in args.subscribers.split(',')}
+    if 'detectors' in only:
+        results['detectors'] = isolated(bench_detectors, args.cycles, options)
+    if 'serialization' in only:
+        results['serialization'] = isolated(bench_serialization, args.history_rows, options)
+    if 'transfer' in only:
+        results['transfer'] = isolated(bench_transfer, args.transfer_rows, options)
+    if 'prediction' in only:
+        results['prediction'] = isolated(bench_prediction, args.profiles, options)
+    if 'startup' in only:
+        results['startup'] = bench_startup(args.startup_runs, options)
+
+    report = {'meta': {'revision': revision(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': datetime.utcnow().isoformat(),
+                       'options': options},
+              'results': results}
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
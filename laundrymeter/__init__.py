@@ -12,16 +12,26 @@ import os
 from flask import Flask
 import logging
 
-from .apis import bp as api
 from .models import db, ma
+from . import models
 from . import telegram_bot
-from . import wm_poller
-from . import db_helper
+from . import state
+from . import recent
+from . import leader
+from . import roles as process_roles
 
 
 # Application Factory
-def create_app(test_config=None):
-    """The application factory."""
+def create_app(test_config=None, roles=None, script_info=None):
+    """The application factory.
+
+    Args:
+        test_config: Config overriding the defaults and the instance config.
+        roles: Subsystems to set up (see `roles`), e.g. `('api',)` for an
+               HTTP-only worker. Defaults to `LAUNDRYMETER_ROLES` or `ROLES`.
+        script_info: Passed by the `flask` command, whose apps default to
+                     the `cli` role (except for `flask run`).
+    """
     
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
@@ -36,15 +46,82 @@ def create_app(test_config=None):
         SQLALCHEMY_TRACK_MODIFICATIONS=True,
     
         # Custom config
+        ROLES=('api', 'poller', 'bot'), # Subsystems set up by create_app (see roles.py), `flask` commands only use 'cli'
         LDAP_URL="ldap.example.org",
         LDAP_BASE_DN="DC=example, DC=org",
+        LDAP_POOL_SIZE=4,               # Number of idle LDAP connections kept open for reuse
+        LDAP_CACHE_SIZE=1024,           # Number of users whose verified credentials are cached
+        LDAP_CACHE_TTL=300,             # Verified credentials are cached for 5 minutes
+        TOKEN_CACHE_SIZE=1024,          # Number of verified auth tokens cached
+        TOKEN_CACHE_TTL=300,            # Verified auth tokens are cached for 5 minutes
+        TELEGRAM_CHAT_CACHE_SIZE=1024,  # Number of authenticated Telegram chats cached
+        TELEGRAM_CHAT_CACHE_TTL=300,    # Authenticated Telegram chats are cached for 5 minutes
         SMART_PLUG_IP='192.168.1.100',
+        SMART_PLUGS=None,               # List of {'id': ..., 'ip': ...} dicts to poll several machines; defaults to SMART_PLUG_IP
+        POLL_WORKERS=8,                 # Maximum number of smart plugs queried concurrently
         SMTP_EMAIL='test@example.org',
         SMTP_PASSWORD='dev',
+        SMTP_HOST='smtp.gmail.com',
+        SMTP_PORT=587,
         TELEGRAM_BOT_TOKEN='dev',
+        TELEGRAM_API_URL='https://api.telegram.org/bot', # Base URL of the Bot API, the token is appended
+        TELEGRAM_WEBHOOK_URL=None,      # Public URL of /api/telegram/webhook to receive updates there instead of polling
+        TELEGRAM_WEBHOOK_SECRET=None,   # Last part of the webhook path, derived from the bot token if None
         POLL_INTERVAL=5,                # The washing machine will be polled every 5 seconds
+        ADAPTIVE_POLLING=False,         # Poll less often while the machine is idle
+        POLL_INTERVAL_MAX=60,           # Adaptive polling: poll at least every 60 seconds...
+        POLL_BACKOFF=1.5,               # ...growing the interval by 50% with every idle reading...
+        POLL_NEAR_THRESHOLD=0.5,        # ...but poll every POLL_INTERVAL from half the RUNNING_THRESHOLD_POWER on
         RUNNING_THRESHOLD_POWER = 80,   # below 80 Watts, the machine will be considered "not running"
-        RUNNING_THRESHOLD_TICKS = 56    # after 56 Ticks (a 5 sec) it will be considered "off"
+        RUNNING_THRESHOLD_TICKS = 56,   # after 56 Ticks (a 5 sec, i.e. 280 seconds) it will be considered "off"
+        RUNNING_THRESHOLD_SECONDS=280,  # after 280 seconds below threshold it will be considered "off" (timed/hysteresis)
+        DETECTOR='ticks',               # Running detector: ticks, timed, hysteresis or energy (see detectors.py)
+        DETECTOR_LOW_POWER=10,          # hysteresis: below 10 Watts the stop delay starts
+        DETECTOR_ENERGY_WINDOW=300,     # energy: mean power is taken over the last 300 seconds...
+        DETECTOR_ENERGY_POWER=20,       # ...and has to be above 20 Watts for "running"
+        PROFILE_RESOLUTION=60,          # Cycle profiles hold the mean power per minute...
+        PROFILE_MAX_SECONDS=21600,      # ...of at most 6 hours
+        PROFILE_LIBRARY_SIZE=5000,      # Running cycles are matched against the newest 5000 profiles of the machine
+        PREDICT_NEIGHBORS=5,            # The remaining time is the median of the 5 most similar profiles
+        REPLAY_MAX_GAP=900,             # Replay benchmark: pauses up to 15 min belong to the same cycle
+        CHANGE_ONLY_STORAGE=False,      # Only store readings leaving the deadbands, extend the current run otherwise
+        DEADBAND_POWER=1.0,             # Power changes up to 1 Watt extend the current run
+        DEADBAND_VOLTAGE=2.0,           # Voltage changes up to 2 Volts extend the current run
+        RUN_SYNC_INTERVAL=60,           # Write the extension of the current run to the database every 60 seconds
+        WRITE_BUFFER_TICKS=12,          # Write buffered readings to the database every 12 ticks...
+        WRITE_BUFFER_SECONDS=60,        # ...or at least every 60 seconds (and on every running/stopped change)
+        WRITE_BUFFER_MAX_ROWS=17280,    # While writes fail, keep at most 17280 new readings (a day of a machine) to retry
+        HISTORY_BATCH_SIZE=1000,        # History is read from the database in batches of 1000 rows
+        TRANSFER_BATCH_SIZE=10000,      # export-/import-readings stream 10000 rows at a time...
+        TRANSFER_COMMIT_ROWS=500000,    # ...and commit imports every 500000 rows
+        RECENT_READINGS=4096,           # The newest 4096 readings per machine (~5.5 hours) are kept in memory
+        TELEGRAM_DEBUG_READINGS=50,     # /debug lists the power of at most 50 recent readings
+        HISTORY_CACHE_MAX_AGE=86400,    # Complete history ranges may be cached for up to a day
+        ARCHIVE_PATH=os.path.join(app.instance_path, 'archive'),
+        ARCHIVE_READINGS=False,         # Move raw readings to the columnar archive instead of dropping them
+        ROLLUP_INTERVAL=60,             # Fold readings into the minute/hour tiers every 60 seconds
+        RAW_RETENTION_DAYS=2,           # Keep every single reading for 2 days
+        MINUTE_RETENTION_DAYS=90,       # Keep per minute aggregates for 90 days
+        HOUR_RETENTION_DAYS=3650,       # Keep per hour aggregates for 10 years
+        STATS_MAX_GAP=300,              # Usage statistics: gaps over 5 minutes between readings aren't counted as observed
+        STATS_DEFAULT_DAYS=28,          # Statistics cover the last 4 weeks unless a range is requested
+        NOTIFY_BATCH_SIZE=500,          # Send at most 500 queued notifications at once
+        NOTIFY_TELEGRAM_WORKERS=4,      # Number of Telegram messages sent concurrently...
+        NOTIFY_TELEGRAM_RATE=25,        # ...but at most 25 per second (Telegram allows about 30)
+        NOTIFY_TIMEOUT=30,              # Timeout of the SMTP connection in seconds
+        NOTIFY_BACKOFF=30,              # Retry failed notifications after 30 seconds, doubling every attempt...
+        NOTIFY_BACKOFF_MAX=3600,        # ...up to an hour
+        NOTIFY_MAX_ATTEMPTS=8,          # Give up on a notification after 8 attempts
+        LEADER_LOCK_PATH=os.path.join(app.instance_path, 'leader.lock'),
+        LEADER_RETRY_INTERVAL=5,        # Followers try to become leader every 5 seconds
+        STATE_PATH=os.path.join(app.instance_path, 'state'),
+        STATE_CHECK_INTERVAL=0.5,       # Waiting followers check for new readings of the leader every 0.5 seconds
+        LONG_POLL_TIMEOUT=30,           # Long-poll requests wait at most 30 seconds for a change
+        STREAM_KEEPALIVE=15,            # Send a comment on idle event streams every 15 seconds
+        STREAM_MAX_SECONDS=300,         # Close event streams after 5 minutes, clients reconnect
+        METRICS_PATH=os.path.join(app.instance_path, 'metrics'),
+        METRICS_DUMP_INTERVAL=10,       # Every process shares its metrics every 10 seconds...
+        METRICS_IDLE_SECONDS=600,       # ...as long as they have been scraped in the last 10 minutes
     )
 
     if test_config is None:
@@ -57,23 +134,79 @@ def create_app(test_config=None):
     # Ensure the instance folder exists
     os.makedirs(app.instance_path, exist_ok=True)
 
-    # Register flask-restplus
-    app.register_blueprint(api, url_prefix='/api')
+    roles = app.config['ROLES'] = process_roles.resolve(app.config, roles, cli=script_info is not None)
+    app.logger.debug("Roles of the process: %s", ', '.join(roles) or 'none')
 
     # Initialize SQLAlchemy Database
     db.init_app(app)
-
-    # Register init-db command/init app
-    db_helper.init_app(app)
+    models.init_app(app)
 
     # Register Marshmallow (after SQLAlchemy)
     ma.init_app(app)
 
-    # Init telegram bot
-    telegram_bot.init_app(app)
+    # Share the newest readings between the processes
+    state.init_app(app)
+    recent.init_app(app)
+
+    # Remember the app for the bot, it is only created on first use
+    telegram_bot.configure(app)
+
+    if process_roles.CLI in roles:
+        # Register init-db and the other commands
+        from . import db_helper
+        from . import replay
+        db_helper.init_app(app)
+        replay.init_app(app)
+        process_roles.init_app(app)
+
+    if process_roles.API in roles:
+        # Register flask-restplus
+        from .apis import bp as api
+        app.register_blueprint(api, url_prefix='/api')
+
+        # Init LDAP connection pool and credential cache
+        from . import ldap_auth
+        ldap_auth.init_app(app)
+
+    if set(roles) & {process_roles.API, process_roles.POLLER, process_roles.BOT}:
+        # Record metrics of requests and share them between the processes
+        from . import metrics
+        metrics.init_app(app)
 
-    # Init Washing Machine poller
-    wm_poller.init_app(app)
+    start_background(app, roles)
 
     app.logger.debug("Finished setting up main application.")
-    return app
\ No newline at end of file
+    return app
+
+def start_background(app, roles):
+    """Take part in the leader election if the process has any background roles."""
+    background = [role for role in roles if role in process_roles.BACKGROUND]
+    if background:
+        # Only one process polls the machines, receives bot updates and sends notifications
+        leader.init_app(app, lambda app: start_leader(app, background))
+
+def start_leader(app, roles=process_roles.BACKGROUND):
+    """Start the background tasks run by the leader process only.
+
+    The roles are started independently, so e.g. an unreachable Telegram
+    API doesn't keep the machines from being polled.
+    """
+    if process_roles.POLLER in roles:
+        try:
+            from . import notifications
+            from . import wm_poller
+
+            # Start sending queued notifications
+            notifications.init_app(app)
+
+            # Init Washing Machine poller
+            wm_poller.init_app(app)
+        except Exception as e:
+            app.logger.exception("Error starting the poller.")
+
+    if process_roles.BOT in roles:
+        try:
+            # Start receiving telegram updates
+            telegram_bot.init_app(app)
+        except Exception as e:
+            app.logger.exception("Error starting the Telegram bot.")
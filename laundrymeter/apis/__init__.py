@@ -14,6 +14,8 @@ from .machine import api as machine
 from .email import api as email
 from .telegram import api as telegram
 from .auth import api as auth, auth as basic_auth
+from .metrics import api as metrics
+from .stats import api as stats
 
 # Create Flask Blueprint
 bp = Blueprint('api', __name__)
@@ -42,4 +44,6 @@ api.namespaces.clear() # TODO: Remove this after upgrading to flask-restplus 0.1
 api.add_namespace(auth, path='/auth')
 api.add_namespace(machine, path='/machine')
 api.add_namespace(email, path='/email')
-api.add_namespace(telegram, path='/telegram')
\ No newline at end of file
+api.add_namespace(telegram, path='/telegram')
+api.add_namespace(metrics, path='/metrics')
+api.add_namespace(stats, path='/stats')
\ No newline at end of file
@@ -5,16 +5,17 @@ This module contains functions for authentication. Namely a function for
 verifying logins and an api endpoint for generating tokens. Simply import
 `auth` from here and protect any function called with `@auth.login_required`.
 Authentication is possible via username:password or token:unused via 
-HTTP Basic Auth. 
+HTTP Basic Auth. LDAP binds go through the pooled connections and credential
+cache of `ldap_auth`.
 
 """
 
 from flask_restplus import Namespace, Resource, abort
 from flask_httpauth import HTTPBasicAuth
 from flask import current_app, g
-from ldap3 import Server, Connection, ALL
 
 from ..models import User, db
+from .. import ldap_auth
 
 # TODO: Add api doc?
 
@@ -72,53 +73,57 @@ def verify_login(username_or_token, password):
     if user:
         current_app.logger.debug('User %s (%s) authenticated via token.', user.username, user.name)
 
+    if not user and ldap_auth.credentials.check(username_or_token, password):
+        # Verified against ldap recently, no need to bind again
+        user = User.query.get(username_or_token)
+        if user:
+            current_app.logger.debug('User %s (%s) authenticated via cached ldap credentials.', user.username, user.name)
+
     if not user:
         # Verify User against ldap
-        server = Server(current_app.config['LDAP_URL'],
-                        use_ssl=True,
-                        get_info=ALL)
         ldap_username = '{username}@{ldap}'.format(username=username_or_token,
                                                    ldap=current_app.config['LDAP_URL'])
-        conn = Connection(server, ldap_username, password)
-        if not conn.bind():
-            current_app.logger.debug('User %s could not be verified against LDAP.', username_or_token)
-            return False
-
-        # Check if user is in local database already
-        user = User.query.get(username_or_token)
-
-        if user:
-            current_app.logger.debug('User %s (%s) authenticated via ldap.', user.username, user.name)
-
-        # Add new record if not
-        if not user:
-            resultSearch = conn.search(
-                    current_app.config['LDAP_BASE_DN'],
-                    '(&(sAMAccountName={username})(objectclass=person))'.format(
-                        username=username_or_token),
-                    attributes=['name', 'mail'])
-            if not resultSearch:
-                current_app.logger.error('Could not get user info for %s from ldap.', username_or_token)
-                return False
-
-            user = User(username=username_or_token,
-                        email=conn.entries[0].mail.value,
-                        name=conn.entries[0].name.value,
-                        notify_email=False,
-                        notify_telegram=False,
-                        telegram_token = None,
-                        telegram_chat_id=None,
-                        auth_token=None)
-            current_app.logger.debug('New user %s (%s) has been created.', user.username, user.name)
-            current_app.logger.debug('Trying to add new user %s (%s) to the database.', user.username, user.name)
-            
-            try:
-                db.session.add(user)
-                db.session.commit()
-                current_app.logger.info('New user %s (%s) has been successfully added to the database.', user.username, user.name)
-            except Exception as e:
-                current_app.logger.exception("Couldn't add user %s (%s) to the database!", user.username, user.name)
+        with ldap_auth.pool.bind(ldap_username, password) as conn:
+            if not conn:
+                current_app.logger.debug('User %s could not be verified against LDAP.', username_or_token)
                 return False
+            ldap_auth.credentials.add(username_or_token, password)
+
+            # Check if user is in local database already
+            user = User.query.get(username_or_token)
+
+            if user:
+                current_app.logger.debug('User %s (%s) authenticated via ldap.', user.username, user.name)
+
+            # Add new record if not
+            if not user:
+                resultSearch = conn.search(
+                        current_app.config['LDAP_BASE_DN'],
+                        '(&(sAMAccountName={username})(objectclass=person))'.format(
+                            username=username_or_token),
+                        attributes=['name', 'mail'])
+                if not resultSearch:
+                    current_app.logger.error('Could not get user info for %s from ldap.', username_or_token)
+                    return False
+
+                user = User(username=username_or_token,
+                            email=conn.entries[0].mail.value,
+                            name=conn.entries[0].name.value,
+                            notify_email=False,
+                            notify_telegram=False,
+                            telegram_token = None,
+                            telegram_chat_id=None,
+                            auth_token=None)
+                current_app.logger.debug('New user %s (%s) has been created.', user.username, user.name)
+                current_app.logger.debug('Trying to add new user %s (%s) to the database.', user.username, user.name)
+                
+                try:
+                    db.session.add(user)
+                    db.session.commit()
+                    current_app.logger.info('New user %s (%s) has been successfully added to the database.', user.username, user.name)
+                except Exception as e:
+                    current_app.logger.exception("Couldn't add user %s (%s) to the database!", user.username, user.name)
+                    return False
 
 
     # Add user to global context, so it is accessible in the called method
@@ -9,15 +9,14 @@ email notifications.
 from flask import g, current_app
 from flask_restplus import Namespace, Resource, abort
 
-from ..models import User, UserSchema
+from ..models import User
+from .. import serializers
 from .auth import auth
 
 
 api = Namespace('email',
                 description='Operations for registering and listing Email notifications.')
 
-user_list_schema = UserSchema(only=['name'], many=True)
-
 # TODO: Add failure.. (i.e. on error)
 # TODO: Add api doc
 # TODO: Add docstring
@@ -29,13 +28,13 @@ class NotifyEmail(Resource):
     def get(self):
         """Get a list of users to be notified via email."""
         try:
-            users = User.query.filter_by(notify_email=True)
+            users = serializers.user_names.query().filter(User.notify_email == True).all()
         except Exception as e:
             current_app.logger.exception('User %s (%s) raised an error on NotifyEmail.get()', g.user.username, g.user.name)
             return abort(500)
             
         current_app.logger.debug('User %s (%s) successfully called NotifyEmail.get()', g.user.username, g.user.name)
-        return user_list_schema.dumps(users), 200
+        return serializers.user_names.dumps(users, many=True), 200
     
     @auth.login_required
     def post(self):
@@ -3,41 +3,87 @@
 
 This module provides an endpoint for retrieving the normal and extenden (debug)
 status of the washing machine. It has endpoints for retrieving the current time
-as well as in the past.
+as well as in the past, and for waiting for changes (long-poll and
+Server-Sent Events). When several machines are polled, the machine can be
+selected with the `machine` query parameter, which defaults to the first
+configured machine.
 
 """
 
-from flask import g, current_app
+from flask import g, current_app, request, Response, stream_with_context
 from flask_restplus import Namespace, Resource, abort
-from sqlalchemy import desc
+from werkzeug.http import http_date
+from datetime import datetime, timedelta, timezone
+import time
 
-from ..models import WashingMachine, WashingMachineSchema
+from ..models import WashingMachine, WashingMachineMinute, WashingMachineHour, CycleSchema
+from ..state import plug_config
+from .. import rollup
+from .. import state
+from .. import serializers
+from .. import history
+from .. import recent
+from .. import archive
+from .. import cycles
 from .auth import auth
 
 
 api = Namespace('machine',
                 description='Operations for querying the machine status.')
 
-wm_status_schema = WashingMachineSchema(only=('timestamp', 'running', 'last_changed'))
-wm_debug_schema = WashingMachineSchema()
+history_serializers = {
+    WashingMachine: serializers.wm_debug,
+    WashingMachineMinute: serializers.minute,
+    WashingMachineHour: serializers.hour,
+}
+history_resolution = {
+    WashingMachineMinute: rollup.MINUTE,
+    WashingMachineHour: rollup.HOUR,
+}
+cycle_schema = CycleSchema()
 
 # TODO: Check returned Schema format. Maybe include name/title?
 # TODO: Add api doc
 # TODO: Add docstring
 
+def requested_machine_id() -> str:
+    """Return the machine id requested via `?machine=`, aborting with 404 if unknown."""
+    machine_ids = [plug['id'] for plug in plug_config(current_app.config)]
+    machine_id = request.args.get('machine', machine_ids[0])
+    if machine_id not in machine_ids:
+        abort(404, 'Unknown machine {}'.format(machine_id))
+    return machine_id
+
+
 @api.route('/')
 class Machine(Resource):
     @auth.login_required
     def get(self):
-        "Return the current status of the washing machine."
+        """Return the current status of the washing machine.
+
+        While a cycle is running, `remaining` is the predicted number of
+        seconds until it ends (null if unknown).
+        """
+        machine_id = requested_machine_id()
         try:
-            washing_machine = WashingMachine.query.order_by(desc('timestamp')).first()
+            snapshot = state.latest.get(machine_id)
         except Exception as e:
             current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
             return abort(500)
         
         current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
-        return wm_status_schema.dumps(washing_machine) # dumps returns JSON, dump dic
+        if not snapshot:
+            return '{}'
+        return conditional(snapshot, snapshot.status_json) # Serialized once per tick by the poller
+
+
+@api.route('/list')
+class MachineList(Resource):
+    @auth.login_required
+    def get(self):
+        "Return the ids of all polled washing machines."
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return [plug['id'] for plug in plug_config(current_app.config)]
 
 
 @api.route('/debug')
@@ -45,25 +91,280 @@ class DebugInfo(Resource):
     @auth.login_required
     def get(self):
         "Return current extended status of the washing machine."
+        machine_id = requested_machine_id()
         try:
-            washing_machine = WashingMachine.query.order_by(desc('timestamp')).first()
+            snapshot = state.latest.get(machine_id)
         except Exception as e:
             current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
             return abort(500)
 
         current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
-        return wm_debug_schema.dumps(washing_machine)
+        if not snapshot:
+            return '{}'
+        return conditional(snapshot, snapshot.debug_json)
+
+@api.route('/wait')
+class MachineWait(Resource):
+    @auth.login_required
+    def get(self):
+        """Long-poll for a change of the running state of the washing machine.
+
+        Returns the current status as soon as its `last_changed` is newer than
+        `?since=` (ISO 8601, UTC), i.e. right away if it already is or no
+        `since` is given. Returns 204 if nothing changed within `?timeout=`
+        seconds (at most `LONG_POLL_TIMEOUT`).
+        """
+        machine_id = requested_machine_id()
+        try:
+            since = parse_timestamp('since')
+        except ValueError as e:
+            return abort(400, str(e))
+        timeout = min(request.args.get('timeout', current_app.config['LONG_POLL_TIMEOUT'], type=float),
+                      current_app.config['LONG_POLL_TIMEOUT'])
+
+        try:
+            snapshot = state.latest.wait(machine_id, since, 'last_changed', timeout)
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        if not snapshot:
+            return '', 204
+        return snapshot.status_json
+
+
+@api.route('/events')
+class MachineEvents(Resource):
+    @auth.login_required
+    def get(self):
+        """Stream the status of the washing machine as Server-Sent Events.
+
+        A `status` event is sent for every new reading, starting with the
+        current one unless the `Last-Event-ID` header (the timestamp of the
+        last received reading) says it was already received. The stream is
+        closed after `STREAM_MAX_SECONDS`, the client reconnects by itself.
+        """
+        machine_id = requested_machine_id()
+        try:
+            last = datetime.fromisoformat(request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            last = None
+        keepalive = current_app.config['STREAM_KEEPALIVE']
+        deadline = time.monotonic() + current_app.config['STREAM_MAX_SECONDS']
+
+        def generate():
+            nonlocal last
+            yield 'retry: 1000\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                snapshot = state.latest.wait(machine_id, last, 'timestamp', min(keepalive, remaining))
+                if not snapshot:
+                    yield ': keepalive\n\n'
+                    continue
+                last = snapshot.reading['timestamp']
+                yield 'id: {}\nevent: status\ndata: {}\n\n'.format(last.isoformat(), snapshot.status_json)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 @api.route('/history/<int:amount>')
 class MachineHistory(Resource):
     @auth.login_required
     def get(self, amount):
-        "Returns list of last 'amount' washing machine states (one state every 5s)."
+        """Returns list of last 'amount' washing machine states (one state every 5s).
+
+        Older states are only kept aggregated. If the requested range reaches
+        further back than the raw readings are kept, the per minute or per
+        hour aggregates covering the range are returned instead.
+
+        Runs of change-only storage are expanded into single states, unless
+        `?dense=0` is passed. The newest states are read from memory (see
+        `recent`), only older ones from the database.
+        """
+        machine_id = requested_machine_id()
+        dense = request.args.get('dense', '1') != '0'
+        try:
+            now = datetime.utcnow()
+            start = now - timedelta(seconds=amount * current_app.config['POLL_INTERVAL'])
+            model = rollup.history_model(start, now, current_app.config)
+            if model is WashingMachine and (dense or not current_app.config['CHANGE_ONLY_STORAGE']):
+                rows = recent.latest(machine_id, amount, current_app.config['HISTORY_BATCH_SIZE'])
+            elif model is WashingMachine:
+                rows = history.latest(model, machine_id, amount, current_app.config['HISTORY_BATCH_SIZE'], dense)
+            else:
+                start = rollup.floor_time(start, history_resolution[model])
+                rows = list(history.iter_rows(model, machine_id, start,
+                                              batch=current_app.config['HISTORY_BATCH_SIZE'],
+                                              descending=True))
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get(%d)', g.user.username, g.user.name, amount)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get(%d)', g.user.username, g.user.name, amount)
+        return history_serializers[model].dumps_dicts(rows)
+
+
+@api.route('/history')
+class MachineHistoryRange(Resource):
+    @auth.login_required
+    def get(self):
+        """Stream the washing machine states between `from` and `to`, oldest first.
+
+        `from` and `to` are ISO 8601 timestamps in UTC. `to` defaults to now,
+        `from` to one day before `to`. To continue a range, pass the timestamp
+        of the last received state as `after`, optionally limiting the states
+        per response with `limit`. Ranges reaching further back than the raw
+        readings are kept return per minute or per hour aggregates, unless
+        they have been archived.
+
+        The response is streamed as a JSON list, or as one JSON object per
+        line with `?format=ndjson`. Complete ranges in the past may be cached
+        until they move to a coarser tier (at most `HISTORY_CACHE_MAX_AGE`).
+        """
+        machine_id = requested_machine_id()
+        try:
+            end = parse_timestamp('to') or datetime.utcnow()
+            start = parse_timestamp('from') or end - timedelta(days=1)
+            after = parse_timestamp('after')
+            limit = request.args.get('limit', type=int)
+        except ValueError as e:
+            return abort(400, str(e))
+        ndjson = request.args.get('format') == 'ndjson'
+
+        model = rollup.history_model(start, datetime.utcnow(), current_app.config)
+        if archive.covers(current_app.config, machine_id, start):
+            model = WashingMachine
+        serializer = history_serializers[model]
+        batch = current_app.config['HISTORY_BATCH_SIZE']
+
+        def generate():
+            if model is WashingMachine:
+                rows = recent.iter_readings(machine_id, max(start, after or start), end, batch, current_app.config)
+            else:
+                rows = history.iter_readings(model, machine_id, max(start, after or start), end,
+                                             batch, current_app.config)
+            if after:
+                rows = (row for row in rows if row['timestamp'] > after)
+            if limit is not None:
+                rows = (row for _, row in zip(range(limit), rows))
+
+            if ndjson:
+                for row in rows:
+                    yield serializer.dump_dict(row) + '\n'
+                return
+
+            yield '['
+            for i, row in enumerate(rows):
+                yield (',' if i else '') + serializer.dump_dict(row)
+            yield ']'
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson' if ndjson else 'application/json',
+                        headers=history_cache_headers(machine_id, start, end))
+
+
+@api.route('/cycles/<int:amount>')
+class MachineCycles(Resource):
+    @auth.login_required
+    def get(self, amount):
+        """Return the last 'amount' wash cycles of the washing machine, newest first.
+
+        A cycle that is still running has no `end`, `duration` and `energy`.
+        """
+        machine_id = requested_machine_id()
         try:
-            history = WashingMachine.query.order_by(desc('timestamp')).limit(amount)
+            rows = cycles.latest(machine_id, amount).all()
         except Exception as e:
             current_app.logger.exception('User %s (%s) raised an error on get(%d)', g.user.username, g.user.name, amount)
             return abort(500)
 
-        current_app.logger.debug('User %s (%s) successfully called get(%d)', g.user.username, g.user.name)
-        return wm_debug_schema.dumps(history, many=True)
+        current_app.logger.debug('User %s (%s) successfully called get(%d)', g.user.username, g.user.name, amount)
+        return cycle_schema.dumps(rows, many=True)
+
+
+@api.route('/cycles/last')
+class LastCycle(Resource):
+    @auth.login_required
+    def get(self):
+        "Return the last wash cycle of the washing machine."
+        machine_id = requested_machine_id()
+        try:
+            row = cycles.latest(machine_id, 1).first()
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return cycle_schema.dumps(row)
+
+
+def conditional(snapshot: state.Snapshot, body: str):
+    """Return a response with validators, or 304 Not Modified if the client is current.
+
+    The ETag and Last-Modified are taken from the timestamp of the reading,
+    so neither the database nor the serializer is needed to answer with 304.
+    """
+    timestamp = snapshot.reading['timestamp']
+    etag = '"{}"'.format(timestamp.isoformat())
+    headers = {'ETag': etag,
+               'Last-Modified': http_date(timestamp.replace(tzinfo=timezone.utc)),
+               'Cache-Control': 'no-cache'} # Clients have to revalidate every time
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag.strip('"'))
+    elif request.if_modified_since:
+        since = request.if_modified_since
+        if since.tzinfo:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        not_modified = timestamp.replace(microsecond=0) <= since
+    else:
+        not_modified = False
+
+    if not_modified:
+        return Response(status=304, headers=headers)
+    return body, 200, headers
+
+def history_cache_headers(machine_id: str, start: datetime, end: datetime) -> dict:
+    """Return the cache headers of a history range.
+
+    Ranges that are complete don't change until they move to a coarser tier.
+    Responses differ per user only by the authorization, so shared caches
+    may keep them separately per `Authorization` header.
+    """
+    now = datetime.utcnow()
+    if archive.covers(current_app.config, machine_id, start):
+        stable_until = now + timedelta(seconds=current_app.config['HISTORY_CACHE_MAX_AGE'])
+    else:
+        stable_until = rollup.history_stable_until(start, end, now, current_app.config)
+    if not stable_until or stable_until <= now:
+        return {'Cache-Control': 'no-cache'}
+
+    max_age = min(int((stable_until - now).total_seconds()), current_app.config['HISTORY_CACHE_MAX_AGE'])
+    return {'Cache-Control': 'public, max-age={}'.format(max_age),
+            'Vary': 'Authorization'}
+
+def parse_timestamp(arg: str) -> datetime:
+    """Parse an ISO 8601 timestamp query parameter, None if it isn't given.
+
+    Timestamps with a UTC offset (or 'Z') are converted to naive UTC, like
+    the stored times.
+    """
+    value = request.args.get(arg)
+    if not value:
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    elif len(value) > 19 and value[-6] == ' ':
+        value = value[:-6] + '+' + value[-5:] # '+' of the offset not encoded in the query string
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Invalid timestamp for '{}': {}".format(arg, request.args.get(arg)))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""REST API for monitoring
+
+Exposes the metrics of all processes in the Prometheus text format (see
+`laundrymeter.metrics`). Prometheus can authenticate with a token as user
+name, just like any other client.
+
+"""
+
+from flask import g, current_app, Response
+from flask_restplus import Namespace, Resource, abort
+
+from .. import metrics
+from .auth import auth
+
+
+api = Namespace('metrics',
+                description='Operations for monitoring the service.')
+
+
+@api.route('/')
+class Metrics(Resource):
+    @auth.login_required
+    def get(self):
+        "Return the metrics in the Prometheus text format."
+        try:
+            text = metrics.registry.render()
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return Response(text, mimetype='text/plain; version=0.0.4')
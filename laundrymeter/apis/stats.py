@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""REST API for usage statistics
+
+Statistics of a machine over the range between `from` and `to` (ISO 8601
+timestamps in UTC, the last `STATS_DEFAULT_DAYS` days by default). They are
+computed from the hourly aggregates maintained by the poller (see
+`laundrymeter.stats`), so even ranges of years are answered quickly. The
+machine is selected with the `machine` query parameter, like in the
+`machine` namespace.
+
+"""
+
+from flask import g, current_app
+from flask_restplus import Namespace, Resource, abort
+from datetime import datetime, timedelta
+
+from .. import stats
+from .auth import auth
+from .machine import requested_machine_id, parse_timestamp
+
+
+api = Namespace('stats',
+                description='Operations for querying usage statistics.')
+
+
+def requested_range() -> tuple:
+    """Return the range requested via `?from=` and `?to=`, aborting with 400 if invalid."""
+    try:
+        end = parse_timestamp('to') or datetime.utcnow()
+        start = parse_timestamp('from') or end - timedelta(days=current_app.config['STATS_DEFAULT_DAYS'])
+    except ValueError as e:
+        abort(400, str(e))
+    return start, end
+
+
+@api.route('/')
+class Summary(Resource):
+    @auth.login_required
+    def get(self):
+        """Return the energy (kWh), cycles and running time of the machine in the range.
+
+        `occupancy` is the fraction of the observed time the machine was running.
+        """
+        machine_id = requested_machine_id()
+        start, end = requested_range()
+        try:
+            result = stats.summary(machine_id, start, end)
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return result
+
+
+@api.route('/daily')
+class Daily(Resource):
+    @auth.login_required
+    def get(self):
+        "Return the energy (kWh), cycles and running time of the machine per day (local time), oldest first."
+        machine_id = requested_machine_id()
+        start, end = requested_range()
+        try:
+            result = stats.daily(machine_id, start, end)
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return result
+
+
+@api.route('/occupancy')
+class Occupancy(Resource):
+    @auth.login_required
+    def get(self):
+        """Return how often the machine is running per hour of the week (local time).
+
+        The 168 hours start with Monday 0:00 (`weekday` 0, `hour` 0).
+        """
+        machine_id = requested_machine_id()
+        start, end = requested_range()
+        try:
+            result = stats.occupancy(machine_id, start, end)
+        except Exception as e:
+            current_app.logger.exception('User %s (%s) raised an error on get()', g.user.username, g.user.name)
+            return abort(500)
+
+        current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
+        return result
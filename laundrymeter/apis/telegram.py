@@ -2,14 +2,16 @@
 """REST API for Telegram notification operations
 
 This module provides an endpoint for registering, removing and listing
-telegram notifications.
+telegram notifications, and the webhook Telegram posts bot updates to.
 
 """
 
-from flask import g, current_app
+from flask import g, current_app, request
 from flask_restplus import Namespace, Resource, abort
+import hmac
 
-from ..models import User, UserSchema
+from ..models import User
+from .. import serializers
 from .auth import auth
 from .. import telegram_bot
 
@@ -17,21 +19,19 @@ from .. import telegram_bot
 api = Namespace('telegram',
                 description='Operations for registering and listing Telegram notifications.')
 
-user_list_schema = UserSchema(only=['name'], many=True)
-
 @api.route('/')
 class NotifyTelegram(Resource):
     @auth.login_required
     def get(self):
         """Get a list of users to be notified via telegram."""
         try:
-            users = User.query.filter_by(notify_telegram=True)
+            users = serializers.user_names.query().filter(User.notify_telegram == True).all()
         except Exception as e:
             current_app.logger.exception('User %s (%s) raised exception on get()', g.user.username, g.user.name)
             return abort(500)
         
         current_app.logger.debug('User %s (%s) successfully called get()', g.user.username, g.user.name)
-        return user_list_schema.dumps(users)
+        return serializers.user_names.dumps(users, many=True)
 
     @auth.login_required
     def post(self):
@@ -72,9 +72,32 @@ class RegisterTelegram(Resource):
         Replaces old user if previously registered, thus deauthenticating him."""
         try:
             token = g.user.generate_telegram_token()
-            auth_url = "https://telegram.me/{}?start={}".format(telegram_bot.updater.bot.name[1:], token)
+            auth_url = "https://telegram.me/{}?start={}".format(telegram_bot.get_updater().bot.name[1:], token)
             current_app.logger.debug('User %s (%s) successfully called post(). Token added.', g.user.username, g.user.name)
             return { 'result': 'success', 'auth_url': auth_url }, 200
         except Exception as e:
             current_app.logger.exception("User %s (%s) raised an exception on post(). Token couldn't be added", g.user.username, g.user.name)
-            return abort(500)
\ No newline at end of file
+            return abort(500)
+
+
+@api.route('/webhook/<string:secret>')
+@api.doc(security=None)
+class TelegramWebhook(Resource):
+    def post(self, secret):
+        """Receive a bot update from Telegram (only with `TELEGRAM_WEBHOOK_URL` set).
+
+        Telegram can't authenticate, so the path contains a secret instead.
+        The command is answered before the request returns.
+        """
+        if (not current_app.config['TELEGRAM_WEBHOOK_URL'] or
+                not hmac.compare_digest(secret, telegram_bot.webhook_secret(current_app.config))):
+            return abort(404)
+
+        try:
+            telegram_bot.process_update(request.get_json(force=True))
+        except Exception as e:
+            current_app.logger.exception("There was an error processing a Telegram update.")
+            return abort(500)
+
+        current_app.logger.debug('Successfully processed a Telegram update.')
+        return {}, 200
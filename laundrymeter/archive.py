@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Columnar archive of raw readings
+
+Old readings can be moved out of the `washingmachine` table into segments on
+disk. A segment is a directory holding one flat binary file per column with
+a fixed width dtype and a `meta.json` describing the archived range. The
+columns are memory-mapped with NumPy, so reading an archived range neither
+copies the data nor creates ORM objects.
+
+Layout::
+
+    ARCHIVE_PATH/<machine_id>/<start>--<end>/
+        meta.json
+        timestamp.bin  voltage.bin  current.bin  power.bin  total_power.bin  running.bin
+
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+import json
+import os
+import shutil
+
+import numpy as np
+from sqlalchemy import func
+
+from . import history
+from .models import WashingMachine, WashingMachineMinute, db
+from . import rollup
+
+
+DTYPES = {
+    'timestamp': np.dtype('<M8[us]'),
+    'voltage': np.dtype('<f4'),
+    'current': np.dtype('<f4'),
+    'power': np.dtype('<f4'),
+    'total_power': np.dtype('<f8'),
+    'running': np.dtype('?'),
+}
+
+TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+DAY = timedelta(days=1)
+
+
+class Segment:
+    """An archived range [start, end) of readings of a machine."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.machine_id = meta['machine_id']
+        self.start = datetime.strptime(meta['start'], TIME_FORMAT)
+        self.end = datetime.strptime(meta['end'], TIME_FORMAT)
+        self.count = meta['count']
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Memory-map all columns of the segment (read only)."""
+        if not self.count:
+            return {name: np.empty(0, dtype) for name, dtype in DTYPES.items()}
+        return {name: np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype,
+                                mode='r', shape=(self.count,))
+                for name, dtype in DTYPES.items()}
+
+
+def machine_path(config: dict, machine_id: str) -> str:
+    """Return the directory holding the segments of a machine."""
+    return os.path.join(config['ARCHIVE_PATH'], machine_id)
+
+def segments(config: dict, machine_id: str) -> List[Segment]:
+    """Return all archived segments of a machine, oldest first."""
+    path = machine_path(config, machine_id)
+    if not os.path.isdir(path):
+        return []
+    found = [Segment(os.path.join(path, name)) for name in os.listdir(path)
+             if not name.endswith('.tmp') and os.path.exists(os.path.join(path, name, 'meta.json'))]
+    return sorted(found, key=lambda segment: segment.start)
+
+def archived_until(config: dict, machine_id: str) -> datetime:
+    """Return the end of the newest segment of a machine, None if there is none."""
+    found = segments(config, machine_id)
+    return found[-1].end if found else None
+
+def covers(config: dict, machine_id: str, timestamp: datetime) -> bool:
+    """Check whether raw readings at timestamp are available from the archive."""
+    return any(segment.start <= timestamp < segment.end for segment in segments(config, machine_id))
+
+def load(config: dict, machine_id: str, start: datetime, end: datetime) -> Dict[str, np.ndarray]:
+    """Return the archived readings of a machine in [start, end) as columns.
+
+    Within a single segment the returned arrays are views into the memory
+    mapped files. Ranges spanning several segments are concatenated.
+    """
+    parts = []
+    for segment in segments(config, machine_id):
+        if segment.end <= start or segment.start >= end:
+            continue
+        columns = segment.columns()
+        lo, hi = np.searchsorted(columns['timestamp'],
+                                 [np.datetime64(start, 'us'), np.datetime64(end, 'us')])
+        parts.append({name: column[lo:hi] for name, column in columns.items()})
+
+    if not parts:
+        return {name: np.empty(0, dtype) for name, dtype in DTYPES.items()}
+    if len(parts) == 1:
+        return parts[0]
+    return {name: np.concatenate([part[name] for part in parts]) for name in DTYPES}
+
+def iter_readings(config: dict, machine_id: str, start: datetime, end: datetime) -> Iterator[dict]:
+    """Yield the archived readings of a machine in [start, end) as dicts, oldest first."""
+    for segment in segments(config, machine_id):
+        if segment.end <= start or segment.start >= end:
+            continue
+        columns = load(config, machine_id, max(start, segment.start), min(end, segment.end))
+        timestamps = columns['timestamp'].astype('M8[us]').tolist()
+        for i, timestamp in enumerate(timestamps):
+            yield {'machine_id': machine_id,
+                   'timestamp': timestamp,
+                   'running': bool(columns['running'][i]),
+                   'last_changed': None,
+                   'voltage': float(columns['voltage'][i]),
+                   'current': float(columns['current'][i]),
+                   'power': float(columns['power'][i]),
+                   'total_power': float(columns['total_power'][i]),
+                   'valid_until': timestamp,
+                   'repeat_count': 1}
+
+def archive(config: dict, machine_id: str, start: datetime, end: datetime, batch: int = 1000) -> Segment:
+    """Write the raw readings of a machine in [start, end) to a new segment.
+
+    The readings are streamed from the database and appended to the column
+    files batch by batch. Runs of change-only storage are expanded. The
+    range must not overlap an existing segment.
+
+    Returns:
+        The new segment.
+    """
+    for segment in segments(config, machine_id):
+        if segment.start < end and start < segment.end:
+            raise ValueError('Range {} - {} overlaps archived segment {} - {}'.format(
+                start, end, segment.start, segment.end))
+
+    name = '{}--{}'.format(start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))
+    path = os.path.join(machine_path(config, machine_id), name)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path) # Left over by an interrupted run
+    os.makedirs(tmp_path)
+
+    files = {column: open(os.path.join(tmp_path, column + '.bin'), 'wb') for column in DTYPES}
+    count = 0
+    try:
+        chunk = []
+        for reading in history.iter_readings(WashingMachine, machine_id, start, end, batch):
+            chunk.append(reading)
+            if len(chunk) >= batch:
+                count += write_chunk(files, chunk)
+                chunk = []
+        count += write_chunk(files, chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'machine_id': machine_id,
+                   'start': start.strftime(TIME_FORMAT),
+                   'end': end.strftime(TIME_FORMAT),
+                   'count': count,
+                   'dtypes': {column: dtype.str for column, dtype in DTYPES.items()}}, f)
+    os.rename(tmp_path, path) # Segments only become visible when complete
+    return Segment(path)
+
+def write_chunk(files: dict, chunk: List[dict]) -> int:
+    """Append a chunk of readings to the open column files."""
+    for column, dtype in DTYPES.items():
+        np.array([reading[column] for reading in chunk], dtype=dtype).tofile(files[column])
+    return len(chunk)
+
+def compact(machine_id: str, segment: Segment) -> int:
+    """Delete the rows of the database that are completely archived in a segment.
+
+    Rows the minute rollup hasn't folded yet are kept, so the rollup tiers
+    don't get gaps. They are expired by the rollup later on.
+
+    Returns:
+        The number of deleted rows.
+    """
+    end = min(segment.end, rollup.watermark(WashingMachineMinute, machine_id, rollup.MINUTE) or segment.start)
+    return (WashingMachine.query
+            .filter(WashingMachine.machine_id == machine_id,
+                    WashingMachine.timestamp >= segment.start,
+                    WashingMachine.valid_until < end)
+            .delete(synchronize_session=False))
+
+def archive_days(config: dict, machine_id: str, until: datetime) -> datetime:
+    """Archive all complete days of raw readings of a machine before until.
+
+    Used before raw readings are expired, so they are kept in the archive.
+
+    Returns:
+        The end of the archived range. Raw readings before it may be deleted.
+    """
+    start = archived_until(config, machine_id)
+    if not start:
+        oldest = (db.session.query(func.min(WashingMachine.timestamp))
+                  .filter(WashingMachine.machine_id == machine_id)
+                  .scalar())
+        if not oldest:
+            return until
+        start = rollup.floor_time(oldest, DAY)
+
+    while start + DAY <= until:
+        archive(config, machine_id, start, start + DAY)
+        start += DAY
+    return start
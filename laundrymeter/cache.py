@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Small thread safe in-memory caches
+
+Caches shared by several processes can be invalidated in all of them:
+`LRUCache.invalidate` writes a new generation to a small file (see
+`LRUCache.share`), and every process clears its entries when it sees a
+generation it doesn't know. Reading the file takes a few microseconds per
+lookup, much less than the database query a cached value saves.
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import os
+import secrets
+import time
+
+
+class LRUCache:
+    """Bounded LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, size: int, ttl: float) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.path = None # File of the generation shared with other processes
+        self._generation = secrets.token_hex(8)
+
+    def share(self, path: str) -> None:
+        """Share invalidations with the other processes using the generation file at path."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self.path = path
+            if not os.path.exists(path):
+                self._write(self._generation)
+
+    def _write(self, generation: str) -> None:
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(generation)
+        os.replace(tmp, self.path) # Readers never see a partial file
+
+    def generation(self) -> str:
+        """Return the current generation, clearing the cache if it was invalidated elsewhere.
+
+        Pass it to `set` along with a value read (e.g. from the database)
+        after calling this.
+        """
+        if self.path is None:
+            return self._generation
+        try:
+            fd = os.open(self.path, os.O_RDONLY) # Unbuffered, a third of the time of open()
+            try:
+                generation = os.read(fd, 64).decode('ascii')
+            finally:
+                os.close(fd)
+        except FileNotFoundError:
+            generation = ''
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+        return generation
+
+    def invalidate(self, *keys) -> None:
+        """Remove keys from the cache in this and (if shared) all other processes."""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            self._generation = secrets.token_hex(8)
+            if self.path is not None:
+                self._write(self._generation)
+
+    def get(self, key, default=None):
+        """Return the value cached for key, default if missing or expired."""
+        self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, generation: str = None) -> None:
+        """Cache a value, evicting the least recently used entries if full.
+
+        Args:
+            generation: The generation the value was read in. If the cache has
+                        been invalidated since, the value isn't cached.
+        """
+        if generation is not None and generation != self.generation():
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key from the cache and return its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry else default
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
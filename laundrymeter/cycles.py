@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Index of wash cycles
+
+The poller maintains the `cycles` table incrementally: a row is inserted when
+a machine starts running and completed when it stops. Questions about past
+cycles are then answered from this index without touching the readings.
+
+A cycle starts with the reading the detector switched to running and ends
+with the last reading above `RUNNING_THRESHOLD_POWER` before the detector
+switched to stopped. Its energy is the `total_power` delta between the two.
+
+"""
+
+from datetime import datetime
+from typing import Iterable, Tuple
+
+from .models import Cycle, WashingMachine, db
+from . import detectors
+from . import history
+
+
+STARTED = 'started'
+FINISHED = 'finished'
+
+
+class CycleTracker:
+    """Follows the readings of a machine and reports started and finished cycles."""
+
+    def __init__(self, machine_id: str, threshold: float) -> None:
+        self.machine_id = machine_id
+        self.threshold = threshold
+        self.cycle = None
+
+    def update(self, timestamp: datetime, power: float, total_power: float, running: bool) -> Tuple[str, dict]:
+        """Feed a reading together with the detected running state.
+
+        Returns:
+            (STARTED, cycle) or (FINISHED, cycle) on a transition, None otherwise.
+        """
+        if self.cycle is None:
+            if not running:
+                return None
+            self.cycle = {'machine_id': self.machine_id,
+                          'start': timestamp,
+                          'end': None,
+                          'duration': None,
+                          'peak_power': power,
+                          'energy': None,
+                          'start_total': total_power,
+                          'last_active': timestamp,
+                          'last_total': total_power}
+            return STARTED, self.cycle
+
+        cycle = self.cycle
+        cycle['peak_power'] = max(cycle['peak_power'], power)
+        if power > self.threshold:
+            cycle['last_active'] = timestamp
+            cycle['last_total'] = total_power
+        if running:
+            return None
+
+        cycle['end'] = cycle['last_active']
+        cycle['duration'] = (cycle['end'] - cycle['start']).total_seconds()
+        cycle['energy'] = max(cycle['last_total'] - cycle['start_total'], 0)
+        self.cycle = None
+        return FINISHED, cycle
+
+
+def columns(cycle: dict) -> dict:
+    """Return the values of a tracked cycle stored in the `cycles` table."""
+    return {name: cycle[name] for name in ('machine_id', 'start', 'end', 'duration', 'peak_power', 'energy')}
+
+def record(event: Tuple[str, dict]) -> None:
+    """Write a tracked transition to the `cycles` table (without committing).
+
+    Cycles left open by an earlier process (e.g. after a restart while the
+    machine was running) are dropped when a new cycle starts.
+    """
+    kind, cycle = event
+    if kind == STARTED:
+        (Cycle.query
+         .filter(Cycle.machine_id == cycle['machine_id'], Cycle.end.is_(None))
+         .delete(synchronize_session=False))
+        db.session.add(Cycle(**columns(cycle)))
+    else:
+        (Cycle.query
+         .filter(Cycle.machine_id == cycle['machine_id'], Cycle.start == cycle['start'])
+         .update(columns(cycle), synchronize_session=False))
+
+def latest(machine_id: str, amount: int) -> Iterable[Cycle]:
+    """Return the newest cycles of a machine, newest first."""
+    return (Cycle.query
+            .filter(Cycle.machine_id == machine_id)
+            .order_by(Cycle.start.desc())
+            .limit(amount))
+
+def backfill(config: dict, machine_id: str, start: datetime, end: datetime) -> int:
+    """Rebuild the cycles of a machine in [start, end) from the stored readings.
+
+    The readings (including archived ones) are streamed once through a fresh
+    detector. Existing cycles starting in the range are replaced. The range
+    is cut to the oldest stored reading (start may be None for that), older
+    cycles can't be rebuilt and are kept.
+
+    Returns:
+        The number of cycles written.
+    """
+    available = history.oldest(machine_id, config)
+    if not available or available >= end:
+        return 0
+    start = max(start, available) if start else available
+
+    (Cycle.query
+     .filter(Cycle.machine_id == machine_id, Cycle.start >= start, Cycle.start < end)
+     .delete(synchronize_session=False))
+
+    detector = detectors.create(config)
+    tracker = CycleTracker(machine_id, config['RUNNING_THRESHOLD_POWER'])
+    count = 0
+    for reading in history.iter_readings(WashingMachine, machine_id, start, end,
+                                         config['HISTORY_BATCH_SIZE'], config):
+        running = detector.update(detectors.seconds(reading['timestamp']), reading['power'])
+        event = tracker.update(reading['timestamp'], reading['power'], reading['total_power'], running)
+        if event and event[0] == FINISHED:
+            db.session.add(Cycle(**columns(event[1])))
+            count += 1
+    if tracker.cycle:
+        db.session.add(Cycle(**columns(tracker.cycle))) # Still running at the end of the range
+        count += 1
+    return count
@@ -1,20 +1,39 @@
 # -*- coding: utf-8 -*-
 """Contains helper functions for the database.
 
-Currently only reinitializing the database (dropping all entries) is possible.
+Reinitializing the database (dropping all entries), moving readings into
+the columnar archive, exporting and importing readings in bulk and
+rebuilding the index of wash cycles, their profiles and the usage
+statistics are possible.
 
 """
 
+from datetime import datetime
+
 import click
+from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
 
 from .models import db
+from . import archive
+from . import cycles
+from . import profiles
+from . import stats
+from . import transfer
+from .state import plug_config
 
 
 # DB Helper functions
 def init_app(app):
     """Register the 'init-db' call for re-initializing the database.x"""
     app.cli.add_command(init_db_command)
+    app.cli.add_command(archive_readings_command)
+    app.cli.add_command(export_readings_command)
+    app.cli.add_command(import_readings_command)
+    app.cli.add_command(backfill_cycles_command)
+    app.cli.add_command(backfill_profiles_command)
+    app.cli.add_command(rebuild_stats_command)
 
 def init_db():
     """Drop all tables in the database and create a new one."""
@@ -27,4 +46,108 @@ def init_db():
 def init_db_command():
     """Clear the existing data and create new tables."""
     init_db()
-    click.echo('Initialized the database.')
\ No newline at end of file
+    click.echo('Initialized the database.')
+
+@click.command('archive-readings')
+@click.argument('machine_id')
+@click.argument('start', type=click.DateTime())
+@click.argument('end', type=click.DateTime())
+@click.option('--compact/--no-compact', default=True,
+              help='Delete the archived readings the rollup already folded from the database afterwards.')
+@with_appcontext
+def archive_readings_command(machine_id, start, end, compact):
+    """Archive the readings of MACHINE_ID between START and END (UTC)."""
+    try:
+        segment = archive.archive(current_app.config, machine_id, start, end,
+                                  current_app.config['HISTORY_BATCH_SIZE'])
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('Archived {} readings to {}.'.format(segment.count, segment.path))
+
+    if compact:
+        deleted = archive.compact(machine_id, segment)
+        db.session.commit()
+        if db.engine.dialect.name == 'sqlite':
+            db.engine.execute('VACUUM') # Give the space back to the file system
+        click.echo('Deleted {} archived rows from the database.'.format(deleted))
+
+@click.command('export-readings')
+@click.argument('machine_ids', nargs=-1)
+@click.option('--output', '-o', default='-', help='File to write (.gz to compress), stdout by default.')
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), default=None,
+              help='File format, guessed from the file name by default.')
+@click.option('--from', 'start', type=click.DateTime(), default='1970-01-01', help='Start of the exported range (UTC).')
+@click.option('--to', 'end', type=click.DateTime(), default=None, help='End of the exported range (UTC), defaults to now.')
+@with_appcontext
+def export_readings_command(machine_ids, output, fmt, start, end):
+    """Export the readings of MACHINE_IDS (default: all) as CSV or NDJSON."""
+    end = end or datetime.utcnow()
+    write = transfer.WRITERS[fmt or transfer.guess_format(output)]
+    count = 0
+    with transfer.open_file(output, 'w') as out:
+        for machine_id in machine_ids or [plug['id'] for plug in plug_config(current_app.config)]:
+            count += write(transfer.export_chunks(current_app.config, machine_id, start, end,
+                                                  current_app.config['TRANSFER_BATCH_SIZE']), out)
+    click.echo('Exported {} readings.'.format(count), err=True)
+
+@click.command('import-readings')
+@click.argument('path', default='-')
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), default=None,
+              help='File format, guessed from the file name by default.')
+@click.option('--machine', 'machine_id', default=None, help='Import all readings as readings of this machine.')
+@click.option('--detect/--no-detect', default=False,
+              help='Recompute the running state and its last change with the configured detector.')
+@click.option('--replace/--no-replace', default=False,
+              help='Replace stored readings in the imported ranges instead of failing on duplicates.')
+@with_appcontext
+def import_readings_command(path, fmt, machine_id, detect, replace):
+    """Import readings from PATH (CSV or NDJSON, .gz to decompress, stdin by default)."""
+    read = transfer.READERS[fmt or transfer.guess_format(path)]
+    try:
+        with transfer.open_file(path, 'r') as f:
+            count = transfer.import_rows(current_app.config, read(f, current_app.config['TRANSFER_BATCH_SIZE']),
+                                         machine_id, detect, replace)
+    except (ValueError, IntegrityError) as e:
+        db.session.rollback()
+        raise click.ClickException('Import failed, readings before the last commit were kept: {}'.format(e))
+    click.echo('Imported {} readings. Rebuild the cycles, profiles and statistics with the backfill commands now.'.format(count))
+
+@click.command('backfill-cycles')
+@click.argument('machine_ids', nargs=-1)
+@click.option('--from', 'start', type=click.DateTime(), default=None,
+              help='Start of the rebuilt range (UTC), defaults to the oldest stored reading.')
+@click.option('--to', 'end', type=click.DateTime(), default=None, help='End of the rebuilt range (UTC), defaults to now.')
+@with_appcontext
+def backfill_cycles_command(machine_ids, start, end):
+    """Rebuild the wash cycles of MACHINE_IDS (default: all) from the stored readings."""
+    end = end or datetime.utcnow()
+    for machine_id in machine_ids or [plug['id'] for plug in plug_config(current_app.config)]:
+        count = cycles.backfill(current_app.config, machine_id, start, end)
+        db.session.commit()
+        click.echo('Found {} cycles of {}.'.format(count, machine_id))
+
+@click.command('backfill-profiles')
+@click.argument('machine_ids', nargs=-1)
+@click.option('--from', 'start', type=click.DateTime(), default='1970-01-01', help='Start of the rebuilt range (UTC).')
+@click.option('--to', 'end', type=click.DateTime(), default=None, help='End of the rebuilt range (UTC), defaults to now.')
+@with_appcontext
+def backfill_profiles_command(machine_ids, start, end):
+    """Rebuild the cycle profiles of MACHINE_IDS (default: all) from the stored readings."""
+    end = end or datetime.utcnow()
+    for machine_id in machine_ids or [plug['id'] for plug in plug_config(current_app.config)]:
+        count = profiles.backfill(current_app.config, machine_id, start, end)
+        db.session.commit()
+        click.echo('Stored {} cycle profiles of {}.'.format(count, machine_id))
+
+@click.command('rebuild-stats')
+@click.argument('machine_ids', nargs=-1)
+@click.option('--from', 'start', type=click.DateTime(), default='1970-01-01', help='Start of the rebuilt range (UTC).')
+@click.option('--to', 'end', type=click.DateTime(), default=None, help='End of the rebuilt range (UTC), defaults to now.')
+@with_appcontext
+def rebuild_stats_command(machine_ids, start, end):
+    """Recompute the usage statistics of MACHINE_IDS (default: all) from the stored history."""
+    end = end or datetime.utcnow()
+    for machine_id in machine_ids or [plug['id'] for plug in plug_config(current_app.config)]:
+        count = stats.rebuild(current_app.config, machine_id, start, end)
+        db.session.commit()
+        click.echo('Rebuilt {} hours of statistics of {}.'.format(count, machine_id))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Running/stopped detectors
+
+A detector gets one reading at a time via `update` and returns whether the
+machine is considered running, using O(1) time and memory per reading. The
+detector used by the poller is selected with `DETECTOR`:
+
+* `ticks`: Running above `RUNNING_THRESHOLD_POWER`, stopped after more than
+  `RUNNING_THRESHOLD_TICKS` poll intervals below it (the original detector).
+  The delay is measured in time, so it stays the same with adaptive polling.
+* `timed`: Like `ticks`, but stopped after `RUNNING_THRESHOLD_SECONDS`.
+* `hysteresis`: Running above `RUNNING_THRESHOLD_POWER`, stopped after
+  `RUNNING_THRESHOLD_SECONDS` below `DETECTOR_LOW_POWER`.
+* `energy`: Running while the mean power of the last `DETECTOR_ENERGY_WINDOW`
+  seconds is above `DETECTOR_ENERGY_POWER`.
+
+Every detector can also `replay` whole arrays of readings. The built-in
+detectors do this vectorized with NumPy, giving the same result as feeding
+the readings to `update` one by one. Replays continue where the previous
+`update` or `replay` left off, so long series can be replayed in chunks.
+
+"""
+
+from collections import deque
+from datetime import datetime
+import numpy as np
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def seconds(timestamp: datetime) -> float:
+    """Convert a naive UTC timestamp to seconds since the epoch."""
+    return (timestamp - EPOCH).total_seconds()
+
+
+class Detector:
+    """Interface of a streaming running/stopped detector."""
+
+    def __init__(self) -> None:
+        self.running = False
+
+    def update(self, t: float, power: float) -> bool:
+        """Feed a reading and return whether the machine is running.
+
+        Args:
+            t: Time of the reading in seconds.
+            power: Power of the reading in Watts.
+        """
+        raise NotImplementedError
+
+    def replay(self, t: np.ndarray, power: np.ndarray) -> np.ndarray:
+        """Feed arrays of readings and return the running state after each."""
+        running = np.empty(len(t), dtype=bool)
+        for i in range(len(t)):
+            running[i] = self.update(t[i], power[i])
+        return running
+
+
+class ThresholdDetector(Detector):
+    """Starts above `start_power`, stops after staying below `keep_power`.
+
+    The machine is considered stopped once more than `delay` seconds have
+    passed since the last reading at or above `keep_power`.
+    """
+
+    def __init__(self, start_power: float, keep_power: float, delay: float) -> None:
+        super().__init__()
+        self.start_power = start_power
+        self.keep_power = keep_power
+        self.delay = delay
+        self.count = 0
+        self.last_keep = None
+
+    def update(self, t: float, power: float) -> bool:
+        self.count += 1
+        if self.running:
+            if power >= self.keep_power:
+                self.last_keep = t
+            elif t - self.last_keep > self.delay:
+                self.running = False
+        elif power > self.start_power:
+            self.running = True
+            self.last_keep = t
+        return self.running
+
+    def replay(self, t: np.ndarray, power: np.ndarray) -> np.ndarray:
+        x = np.asarray(t, dtype=float)
+        power = np.asarray(power, dtype=float)
+        resumed = self.running
+        if resumed:
+            # Continue the cycle as if it had just started at its last reading above keep_power
+            x = np.concatenate(([self.last_keep], x))
+            power = np.concatenate(([np.inf], power))
+        index = np.arange(len(x))
+
+        last_keep = np.maximum.accumulate(np.where(power >= self.keep_power, x, -np.inf))
+        stop = x - last_keep > self.delay
+        last_stop = np.maximum.accumulate(np.where(stop, index, -1))
+        last_start = np.maximum.accumulate(np.where(power > self.start_power, index, -1))
+        running = last_start > last_stop
+        if resumed:
+            running, last_keep = running[1:], last_keep[1:]
+
+        # Continue streaming from where the replay ended
+        if len(running):
+            self.count += len(running)
+            self.running = bool(running[-1])
+            self.last_keep = last_keep[-1] if self.running else None
+        return running
+
+
+class EnergyDetector(Detector):
+    """Running while the mean power over a sliding time window is above a threshold."""
+
+    def __init__(self, window: float, power: float) -> None:
+        super().__init__()
+        self.window = window
+        self.power = power
+        self.energies = deque()
+        self.energy = 0.0
+        self.last_t = None
+
+    def update(self, t: float, power: float) -> bool:
+        energy = power * (t - self.last_t) if self.last_t is not None else 0.0
+        self.last_t = t
+        self.energies.append((t, energy))
+        self.energy += energy
+        while self.energies[0][0] < t - self.window:
+            self.energy -= self.energies.popleft()[1]
+        self.running = self.energy / self.window > self.power
+        return self.running
+
+    def replay(self, t: np.ndarray, power: np.ndarray) -> np.ndarray:
+        t = np.asarray(t, dtype=float)
+        energy = np.zeros(len(t))
+        energy[1:] = power[1:] * np.diff(t)
+        if self.last_t is not None and len(t):
+            energy[0] = power[0] * (t[0] - self.last_t)
+
+        # Continue with the readings still kept for the window
+        kept = len(self.energies)
+        if kept:
+            t = np.concatenate(([entry[0] for entry in self.energies], t))
+            energy = np.concatenate(([entry[1] for entry in self.energies], energy))
+        cumulative = np.concatenate(([0.0], np.cumsum(energy)))
+        first = np.searchsorted(t, t - self.window, side='left')
+        running = ((cumulative[1:] - cumulative[first]) / self.window > self.power)[kept:]
+
+        # Continue streaming from where the replay ended
+        if len(running):
+            start = first[-1]
+            self.energies = deque(zip(t[start:].tolist(), energy[start:].tolist()))
+            self.energy = float(energy[start:].sum())
+            self.last_t = float(t[-1])
+            self.running = bool(running[-1])
+        return running
+
+
+DETECTORS = {
+    'ticks': lambda config: ThresholdDetector(config['RUNNING_THRESHOLD_POWER'],
+                                              config['RUNNING_THRESHOLD_POWER'],
+                                              config['RUNNING_THRESHOLD_TICKS'] * config['POLL_INTERVAL']),
+    'timed': lambda config: ThresholdDetector(config['RUNNING_THRESHOLD_POWER'],
+                                              config['RUNNING_THRESHOLD_POWER'],
+                                              config['RUNNING_THRESHOLD_SECONDS']),
+    'hysteresis': lambda config: ThresholdDetector(config['RUNNING_THRESHOLD_POWER'],
+                                                   config['DETECTOR_LOW_POWER'],
+                                                   config['RUNNING_THRESHOLD_SECONDS']),
+    'energy': lambda config: EnergyDetector(config['DETECTOR_ENERGY_WINDOW'],
+                                            config['DETECTOR_ENERGY_POWER']),
+}
+
+
+def create(config: dict, name: str = None) -> Detector:
+    """Create the detector configured with `DETECTOR` (or the given name)."""
+    name = name or config['DETECTOR']
+    if name not in DETECTORS:
+        raise ValueError('Unknown detector {}. Available: {}'.format(name, ', '.join(DETECTORS)))
+    return DETECTORS[name](config)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Streaming access to the history of readings
+
+Rows are read with keyset pagination on `timestamp` in batches of
+`HISTORY_BATCH_SIZE`, so arbitrarily long ranges can be streamed with
+constant memory. Each batch is a separate query, which keeps the query fast
+regardless of how far into the range it is.
+
+"""
+
+from datetime import datetime
+from typing import Iterator, Sequence
+
+from sqlalchemy import func
+
+from .models import WashingMachine, db
+from . import runs
+from . import archive
+
+
+ROLLUP_COLUMNS = ('machine_id', 'timestamp', 'samples', 'power_min', 'power_max',
+                  'power_mean', 'energy', 'running_fraction')
+
+
+def columns(model) -> Sequence[str]:
+    """Return the names of the columns read from a history tier."""
+    return runs.COLUMNS if model is WashingMachine else ROLLUP_COLUMNS
+
+def iter_rows(model, machine_id: str, start: datetime = None, end: datetime = None,
+              batch: int = 1000, descending: bool = False) -> Iterator[dict]:
+    """Yield the rows of a tier reaching into [start, end) as dicts.
+
+    Args:
+        model: The tier to read (`WashingMachine` or a rollup model).
+        machine_id: The machine to read the rows of.
+        start: Rows ending before start are skipped. Runs of change-only
+               storage starting before but reaching into the range are
+               included.
+        end: Rows starting at or after end are skipped.
+        batch: Number of rows read per query.
+        descending: Yield the newest rows first.
+    """
+    names = columns(model)
+    entities = [getattr(model, name) for name in names]
+    row_end = model.valid_until if model is WashingMachine else model.timestamp
+    cursor = None
+
+    while True:
+        query = db.session.query(*entities).filter(model.machine_id == machine_id)
+        if descending:
+            if cursor or end:
+                query = query.filter(model.timestamp < (cursor or end))
+            if start:
+                query = query.filter(row_end >= start)
+            query = query.order_by(model.timestamp.desc())
+        else:
+            if cursor:
+                query = query.filter(model.timestamp > cursor)
+            elif start:
+                query = query.filter(row_end >= start)
+            if end:
+                query = query.filter(model.timestamp < end)
+            query = query.order_by(model.timestamp)
+
+        rows = query.limit(batch).all()
+        for row in rows:
+            yield dict(zip(names, row))
+        if len(rows) < batch:
+            return
+        cursor = rows[-1].timestamp
+
+def iter_readings(model, machine_id: str, start: datetime, end: datetime,
+                  batch: int = 1000, config: dict = None) -> Iterator[dict]:
+    """Yield the readings of a tier in [start, end), oldest first.
+
+    Runs of change-only storage are expanded into single readings. If the
+    app config is given, archived ranges of raw readings are read from the
+    archive instead of the database.
+    """
+    if model is not WashingMachine:
+        yield from iter_rows(model, machine_id, start, end, batch)
+        return
+
+    cursor = start
+    if config:
+        for segment in archive.segments(config, machine_id):
+            if segment.end <= start or (end and segment.start >= end):
+                continue
+            if cursor < segment.start:
+                yield from iter_database_readings(machine_id, cursor, segment.start, batch)
+            yield from archive.iter_readings(config, machine_id, max(cursor, segment.start),
+                                             min(end, segment.end) if end else segment.end)
+            cursor = segment.end
+    if not end or cursor < end:
+        yield from iter_database_readings(machine_id, cursor, end, batch)
+
+def oldest(machine_id: str, config: dict = None) -> datetime:
+    """Return the time raw readings of a machine are stored from, None if there are none.
+
+    If the app config is given, archived readings count as well.
+    """
+    found = archive.segments(config, machine_id) if config else []
+    stored = (db.session.query(func.min(WashingMachine.timestamp))
+              .filter(WashingMachine.machine_id == machine_id)
+              .scalar())
+    candidates = [time for time in (found[0].start if found else None, stored) if time]
+    return min(candidates) if candidates else None
+
+def iter_database_readings(machine_id: str, start: datetime, end: datetime,
+                           batch: int = 1000) -> Iterator[dict]:
+    """Yield the raw readings in [start, end) stored in the database, oldest first."""
+    total = None
+    for row in iter_rows(WashingMachine, machine_id, start, end, batch):
+        for reading in runs.expand(row, total):
+            if (not start or reading['timestamp'] >= start) and (not end or reading['timestamp'] < end):
+                yield reading
+        total = row['total_power']
+
+def latest(model, machine_id: str, amount: int, batch: int = 1000, dense: bool = True,
+           end: datetime = None) -> list:
+    """Return the newest `amount` rows of a tier before `end`, newest first.
+
+    With `dense`, runs of change-only storage are expanded and `amount`
+    counts single readings.
+    """
+    rows = iter_rows(model, machine_id, end=end, batch=max(1, min(batch, amount)), descending=True)
+    if model is WashingMachine and dense:
+        return runs.expand_newest(rows, amount, end)
+    return [row for _, row in zip(range(amount), rows)]
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Pooled LDAP authentication with a credential cache
+
+Binding against LDAP needs a TLS handshake and a round trip to the directory
+server. To keep this off most requests, bound connections are kept in a small
+pool and rebound for the next user, and the server schema is never fetched.
+Successful verifications are remembered for `LDAP_CACHE_TTL` seconds as
+salted, keyed hashes, so repeated requests of the same user don't reach the
+directory server at all. Plaintext passwords are never stored. ldap3 is only
+imported with the first connection.
+
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+from queue import LifoQueue, Empty, Full
+from typing import TYPE_CHECKING, Iterator
+import hashlib
+import hmac
+import secrets
+
+from .cache import LRUCache
+
+if TYPE_CHECKING:
+    from ldap3 import Connection, Server
+
+
+class CredentialCache:
+    """Bounded LRU cache of successfully verified credentials with a TTL."""
+
+    def __init__(self, size: int, ttl: float) -> None:
+        self._key = secrets.token_bytes(32) # Never leaves the process
+        self._entries = LRUCache(size, ttl)
+
+    def _hash(self, password: str, salt: bytes) -> bytes:
+        return hashlib.blake2b(password.encode('utf-8'), key=self._key, salt=salt).digest()
+
+    def add(self, username: str, password: str) -> None:
+        """Remember a successful verification of the credentials."""
+        salt = secrets.token_bytes(16)
+        self._entries.set(username, (salt, self._hash(password, salt)))
+
+    def check(self, username: str, password: str) -> bool:
+        """Check whether the credentials have been verified within the TTL."""
+        entry = self._entries.get(username)
+        if not entry:
+            return False
+        return hmac.compare_digest(entry[1], self._hash(password, entry[0]))
+
+    def invalidate(self, username: str) -> None:
+        """Forget the cached verification of a user."""
+        self._entries.pop(username)
+
+
+class ConnectionPool:
+    """Pool of TLS connections to the LDAP server, rebound for each user."""
+
+    def __init__(self, url: str, size: int) -> None:
+        self.url = url
+        self._server = None
+        self._idle = LifoQueue(maxsize=size)
+
+    @property
+    def server(self) -> Server:
+        """The LDAP server, created on first use."""
+        if self._server is None:
+            from ldap3 import Server, NONE
+            self._server = Server(self.url, use_ssl=True, get_info=NONE)
+        return self._server
+
+    @contextmanager
+    def bind(self, user: str, password: str) -> Iterator[Connection]:
+        """Bind a pooled connection as the given user.
+
+        A pooled connection the server has closed meanwhile is replaced by
+        a new one.
+
+        Yields:
+            The bound connection, None if the credentials were rejected.
+        """
+        from ldap3 import Connection
+        from ldap3.core.exceptions import LDAPException
+
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = None
+
+        bound = False
+        if conn:
+            try:
+                bound = conn.rebind(user, password, read_server_info=False)
+            except LDAPException:
+                # The server dropped the idle connection, retry on a new one
+                self._discard(conn)
+                conn = None
+        if conn is None:
+            try:
+                conn = Connection(self.server, user, password, read_only=True)
+                bound = conn.bind(read_server_info=False)
+            except LDAPException:
+                bound = False
+
+        if not bound:
+            self._discard(conn)
+            yield None
+            return
+
+        try:
+            yield conn
+        except:
+            self._discard(conn)
+            raise
+        else:
+            try:
+                self._idle.put_nowait(conn)
+            except Full:
+                self._discard(conn)
+
+    @staticmethod
+    def _discard(conn: Connection) -> None:
+        from ldap3.core.exceptions import LDAPException
+
+        if conn is None:
+            return
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+
+def init_app(flask_app) -> None:
+    """Create the connection pool and credential cache from the app config."""
+    flask_app.logger.debug('Setting up LDAP connection pool...')
+    global pool
+    global credentials
+    pool = ConnectionPool(flask_app.config['LDAP_URL'], flask_app.config['LDAP_POOL_SIZE'])
+    credentials = CredentialCache(flask_app.config['LDAP_CACHE_SIZE'], flask_app.config['LDAP_CACHE_TTL'])
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Leader election between the processes serving the app
+
+Every gunicorn worker creates its own app. Only one of them may poll the
+machines, run the Telegram bot and send notifications, the others just
+serve HTTP. The leader is the process holding an exclusive lock on
+`LEADER_LOCK_PATH`. Followers try to take the lock every
+`LEADER_RETRY_INTERVAL` seconds. The operating system releases the lock
+when the leader exits or dies, so a follower takes over within one retry
+interval.
+
+As the lock is a file lock, all processes have to run on the same host.
+
+"""
+
+from threading import Event, Thread
+from typing import Callable
+import atexit
+import fcntl
+import os
+
+
+class FileLock:
+    """Exclusive, non-blocking lock on a file, held until released or the process exits."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd = None
+
+    def acquire(self) -> bool:
+        """Try to take the lock without waiting.
+
+        Returns:
+            Whether the lock is held now.
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        # For debugging only, the lock doesn't depend on the content
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        """Give the lock up."""
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class Election:
+    """Background thread trying to become leader until it succeeds."""
+
+    def __init__(self, app, on_elected: Callable) -> None:
+        self.app = app
+        self.on_elected = on_elected
+        self.lock = FileLock(app.config['LEADER_LOCK_PATH'])
+        self.stopping = Event()
+        self.thread = Thread(target=self.run, name='leader-election', daemon=True)
+
+    def start(self) -> None:
+        """Try to become leader right away, keep trying in the background otherwise."""
+        if not self.try_elect():
+            self.app.logger.info("Process %d is a follower, only serving HTTP.", os.getpid())
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Stop trying and give up the leadership."""
+        self.stopping.set()
+        self.lock.release()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.app.config['LEADER_RETRY_INTERVAL']):
+            if self.try_elect():
+                return
+
+    def try_elect(self) -> bool:
+        """Take the lock if it's free and start the leader's tasks."""
+        if not self.lock.acquire():
+            return False
+        self.app.logger.info("Process %d was elected leader.", os.getpid())
+        try:
+            self.on_elected(self.app)
+        except Exception as e:
+            self.app.logger.exception("Error starting the tasks of the leader.")
+        return True
+
+
+def init_app(flask_app, on_elected: Callable) -> None:
+    """Take part in the election. `on_elected(app)` is called once this process becomes leader."""
+    global election
+    election = Election(flask_app, on_elected)
+    atexit.register(election.stop)
+    election.start()
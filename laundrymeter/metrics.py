@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""In-process metrics in the Prometheus text format
+
+Counters and histograms are plain Python objects updated under a lock, so
+recording a value costs a few hundred nanoseconds. Nothing is computed or
+written until the metrics are scraped.
+
+Each gunicorn worker has its own registry, but a scrape only reaches one of
+them. Therefore every process writes its raw values to `METRICS_PATH`
+every `METRICS_DUMP_INTERVAL` seconds, as long as the metrics have been
+scraped within `METRICS_IDLE_SECONDS`. A scrape sums its own values and the
+recent dumps of all other processes.
+
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread, Event
+from typing import Dict, Iterable, List, Tuple
+import atexit
+import glob
+import json
+import os
+import time
+
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+
+# Upper bounds in seconds, suitable from local function calls to network round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    """Base of a metric with a value per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = Lock()
+        self._values = {}
+        registry.register(self)
+
+    def dump(self) -> Dict[str, object]:
+        """Return the raw values, keyed by the JSON encoded label values."""
+        with self._lock:
+            return {json.dumps(key): self.copy(value) for key, value in self._values.items()}
+
+    def copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(a: float, b: float) -> float:
+        return a + b
+
+    def samples(self, labels: Tuple[str, ...], value: float) -> Iterable[Tuple[str, dict, float]]:
+        yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        """Observe the duration of the `with` block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def copy(self, value: list) -> list:
+        return [list(value[0]), value[1]]
+
+    @staticmethod
+    def merge(a: list, b: list) -> list:
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+    def samples(self, labels: Tuple[str, ...], value: list) -> Iterable[Tuple[str, dict, float]]:
+        base = dict(zip(self.labels, labels))
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value[0]):
+            cumulative += count
+            yield self.name + '_bucket', dict(base, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+        yield self.name + '_sum', base, value[1]
+        yield self.name + '_count', base, cumulative
+
+
+class Registry:
+    """All metrics of the process."""
+
+    def __init__(self) -> None:
+        self.metrics = []
+        self.path = None
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def dump(self) -> Dict[str, dict]:
+        """Return the raw values of all metrics."""
+        return {metric.name: metric.dump() for metric in self.metrics}
+
+    def write_dump(self) -> None:
+        """Write the raw values of this process for the other processes to read."""
+        filename = os.path.join(self.path, '{}.json'.format(os.getpid()))
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.dump(), f)
+        os.replace(filename + '.tmp', filename)
+
+    def collect(self) -> List[Dict[str, object]]:
+        """Return the values of this and (if shared) all other live processes, summed up."""
+        dumps = [self.dump()]
+        if self.path:
+            os.utime(os.path.join(self.path, 'scraped'), None) # Makes the other processes dump their values
+            for filename in glob.glob(os.path.join(self.path, '*.json')):
+                pid = int(os.path.basename(filename).split('.')[0])
+                if pid == os.getpid():
+                    continue
+                try:
+                    if not alive(pid):
+                        os.remove(filename)
+                        continue
+                    with open(filename) as f:
+                        dumps.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        merged = []
+        for metric in self.metrics:
+            values = {}
+            for dump in dumps:
+                for key, value in dump.get(metric.name, {}).items():
+                    values[key] = metric.merge(values[key], value) if key in values else value
+            merged.append(values)
+        return merged
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric, values in zip(self.metrics, self.collect()):
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for key in sorted(values):
+                for name, labels, value in metric.samples(tuple(json.loads(key)), values[key]):
+                    lines.append('{}{} {}'.format(name, format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+def alive(pid: int) -> bool:
+    """Check whether a process exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(labels, escaped)) + '}'
+
+def statement_type(statement: str) -> str:
+    """Return the type of an SQL statement (SELECT, INSERT, ...)."""
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+
+
+registry = Registry()
+
+plug_seconds = Histogram('laundrymeter_plug_request_seconds', 'Round trip time of smart plug queries.', ('machine',))
+plug_errors = Counter('laundrymeter_plug_errors_total', 'Failed smart plug queries.', ('machine', 'kind'))
+db_seconds = Histogram('laundrymeter_db_statement_seconds', 'Latency of database statements.', ('statement',))
+tick_seconds = Histogram('laundrymeter_poll_tick_seconds', 'Duration of a poll tick.')
+tick_overruns = Counter('laundrymeter_poll_tick_overruns_total', 'Poll ticks taking longer than POLL_INTERVAL.')
+notify_seconds = Histogram('laundrymeter_notification_send_seconds', 'Latency of sending a notification.', ('channel',))
+notify_errors = Counter('laundrymeter_notification_errors_total', 'Failed attempts to send a notification.', ('channel',))
+request_seconds = Histogram('laundrymeter_request_seconds', 'Latency of REST requests.', ('resource', 'method', 'status'))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    db_seconds.observe(time.perf_counter() - conn.info['metrics_start'].pop(), statement_type(statement))
+
+# The commit itself is timed after the final flush, whose statements are timed above
+@event.listens_for(Session, 'before_commit')
+@event.listens_for(Session, 'after_flush_postexec')
+def start_commit(session, *args):
+    session.info['metrics_commit'] = time.perf_counter()
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    start = session.info.pop('metrics_commit', None)
+    if start is not None:
+        db_seconds.observe(time.perf_counter() - start, 'COMMIT')
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get('metrics_start'):
+        context.connection.info['metrics_start'].pop()
+
+
+class Dumper:
+    """Background thread writing the values of this process while they are being scraped."""
+
+    def __init__(self, app) -> None:
+        self.interval = app.config['METRICS_DUMP_INTERVAL']
+        self.idle = app.config['METRICS_IDLE_SECONDS']
+        self.stopping = Event()
+        self.thread = Thread(target=self.run, name='metrics-dumper', daemon=True)
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            try:
+                scraped = os.stat(os.path.join(registry.path, 'scraped')).st_mtime
+                if time.time() - scraped < self.idle:
+                    registry.write_dump()
+            except OSError:
+                pass
+
+    def stop(self) -> None:
+        self.stopping.set()
+        try:
+            os.remove(os.path.join(registry.path, '{}.json'.format(os.getpid())))
+        except OSError:
+            pass
+
+
+def init_app(app) -> None:
+    """Share the metrics between the processes and time every request."""
+    os.makedirs(app.config['METRICS_PATH'], exist_ok=True)
+    open(os.path.join(app.config['METRICS_PATH'], 'scraped'), 'a').close()
+    registry.path = app.config['METRICS_PATH']
+
+    dumper = Dumper(app)
+    dumper.thread.start()
+    atexit.register(dumper.stop)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if 'request_start' in g:
+            request_seconds.observe(time.perf_counter() - g.request_start,
+                                    request.endpoint or 'unknown', request.method, str(response.status_code))
+        return response
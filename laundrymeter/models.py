@@ -14,8 +14,12 @@ from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from sqlalchemy import inspect
+from sqlalchemy.orm.exc import NoResultFound
+import os
 import secrets
 
+from .cache import LRUCache
+
 
 # Main SQLAlchemy instance
 db = SQLAlchemy()
@@ -23,6 +27,26 @@ db = SQLAlchemy()
 # Main Marshmallow instance
 ma = Marshmallow()
 
+# Verified auth tokens -> (username, name), configured in `init_app`
+token_cache = LRUCache(size=1024, ttl=300)
+
+# Authenticated Telegram chat ids -> (username, name), configured in `init_app`
+chat_cache = LRUCache(size=1024, ttl=300)
+
+
+def init_app(flask_app) -> None:
+    """Configure the token and chat caches from the app config.
+
+    Invalidations are shared with the other processes through files in
+    `STATE_PATH`.
+    """
+    token_cache.size = flask_app.config['TOKEN_CACHE_SIZE']
+    token_cache.ttl = flask_app.config['TOKEN_CACHE_TTL']
+    token_cache.share(os.path.join(flask_app.config['STATE_PATH'], 'token_cache.generation'))
+    chat_cache.size = flask_app.config['TELEGRAM_CHAT_CACHE_SIZE']
+    chat_cache.ttl = flask_app.config['TELEGRAM_CHAT_CACHE_TTL']
+    chat_cache.share(os.path.join(flask_app.config['STATE_PATH'], 'chat_cache.generation'))
+
 
 ##################
 ##### Models #####
@@ -51,22 +75,37 @@ class User(db.Model):
         """
 
         session = inspect(self).session
+        old_token = self.auth_token
         self.auth_token = secrets.token_urlsafe()
         session.commit()
+        if old_token:
+            token_cache.invalidate(old_token) # In all processes
         return self.auth_token
 
     @staticmethod
-    def verify_auth_token(token: str) -> User:
+    def verify_auth_token(token: str) -> CachedUser:
         """Verify auth token and return corresponding user object.
+
+        Verified tokens are cached for `TOKEN_CACHE_TTL` seconds, so repeated
+        verifications of the same token don't query the database. Rotating
+        the token with `generate_auth_token` evicts the old one in all
+        processes (through `STATE_PATH`).
         
         Returns:
             The object of the authenticated user, None otherwise.
         """
+        cached = token_cache.get(token)
+        if cached:
+            return CachedUser(*cached)
+
+        generation = token_cache.generation()
         try:
             user = User.query.filter_by(auth_token=token).one()
-        except:
-            user = None
-        return user
+        except NoResultFound:
+            return None
+
+        token_cache.set(token, (user.username, user.name), generation)
+        return CachedUser(user.username, user.name, user)
 
     def generate_telegram_token(self) -> str:
         """Generate a new telegram token and store it in the database.
@@ -100,14 +139,40 @@ class User(db.Model):
         try:
             user = User.query.filter_by(telegram_token=token).one()
             session = inspect(user).session
+            previous_chat_id = user.telegram_chat_id
             user.telegram_token = None
             user.telegram_chat_id = chat_id
             session.commit()
+            chat_cache.invalidate(previous_chat_id, chat_id) # The previous chat is logged out in all processes
         except:
             current_app.logger.exception('Failed to verify telegram token %s send by %d', token, chat_id)
             user = None
         return user
 
+    @staticmethod
+    def verify_telegram_chat(chat_id: int) -> CachedUser:
+        """Return the user authenticated in a Telegram chat.
+
+        Authenticated chats are cached for `TELEGRAM_CHAT_CACHE_TTL` seconds,
+        so bot commands don't query the database. `verify_telegram_token`
+        evicts the previous and the new chat of the user in all processes
+        (through `STATE_PATH`), `register_notification` in this process.
+
+        Returns:
+            The object of the authenticated user, None if the chat isn't authenticated.
+        """
+        cached = chat_cache.get(chat_id)
+        if cached:
+            return CachedUser(*cached)
+
+        generation = chat_cache.generation()
+        user = User.query.filter_by(telegram_chat_id=chat_id).first()
+        if not user:
+            return None
+
+        chat_cache.set(chat_id, (user.username, user.name), generation)
+        return CachedUser(user.username, user.name, user)
+
     def register_notification(self, **kwargs) -> None:
         """Register supplied notifications.
         
@@ -124,13 +189,43 @@ class User(db.Model):
             if 'telegram' in kwargs:
                 self.notify_telegram = kwargs['telegram']
             session.commit()
+            chat_cache.pop(self.telegram_chat_id)
         else:
             current_app.logger.debug('register_notification() called without arguments')
 
 
+class CachedUser:
+    """Detached snapshot of a user's identity.
+
+    Only `username` and `name` are kept in the snapshot. Any other attribute
+    or method is taken from the `User` row, which is loaded on first access
+    within the current request.
+    """
+
+    def __init__(self, username: str, name: str, user: User = None) -> None:
+        self.username = username
+        self.name = name
+        self._user = user
+
+    def __getattr__(self, attr):
+        # Only called for attributes not in the snapshot
+        if attr.startswith('__') or attr == '_user':
+            raise AttributeError(attr)
+        if self._user is None:
+            self._user = User.query.get(self.username)
+        return getattr(self._user, attr)
+
+
 class WashingMachine(db.Model):
-    """Model for storing current status of the Washing Machine in the DB."""
+    """Model for storing current status of the Washing Machine in the DB.
+    
+    Readings are keyed by the id of the machine they were taken from and
+    their timestamp, so several machines can share a single table. With
+    change-only storage, a row stands for `repeat_count` readings up to
+    `valid_until` (see `runs`).
+    """
     __tablename__ = 'washingmachine'
+    machine_id = db.Column(db.String(64), primary_key=True)
     timestamp = db.Column(db.DateTime, primary_key=True)
     running = db.Column(db.Boolean)
     last_changed = db.Column(db.DateTime)
@@ -138,6 +233,101 @@ class WashingMachine(db.Model):
     current = db.Column(db.Float)
     power = db.Column(db.Float)
     total_power = db.Column(db.Float)
+    valid_until = db.Column(db.DateTime, index=True)
+    repeat_count = db.Column(db.Integer, default=1)
+
+
+class Cycle(db.Model):
+    """Index of the wash cycles of the machines, maintained by the poller.
+
+    `end`, `duration` and `energy` are None while the cycle is running.
+    `duration` is in seconds, `energy` in kWh.
+    """
+    __tablename__ = 'cycles'
+    __table_args__ = (db.Index('ix_cycles_machine_start', 'machine_id', 'start'),)
+    id = db.Column(db.Integer, primary_key=True)
+    machine_id = db.Column(db.String(64))
+    start = db.Column(db.DateTime)
+    end = db.Column(db.DateTime)
+    duration = db.Column(db.Float)
+    peak_power = db.Column(db.Float)
+    energy = db.Column(db.Float)
+
+
+class CycleProfile(db.Model):
+    """Power trace of a finished wash cycle, for predicting the remaining time (see `profiles`).
+
+    `power` holds the mean power in Watts per `resolution` seconds since the
+    start of the cycle, as little endian float32.
+    """
+    __tablename__ = 'cycle_profiles'
+    machine_id = db.Column(db.String(64), primary_key=True)
+    start = db.Column(db.DateTime, primary_key=True)
+    duration = db.Column(db.Float)
+    resolution = db.Column(db.Integer)
+    power = db.Column(db.LargeBinary)
+
+
+class Notification(db.Model):
+    """Outbox of notifications waiting to be sent by the dispatcher.
+
+    Rows are deleted once sent. Failed rows are retried at `next_attempt`
+    until `NOTIFY_MAX_ATTEMPTS` attempts were made.
+    """
+    __tablename__ = 'notification'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(255), db.ForeignKey('user.username'), index=True)
+    channel = db.Column(db.String(16)) # 'email' or 'telegram'
+    text = db.Column(db.String(255))
+    created = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True)
+    user = db.relationship('User', lazy='joined')
+
+
+class RollupMixin:
+    """Columns shared by the aggregated (rolled up) tiers of readings.
+
+    Each row aggregates all readings of a machine within the bucket starting
+    at `timestamp`. `energy` is the sum of the `total_power` deltas in kWh.
+    """
+    machine_id = db.Column(db.String(64), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    samples = db.Column(db.Integer)
+    power_min = db.Column(db.Float)
+    power_max = db.Column(db.Float)
+    power_mean = db.Column(db.Float)
+    energy = db.Column(db.Float)
+    running_fraction = db.Column(db.Float)
+
+
+class WashingMachineMinute(RollupMixin, db.Model):
+    """Readings of the Washing Machine aggregated per minute."""
+    __tablename__ = 'washingmachine_minute'
+
+
+class WashingMachineHour(RollupMixin, db.Model):
+    """Readings of the Washing Machine aggregated per hour."""
+    __tablename__ = 'washingmachine_hour'
+
+
+class UsageHour(db.Model):
+    """Usage of a machine per hour, maintained incrementally by the poller.
+
+    `hour` counts the hours since the epoch (UTC), so hours can be grouped
+    by local day or hour of the week with plain arithmetic in SQL.
+    `seconds` is the time covered by readings, `running_seconds` the part of
+    it the machine was running, `energy` is in kWh. Finished cycles are
+    counted in the hour they started, `cycle_seconds` is their total duration.
+    """
+    __tablename__ = 'usage_hour'
+    machine_id = db.Column(db.String(64), primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    seconds = db.Column(db.Float, default=0)
+    running_seconds = db.Column(db.Float, default=0)
+    energy = db.Column(db.Float, default=0)
+    cycles = db.Column(db.Integer, default=0)
+    cycle_seconds = db.Column(db.Float, default=0)
 
 
 ###################
@@ -150,6 +340,25 @@ class WashingMachineSchema(ma.ModelSchema):
         model = WashingMachine
 
 
+class WashingMachineMinuteSchema(ma.ModelSchema):
+    """Schema for JSON (De-)Serialization of per minute rollups."""
+    class Meta:
+        model = WashingMachineMinute
+
+
+class WashingMachineHourSchema(ma.ModelSchema):
+    """Schema for JSON (De-)Serialization of per hour rollups."""
+    class Meta:
+        model = WashingMachineHour
+
+
+class CycleSchema(ma.ModelSchema):
+    """Schema for JSON (De-)Serialization of Cycles."""
+    class Meta:
+        model = Cycle
+        exclude = ('id',)
+
+
 class UserSchema(ma.ModelSchema):
     """Schema for JSON (De-)Serialization of User."""
     class Meta:
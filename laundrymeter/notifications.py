@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Notification outbox and dispatcher
+
+The poller doesn't send notifications itself. It only queues one row per
+subscribed user and channel in the `notification` table and wakes up the
+dispatcher, a background thread sending the queued notifications:
+
+* Telegram messages are sent concurrently by `NOTIFY_TELEGRAM_WORKERS`
+  threads, limited to `NOTIFY_TELEGRAM_RATE` messages per second overall.
+* Emails are sent through a single SMTP session per batch.
+
+Failed notifications are retried with exponential backoff, starting at
+`NOTIFY_BACKOFF` seconds, and dropped after `NOTIFY_MAX_ATTEMPTS`. A user's `notify_email`/`notify_telegram` flag is
+only reset once the notification was actually sent. As the outbox is stored
+in the database, notifications queued before a restart are sent afterwards.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+from typing import Dict, List, Tuple
+import smtplib
+import atexit
+import time
+
+from .models import Notification, User, db
+from . import telegram_bot as tb
+from . import metrics
+
+
+EMAIL = 'email'
+TELEGRAM = 'telegram'
+
+# Flags of the users subscribed to each channel
+CHANNELS = {
+    EMAIL: User.notify_email,
+    TELEGRAM: User.notify_telegram,
+}
+
+FOOTER = "\n\n\n---\nThis service is kindly provided by your friendly neighbourhood programmer."
+
+
+def enqueue(text: str, now: datetime, config: dict) -> int:
+    """Queue a notification for every subscribed user (needs an app context).
+
+    Users that still have a notification queued on a channel don't get a
+    second one, just like they were only notified once before.
+
+    Returns:
+        The number of queued notifications.
+    """
+    count = 0
+    for channel, flag in CHANNELS.items():
+        queued = (db.session.query(Notification.username)
+                  .filter(Notification.channel == channel,
+                          Notification.attempts < config['NOTIFY_MAX_ATTEMPTS']))
+        usernames = (db.session.query(User.username)
+                     .filter(flag == True, ~User.username.in_(queued))
+                     .all())
+        rows = [{'username': username,
+                 'channel': channel,
+                 'text': text,
+                 'created': now,
+                 'attempts': 0,
+                 'next_attempt': now} for username, in usernames]
+        if rows:
+            db.session.execute(Notification.__table__.insert(), rows)
+        count += len(rows)
+    db.session.commit()
+    return count
+
+
+class RateLimiter:
+    """Spaces out calls from several threads to at most `rate` per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self._lock = Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        """Block until the caller may go ahead."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
+
+
+class Dispatcher:
+    """Background thread sending the queued notifications.
+
+    Args:
+        app: The flask app.
+        bot: Telegram bot to send with, defaults to the bot of `telegram_bot`.
+        smtp: SMTP client class, defaults to `smtplib.SMTP`.
+    """
+
+    def __init__(self, app, bot=None, smtp=smtplib.SMTP) -> None:
+        self.app = app
+        self.config = app.config
+        self.bot = bot
+        self.smtp = smtp
+        self.wakeup = Event()
+        self.stopping = False
+        self.limiter = RateLimiter(app.config['NOTIFY_TELEGRAM_RATE'])
+        self.executor = ThreadPoolExecutor(max_workers=app.config['NOTIFY_TELEGRAM_WORKERS'])
+        self.thread = Thread(target=self.run, name='notification-dispatcher', daemon=True)
+
+    def start(self) -> None:
+        """Start the thread. Notifications left over from an earlier run are sent right away."""
+        self.wakeup.set()
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread after the current batch."""
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join(timeout=self.config['POLL_INTERVAL'])
+        self.executor.shutdown(wait=False)
+
+    def wake(self) -> None:
+        """Make the thread look for due notifications."""
+        self.wakeup.set()
+
+    def run(self) -> None:
+        """Send due notifications, then sleep until woken or the next retry is due."""
+        timeout = None
+        while True:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            with self.app.app_context():
+                try:
+                    timeout = self.dispatch(datetime.utcnow())
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("There was an error dispatching notifications.")
+                    timeout = self.config['NOTIFY_BACKOFF']
+
+    def dispatch(self, now: datetime) -> float:
+        """Send a batch of due notifications and record the results.
+
+        Returns:
+            Seconds until the next notification is due, None if there is none.
+        """
+        due = (Notification.query
+               .filter(Notification.next_attempt <= now,
+                       Notification.attempts < self.config['NOTIFY_MAX_ATTEMPTS'])
+               .order_by(Notification.id)
+               .limit(self.config['NOTIFY_BATCH_SIZE'])
+               .all())
+        if due:
+            self.app.logger.debug("Sending %d notifications...", len(due))
+
+            # Telegram messages are sent in the background while the emails go out
+            futures = {self.executor.submit(self.send_telegram, n.user.telegram_chat_id, n.text): n
+                       for n in due if n.channel == TELEGRAM}
+            failures = self.send_emails([n for n in due if n.channel == EMAIL])
+            wait(futures)
+            for future, notification in futures.items():
+                if future.exception():
+                    failures[notification.id] = (future.exception(), permanent(future.exception()))
+
+            for notification in due:
+                if notification.id in failures:
+                    self.retry(notification, *failures[notification.id], now)
+                else:
+                    setattr(notification.user, 'notify_' + notification.channel, False) # Only notify once
+                    db.session.delete(notification)
+            db.session.commit()
+            self.app.logger.debug("Sent %d of %d notifications.", len(due) - len(failures), len(due))
+            if len(due) == self.config['NOTIFY_BATCH_SIZE']:
+                return 0
+
+        next_attempt = (db.session.query(db.func.min(Notification.next_attempt))
+                        .filter(Notification.attempts < self.config['NOTIFY_MAX_ATTEMPTS'])
+                        .scalar())
+        if next_attempt is None:
+            return None
+        return max((next_attempt - datetime.utcnow()).total_seconds(), 0)
+
+    def retry(self, notification: Notification, error: Exception, give_up: bool, now: datetime) -> None:
+        """Schedule the next attempt of a failed notification with exponential backoff, or drop it."""
+        metrics.notify_errors.inc(notification.channel)
+        notification.attempts = self.config['NOTIFY_MAX_ATTEMPTS'] if give_up else notification.attempts + 1
+        if notification.attempts >= self.config['NOTIFY_MAX_ATTEMPTS']:
+            self.app.logger.error("Giving up notifying %s via %s: %s", notification.username, notification.channel, error)
+            db.session.delete(notification) # The user stays subscribed for the next one
+            return
+
+        from telegram.error import RetryAfter
+
+        delay = min(self.config['NOTIFY_BACKOFF'] * 2 ** (notification.attempts - 1), self.config['NOTIFY_BACKOFF_MAX'])
+        if isinstance(error, RetryAfter):
+            delay = max(delay, error.retry_after)
+        notification.next_attempt = now + timedelta(seconds=delay)
+        self.app.logger.warning("Notifying %s via %s failed (attempt %d), retrying in %ds: %s",
+                                notification.username, notification.channel, notification.attempts, delay, error)
+
+    def send_telegram(self, chat_id: int, text: str) -> None:
+        """Send a Telegram message within the rate limit (runs in a worker thread)."""
+        from telegram.error import BadRequest
+
+        if chat_id is None:
+            raise BadRequest("No telegram chat registered")
+        self.limiter.wait()
+        with metrics.notify_seconds.time(TELEGRAM):
+            (self.bot or tb.get_updater().bot).send_message(chat_id=chat_id, text=text)
+
+    def send_emails(self, notifications: List[Notification]) -> Dict[int, Tuple[Exception, bool]]:
+        """Send emails through a single SMTP session.
+
+        Returns:
+            (error, permanent) of the failed notifications by id.
+        """
+        if not notifications:
+            return {}
+
+        failures, sent = {}, set()
+        try:
+            with self.smtp(self.config['SMTP_HOST'], self.config['SMTP_PORT'],
+                              timeout=self.config['NOTIFY_TIMEOUT']) as server:
+                server.starttls() # Starts the connection
+                server.login(self.config['SMTP_EMAIL'], self.config['SMTP_PASSWORD'])
+                for notification in notifications:
+                    try:
+                        with metrics.notify_seconds.time(EMAIL):
+                            server.sendmail(self.config['SMTP_EMAIL'], notification.user.email, email_message(notification))
+                        sent.add(notification.id)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        self.app.logger.error("Recipient refused. Is the Email of user %s correct? %s",
+                                              notification.username, notification.user.email)
+                        failures[notification.id] = (e, True)
+                    except (smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                        failures[notification.id] = (e, False)
+        except smtplib.SMTPAuthenticationError as e:
+            self.app.logger.exception("SMTP credentials are wrong! %s", self.config['SMTP_EMAIL'])
+            failures.update({n.id: (e, False) for n in notifications if n.id not in sent})
+        except Exception as e:
+            # Connection failed or dropped: everything not sent yet is retried
+            self.app.logger.exception("There was an error sending notification emails!")
+            failures.update({n.id: (e, False) for n in notifications if n.id not in sent and n.id not in failures})
+        return failures
+
+
+def permanent(error: Exception) -> bool:
+    """Check whether a failed Telegram message is pointless to retry (chat gone, bot blocked)."""
+    from telegram.error import BadRequest, Unauthorized
+    return isinstance(error, (BadRequest, Unauthorized))
+
+def email_message(notification: Notification) -> str:
+    """Return the email for a notification, including the time it was queued (local time)."""
+    created = notification.created.replace(tzinfo=timezone.utc).astimezone()
+    return 'Subject: {}\n\n{}'.format(
+        notification.text,
+        "The time was: {:%Y-%m-%d %H:%M:%S}.".format(created) + FOOTER)
+
+
+def init_app(flask_app) -> None:
+    """Start the notification dispatcher."""
+    global dispatcher
+    dispatcher = Dispatcher(flask_app)
+    dispatcher.start()
+    atexit.register(dispatcher.stop)
+    flask_app.logger.debug("Started notification dispatcher.")
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Remaining time of running cycles, predicted from past cycle profiles
+
+When a cycle finishes, its power trace is stored downsampled to the mean
+power per `PROFILE_RESOLUTION` seconds in the `cycle_profiles` table. The
+heating and spinning phases of a program give it a distinct trace, so the
+trace of a running cycle so far is compared with the same span of all
+profiles of the machine. The remaining time is the median remaining time
+of the `PREDICT_NEIGHBORS` most similar profiles.
+
+The profiles of a machine are kept in memory as one zero-padded matrix (the
+machine is off after a cycle), so the distances to all profiles are
+computed in a single vectorized step. Cycles are aligned at their start by
+the detector, so the plain Euclidean distance is used. Next to the matrix,
+each profile is indexed by its piecewise aggregate approximation (the mean
+of every `PAA_WIDTH` samples). Its distance is a lower bound of the exact
+distance, so exact distances are only computed for the candidates in the
+order of their bound, until the bound exceeds the best distances found.
+A prediction is only made when a new sample of the running cycle is
+complete, in between the remaining time just counts down.
+
+"""
+
+from datetime import datetime
+from threading import Lock
+from typing import List
+
+import numpy as np
+
+from .models import Cycle, CycleProfile, WashingMachine, db
+from . import history
+
+
+# Samples per value of the approximation the profiles are indexed by
+PAA_WIDTH = 8
+
+# Exact distances are computed for this many candidates at once
+BLOCK = 64
+
+
+def paa(samples: np.ndarray) -> np.ndarray:
+    """Return the means of every `PAA_WIDTH` samples (of the last axis), incomplete ones dropped."""
+    segments = samples.shape[-1] // PAA_WIDTH
+    shape = samples.shape[:-1] + (segments, PAA_WIDTH)
+    return samples[..., :segments * PAA_WIDTH].reshape(shape).mean(axis=-1)
+
+
+class Trace:
+    """Power trace of a running cycle, downsampled while it is recorded.
+
+    Args:
+        start: Start of the cycle.
+        resolution: Seconds per sample.
+        max_samples: Later readings are ignored.
+    """
+
+    def __init__(self, start: datetime, resolution: float, max_samples: int) -> None:
+        self.start = start
+        self.resolution = resolution
+        self.max_samples = max_samples
+        self._sums = []
+        self._counts = []
+        self.predicted = None # (samples, duration) of the latest prediction
+
+    def sample(self, timestamp: datetime) -> int:
+        """Return the index of the sample a timestamp falls into."""
+        return int((timestamp - self.start).total_seconds() // self.resolution)
+
+    def add(self, timestamp: datetime, power: float) -> None:
+        """Add a reading taken during the cycle."""
+        i = self.sample(timestamp)
+        if i >= self.max_samples:
+            return
+        while len(self._sums) <= i:
+            self._sums.append(0.0)
+            self._counts.append(0)
+        self._sums[i] += power
+        self._counts[i] += 1
+
+    def samples(self, end: int = None) -> np.ndarray:
+        """Return the mean power of the first `end` samples (all if None).
+
+        Samples without a reading repeat the previous one.
+        """
+        end = len(self._sums) if end is None else min(end, len(self._sums))
+        samples = np.zeros(end, np.float32)
+        value = 0.0
+        for i in range(end):
+            if self._counts[i]:
+                value = self._sums[i] / self._counts[i]
+            samples[i] = value
+        return samples
+
+    def profile(self, duration: float) -> np.ndarray:
+        """Return the samples of the finished cycle up to its end (`duration` seconds after the start)."""
+        return self.samples(int(np.ceil(duration / self.resolution)))
+
+
+class Library:
+    """Index of the cycle profiles of a machine for nearest neighbour searches.
+
+    Args:
+        max_samples: Length of the profiles, longer ones are cut off.
+        size: Number of profiles kept, the oldest are dropped.
+    """
+
+    def __init__(self, max_samples: int, size: int) -> None:
+        self.max_samples = max_samples
+        self.size = size
+        self._lock = Lock()
+        self._profiles = np.zeros((0, max_samples), np.float32)
+        self._approximations = paa(self._profiles)
+        self._durations = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self._durations)
+
+    def extend(self, profiles: List[np.ndarray], durations: List[float]) -> None:
+        """Add the profiles of finished cycles, oldest first."""
+        if not profiles:
+            return
+        padded = np.zeros((len(profiles), self.max_samples), np.float32)
+        for row, profile in zip(padded, profiles):
+            profile = profile[:self.max_samples]
+            row[:len(profile)] = profile
+        with self._lock:
+            self._profiles = np.concatenate([self._profiles, padded])[-self.size:]
+            self._approximations = np.concatenate([self._approximations, paa(padded)])[-self.size:]
+            self._durations = np.concatenate([self._durations, durations])[-self.size:]
+
+    def _snapshot(self) -> tuple:
+        with self._lock:
+            return self._profiles, self._approximations, self._durations
+
+    def nearest(self, samples: np.ndarray, k: int) -> np.ndarray:
+        """Return the indices of the k profiles closest to the samples over their span, closest first."""
+        return self._nearest(*self._snapshot()[:2], samples, k)
+
+    def _nearest(self, profiles: np.ndarray, approximations: np.ndarray, samples: np.ndarray, k: int) -> np.ndarray:
+        n = min(len(samples), self.max_samples)
+        samples = samples[:n]
+        k = min(k, len(profiles))
+
+        # The PAA distance of the complete segments is a lower bound of the squared distance
+        segments = n // PAA_WIDTH
+        bounds = PAA_WIDTH * ((approximations[:, :segments] - paa(samples)) ** 2).sum(axis=1)
+        order = np.argsort(bounds, kind='stable')
+
+        best = np.empty(0, np.int64)
+        best_distances = np.empty(0)
+        for first in range(0, len(order), BLOCK):
+            if len(best) == k and bounds[order[first]] >= best_distances[-1]:
+                break # No remaining candidate can be closer
+            block = order[first:first + BLOCK]
+            distances = ((profiles[block, :n] - samples) ** 2).sum(axis=1)
+            best = np.concatenate([best, block])
+            best_distances = np.concatenate([best_distances, distances])
+            keep = np.argsort(best_distances, kind='stable')[:k]
+            best, best_distances = best[keep], best_distances[keep]
+        return best
+
+    def predict(self, samples: np.ndarray, k: int) -> float:
+        """Return the expected duration of a cycle, None without profiles.
+
+        Without any samples yet, the median duration of all profiles is returned.
+        """
+        profiles, approximations, durations = self._snapshot()
+        if not len(durations):
+            return None
+        if not len(samples):
+            return float(np.median(durations))
+        return float(np.median(durations[self._nearest(profiles, approximations, samples, k)]))
+
+
+def library(machine_id: str, config: dict) -> Library:
+    """Return the library of a machine, loading it from the database on first use (needs an app context)."""
+    found = libraries.get(machine_id)
+    if found is None:
+        found = Library(max_samples(config), config['PROFILE_LIBRARY_SIZE'])
+        rows = (db.session.query(CycleProfile.duration, CycleProfile.power)
+                .filter(CycleProfile.machine_id == machine_id,
+                        CycleProfile.resolution == config['PROFILE_RESOLUTION'])
+                .order_by(CycleProfile.start.desc())
+                .limit(config['PROFILE_LIBRARY_SIZE'])
+                .all())
+        rows.reverse()
+        found.extend([np.frombuffer(power, '<f4') for _, power in rows], [duration for duration, _ in rows])
+        found = libraries.setdefault(machine_id, found)
+    return found
+
+def max_samples(config: dict) -> int:
+    """Return the number of samples of a profile."""
+    return int(config['PROFILE_MAX_SECONDS'] // config['PROFILE_RESOLUTION'])
+
+def begin(cycle: dict, config: dict) -> Trace:
+    """Start recording the trace of a cycle that just started."""
+    return Trace(cycle['start'], config['PROFILE_RESOLUTION'], max_samples(config))
+
+def store(trace: Trace, cycle: dict, config: dict) -> np.ndarray:
+    """Write the profile of a finished cycle to the `cycle_profiles` table (without committing).
+
+    Returns:
+        The profile.
+    """
+    profile = trace.profile(cycle['duration'])
+    db.session.merge(CycleProfile(machine_id=cycle['machine_id'],
+                                  start=cycle['start'],
+                                  duration=cycle['duration'],
+                                  resolution=config['PROFILE_RESOLUTION'],
+                                  power=profile.astype('<f4').tobytes()))
+    return profile
+
+def record(trace: Trace, cycle: dict, config: dict) -> None:
+    """Store the profile of a finished cycle and add it to the library of its machine."""
+    profile = store(trace, cycle, config)
+    library(cycle['machine_id'], config).extend([profile], [cycle['duration']])
+
+def remaining(machine_id: str, trace: Trace, now: datetime, config: dict) -> float:
+    """Return the predicted seconds until a running cycle ends, None if unknown.
+
+    The prediction is only renewed when another sample of the trace is
+    complete.
+    """
+    complete = trace.sample(now)
+    if trace.predicted is None or trace.predicted[0] != complete:
+        duration = library(machine_id, config).predict(trace.samples(complete), config['PREDICT_NEIGHBORS'])
+        trace.predicted = (complete, duration)
+    duration = trace.predicted[1]
+    if duration is None:
+        return None
+    return max(duration - (now - trace.start).total_seconds(), 0)
+
+def backfill(config: dict, machine_id: str, start: datetime, end: datetime) -> int:
+    """Rebuild the profiles of the cycles finished in [start, end) from the stored readings (without committing).
+
+    The cycles are taken from the `cycles` table (see `cycles.backfill`).
+    Cycles whose raw readings have expired (and weren't archived) are
+    skipped. The library of the machine is reloaded on its next use.
+
+    Returns:
+        The number of profiles written.
+    """
+    rows = (Cycle.query
+            .filter(Cycle.machine_id == machine_id, Cycle.start >= start, Cycle.start < end,
+                    Cycle.end.isnot(None))
+            .order_by(Cycle.start)
+            .all())
+    count = 0
+    for row in rows:
+        cycle = {'machine_id': machine_id, 'start': row.start, 'end': row.end, 'duration': row.duration}
+        trace = begin(cycle, config)
+        for reading in history.iter_readings(WashingMachine, machine_id, cycle['start'], cycle['end'],
+                                             config['HISTORY_BATCH_SIZE'], config):
+            trace.add(reading['timestamp'], reading['power'])
+        if not len(trace.samples()):
+            continue
+        store(trace, cycle, config)
+        count += 1
+    libraries.pop(machine_id, None)
+    return count
+
+
+libraries = {} # Library by machine id
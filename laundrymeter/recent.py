@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Ring buffer of the newest readings of every machine
+
+The poller appends every reading to a fixed-size buffer per machine, so
+short history requests (the last few minutes) are answered from memory. The
+readings are stored column by column in typed arrays, about 50 bytes per
+reading, holding the newest `RECENT_READINGS` readings.
+
+Requests reaching further back than the buffer read only the remainder
+from the database. Only the polling process (see `leader`) fills the
+buffers. It keeps them in fixed-size files in `STATE_PATH`, which the other
+processes map read-only. A sequence number in the header of the file tells
+them to read again if the poller appended in the meantime.
+
+Layout of a buffer file (native byte order)::
+
+    sequence, next slot, size, capacity         int64 each
+    timestamp[capacity]  last_changed[capacity] int64, microseconds since the epoch
+    voltage[capacity]  current[capacity]  power[capacity]  total_power[capacity]  float64
+    running[capacity]                           int8
+
+"""
+
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Callable, Iterator, List, Tuple
+import mmap
+import os
+import struct
+import time
+
+from .models import WashingMachine
+from .detectors import EPOCH
+from . import history
+
+
+# Columns in the order they are laid out in a buffer file
+COLUMNS = (('timestamp', 'q'), ('last_changed', 'q'), ('voltage', 'd'), ('current', 'd'),
+           ('power', 'd'), ('total_power', 'd'), ('running', 'b'))
+
+HEADER = 4 # Fields of the header (sequence, next slot, size, capacity)
+
+WRITE_TIMEOUT = 0.1 # Seconds an append may take at most
+
+
+def microseconds(timestamp: datetime) -> int:
+    """Convert a naive UTC timestamp to microseconds since the epoch."""
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+def timestamp(microseconds: int) -> datetime:
+    """Convert microseconds since the epoch to a naive UTC timestamp."""
+    return EPOCH + timedelta(microseconds=microseconds)
+
+def file_size(capacity: int) -> int:
+    """Return the size in bytes of a buffer holding `capacity` readings."""
+    return 8 * HEADER + capacity * sum(struct.calcsize(code) for _, code in COLUMNS)
+
+
+class RingBuffer:
+    """Fixed-size store of the newest readings of a machine, oldest are overwritten.
+
+    Creates a new, empty buffer to append to. Use `attach` to read the buffer
+    of another process.
+
+    Args:
+        machine_id: The machine the readings are taken from.
+        capacity: Number of readings kept.
+        path: File to share the buffer in (replaced), None to keep it in
+              this process only.
+    """
+
+    def __init__(self, machine_id: str, capacity: int, path: str = None) -> None:
+        self.machine_id = machine_id
+        self.capacity = capacity
+        self.path = path
+        self.writable = True
+        self._lock = Lock()
+        if path:
+            with open(path + '.tmp', 'w+b') as f:
+                f.truncate(file_size(capacity))
+                self._map = mmap.mmap(f.fileno(), file_size(capacity))
+            self._setup()
+            self._header[3] = capacity
+            os.replace(path + '.tmp', path) # Readers never see a partial header
+            self.inode = os.stat(path).st_ino
+        else:
+            self._map = mmap.mmap(-1, file_size(capacity))
+            self._setup()
+            self._header[3] = capacity
+
+    @classmethod
+    def attach(cls, machine_id: str, path: str) -> 'RingBuffer':
+        """Map the buffer another process shares in `path` read-only.
+
+        Returns:
+            The buffer, None if there is no valid buffer file.
+        """
+        try:
+            with open(path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                shared = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): # ValueError: empty file
+            return None
+        capacity = memoryview(shared)[:8 * HEADER].cast('q')[3] if len(shared) >= 8 * HEADER else 0
+        if not capacity or len(shared) != file_size(capacity):
+            return None
+
+        buffer = cls.__new__(cls)
+        buffer.machine_id = machine_id
+        buffer.capacity = capacity
+        buffer.path = path
+        buffer.writable = False
+        buffer.inode = inode
+        buffer._map = shared
+        buffer._setup()
+        return buffer
+
+    def _setup(self) -> None:
+        """Create the typed views of the header and the columns on the mapped memory."""
+        view = memoryview(self._map)
+        self._header = view[:8 * HEADER].cast('q')
+        offset = 8 * HEADER
+        for name, code in COLUMNS:
+            size = struct.calcsize(code) * self.capacity
+            setattr(self, '_' + name, view[offset:offset + size].cast(code))
+            offset += size
+
+    def __len__(self) -> int:
+        return self._header[2]
+
+    def current(self) -> bool:
+        """Check whether an attached buffer is still the one shared in its file."""
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except OSError:
+            return False
+
+    def append(self, reading: dict) -> None:
+        """Add a reading, newer than all readings in the buffer."""
+        with self._lock:
+            header = self._header
+            header[0] += 1 # Odd while writing
+            i = header[1]
+            self._timestamp[i] = microseconds(reading['timestamp'])
+            self._last_changed[i] = microseconds(reading['last_changed'] or reading['timestamp'])
+            self._running[i] = bool(reading['running'])
+            self._voltage[i] = reading['voltage']
+            self._current[i] = reading['current']
+            self._power[i] = reading['power']
+            self._total_power[i] = reading['total_power']
+            header[1] = (i + 1) % self.capacity
+            header[2] = min(header[2] + 1, self.capacity)
+            header[0] += 1
+
+    def newest(self, amount: int) -> List[dict]:
+        """Return up to `amount` of the newest readings, newest first."""
+        def read():
+            size = self._header[2]
+            return [self._reading(self._slot(k)) for k in range(size - 1, max(size - amount, 0) - 1, -1)]
+        return self._consistent(read, [])
+
+    def between(self, start: datetime, end: datetime = None) -> Tuple[List[dict], bool]:
+        """Return the readings in [start, end), oldest first.
+
+        Returns:
+            The readings and whether the buffer reaches back to `start`, i.e.
+            there are no older readings in the range.
+        """
+        def read():
+            size = self._header[2]
+            value = microseconds(start)
+            first = self._search(value)
+            last = self._search(microseconds(end)) if end else size
+            complete = size > 0 and self._timestamp[self._slot(0)] <= value
+            return [self._reading(self._slot(k)) for k in range(first, last)], complete
+        return self._consistent(read, ([], False))
+
+    def _consistent(self, read: Callable, default):
+        """Call `read` until no reading was appended while it ran (sequence lock).
+
+        Returns:
+            The result of `read`, `default` if the buffer stays locked (the
+            poller died while appending).
+        """
+        deadline = time.monotonic() + WRITE_TIMEOUT
+        while time.monotonic() < deadline:
+            sequence = self._header[0]
+            if sequence % 2 == 0:
+                try:
+                    result = read()
+                except (OverflowError, ValueError):
+                    if self._header[0] == sequence:
+                        raise
+                    continue # Read a half written reading
+                if self._header[0] == sequence:
+                    return result
+            time.sleep(0)
+        return default
+
+    def _slot(self, k: int) -> int:
+        """Return the slot of the k-th oldest reading."""
+        return (self._header[1] - self._header[2] + k) % self.capacity
+
+    def _search(self, value: int) -> int:
+        """Return the position of the oldest reading at or after `value` (binary search)."""
+        lo, hi = 0, self._header[2]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp[self._slot(mid)] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _reading(self, i: int) -> dict:
+        """Return the reading in a slot as a row of the `washingmachine` table."""
+        time = timestamp(self._timestamp[i])
+        return {'machine_id': self.machine_id,
+                'timestamp': time,
+                'running': bool(self._running[i]),
+                'last_changed': timestamp(self._last_changed[i]),
+                'voltage': self._voltage[i],
+                'current': self._current[i],
+                'power': self._power[i],
+                'total_power': self._total_power[i],
+                'valid_until': time,
+                'repeat_count': 1}
+
+
+def filename(machine_id: str) -> str:
+    """Return the file the buffer of a machine is shared in."""
+    return os.path.join(path, machine_id + '.recent')
+
+def get(machine_id: str) -> RingBuffer:
+    """Return the buffer of a machine, the one of the polling process if it's another one.
+
+    Returns:
+        The buffer, None if no process polls the machine yet.
+    """
+    buffer = buffers.get(machine_id)
+    if buffer and (buffer.writable or not path or buffer.current()):
+        return buffer
+    if not path:
+        return None
+    buffer = RingBuffer.attach(machine_id, filename(machine_id)) # The poller created a new one
+    if buffer:
+        buffers[machine_id] = buffer
+    return buffer
+
+def append(reading: dict) -> None:
+    """Add a reading to the buffer of its machine, replacing the one of an earlier poller."""
+    machine_id = reading['machine_id']
+    buffer = buffers.get(machine_id)
+    if buffer is None or not buffer.writable:
+        buffer = buffers[machine_id] = RingBuffer(machine_id, capacity, filename(machine_id) if path else None)
+    buffer.append(reading)
+
+def latest(machine_id: str, amount: int, batch: int = 1000) -> List[dict]:
+    """Return the newest `amount` readings of a machine, newest first.
+
+    Readings older than the buffer are read from the database (needs an app
+    context), runs of change-only storage expanded.
+    """
+    buffer = get(machine_id)
+    readings = buffer.newest(amount) if buffer else []
+    if len(readings) < amount:
+        end = readings[-1]['timestamp'] if readings else None
+        readings += history.latest(WashingMachine, machine_id, amount - len(readings), batch, end=end)
+    return readings
+
+def iter_readings(machine_id: str, start: datetime, end: datetime = None,
+                  batch: int = 1000, config: dict = None) -> Iterator[dict]:
+    """Yield the readings of a machine in [start, end), oldest first.
+
+    Like `history.iter_readings`, but readings within the buffer are taken
+    from memory.
+    """
+    buffer = get(machine_id)
+    recent, complete = buffer.between(start, end) if buffer else ([], False)
+    if not complete:
+        # Only the remainder before the buffer is read from the database
+        remainder_end = recent[0]['timestamp'] if recent else end
+        yield from history.iter_readings(WashingMachine, machine_id, start, remainder_end, batch, config)
+    yield from recent
+
+
+def init_app(app) -> None:
+    """Set the number of readings kept per machine and share the buffers through `STATE_PATH`."""
+    global capacity, path
+    capacity = app.config['RECENT_READINGS']
+    path = app.config['STATE_PATH']
+    os.makedirs(path, exist_ok=True)
+
+
+buffers = {} # RingBuffer by machine id
+capacity = 4096
+path = None
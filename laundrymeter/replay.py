@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Offline replay of stored readings through running detectors
+
+Used to tune detectors and their thresholds against real data. The stored
+readings of a machine are loaded into NumPy arrays once and replayed through
+one or more detectors. The result is compared to reference cycles found
+offline with knowledge of the whole trace: a cycle spans from the first to
+the last reading above `RUNNING_THRESHOLD_POWER`, with pauses of at most
+`REPLAY_MAX_GAP` seconds.
+
+For every detector the replay reports
+
+* `false_stops`: Stops detected while the reference cycle still continued.
+* `stop_latency`: Seconds from the end of a reference cycle to the detected stop.
+* `missed_stops`: Reference cycles whose end was never detected.
+* `start_latency`: Seconds from the start of a reference cycle to the detected start.
+
+"""
+
+from datetime import datetime
+from typing import Dict, List, Tuple
+import json
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .models import WashingMachine
+from . import archive
+from . import detectors
+from . import history
+
+
+def load(config: dict, machine_id: str, start: datetime, end: datetime) -> Tuple[np.ndarray, np.ndarray]:
+    """Load the raw readings of a machine in [start, end) as arrays.
+
+    Archived ranges are read from the archive, the remainder from the
+    database. Runs of change-only storage are expanded.
+
+    Returns:
+        The times in seconds since the epoch and the power in Watts.
+    """
+    times, powers = [], []
+    cursor = start
+    for segment in archive.segments(config, machine_id):
+        if segment.end <= start or segment.start >= end:
+            continue
+        if cursor < segment.start:
+            append_database(times, powers, machine_id, cursor, segment.start, config['HISTORY_BATCH_SIZE'])
+        columns = archive.load(config, machine_id, max(cursor, segment.start), min(end, segment.end))
+        times.append(columns['timestamp'].astype('M8[us]').astype(np.int64) / 1e6)
+        powers.append(columns['power'].astype(float))
+        cursor = segment.end
+    if cursor < end:
+        append_database(times, powers, machine_id, cursor, end, config['HISTORY_BATCH_SIZE'])
+
+    if not times:
+        return np.empty(0), np.empty(0)
+    return np.concatenate(times), np.concatenate(powers)
+
+def append_database(times: List[np.ndarray], powers: List[np.ndarray], machine_id: str,
+                    start: datetime, end: datetime, batch: int) -> None:
+    """Append the readings in [start, end) stored in the database to the lists of arrays."""
+    first, last, count, power = [], [], [], []
+    for row in history.iter_rows(WashingMachine, machine_id, start, end, batch):
+        first.append(detectors.seconds(row['timestamp']))
+        last.append(detectors.seconds(row['valid_until'] or row['timestamp']))
+        count.append(row['repeat_count'] or 1)
+        power.append(row['power'])
+    if not first:
+        return
+
+    # Expand runs of change-only storage into evenly spaced readings
+    first, last, count, power = np.array(first), np.array(last), np.array(count), np.array(power)
+    rows = np.repeat(np.arange(len(count)), count)
+    k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    step = np.where(count > 1, (last - first) / np.maximum(count - 1, 1), 0.0)
+    t = first[rows] + step[rows] * k
+
+    inside = (t >= detectors.seconds(start)) & (t < detectors.seconds(end))
+    times.append(t[inside])
+    powers.append(power[rows][inside])
+
+def reference_cycles(t: np.ndarray, power: np.ndarray, threshold: float, max_gap: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the cycles of a trace offline.
+
+    Returns:
+        Arrays of the start and end times of the cycles.
+    """
+    above = t[power > threshold]
+    if not len(above):
+        return np.empty(0), np.empty(0)
+    breaks = np.flatnonzero(np.diff(above) > max_gap)
+    starts = above[np.concatenate(([0], breaks + 1))]
+    ends = above[np.concatenate((breaks, [len(above) - 1]))]
+    return starts, ends
+
+def evaluate(running: np.ndarray, t: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> Dict[str, float]:
+    """Compare the running state of a detector with the reference cycles."""
+    previous = np.concatenate(([False], running[:-1]))
+    on = t[running & ~previous]
+    off = t[~running & previous]
+    results = {'cycles': int(len(starts)), 'false_stops': 0, 'false_stop_rate': 0.0, 'missed_stops': 0,
+               'stop_latency_mean': None, 'stop_latency_median': None, 'stop_latency_max': None,
+               'start_latency_mean': None}
+    if not len(starts):
+        return results
+
+    # Stops within a cycle, i.e. before its last reading above threshold
+    cycle = np.searchsorted(starts, off, side='right') - 1
+    false_stops = int(np.sum((cycle >= 0) & (off < ends[np.maximum(cycle, 0)])))
+
+    # First stop after the end of each cycle, before the next one starts
+    index = np.searchsorted(off, ends, side='left')
+    stop_at = np.full(len(ends), np.inf)
+    stop_at[index < len(off)] = off[index[index < len(off)]]
+    detected = stop_at < np.concatenate((starts[1:], [np.inf]))
+    stop_latency = (stop_at - ends)[detected]
+
+    # First start within each cycle
+    index = np.searchsorted(on, starts, side='left')
+    start_at = np.full(len(starts), np.inf)
+    start_at[index < len(on)] = on[index[index < len(on)]]
+    start_latency = (start_at - starts)[start_at <= ends]
+
+    results.update(false_stops=false_stops,
+                   false_stop_rate=false_stops / len(starts),
+                   missed_stops=int(len(ends) - detected.sum()))
+    if len(stop_latency):
+        results.update(stop_latency_mean=float(stop_latency.mean()),
+                       stop_latency_median=float(np.median(stop_latency)),
+                       stop_latency_max=float(stop_latency.max()))
+    if len(start_latency):
+        results.update(start_latency_mean=float(start_latency.mean()))
+    return results
+
+def run(config: dict, t: np.ndarray, power: np.ndarray, names: List[str]) -> Dict[str, dict]:
+    """Replay a trace through the named detectors and evaluate them."""
+    starts, ends = reference_cycles(t, power, config['RUNNING_THRESHOLD_POWER'], config['REPLAY_MAX_GAP'])
+    results = {}
+    for name in names:
+        detector = detectors.create(config, name)
+        began = time.perf_counter()
+        running = detector.replay(t, power)
+        elapsed = time.perf_counter() - began
+        results[name] = dict(evaluate(running, t, starts, ends),
+                             readings=int(len(t)),
+                             replay_seconds=elapsed)
+    return results
+
+
+def init_app(app) -> None:
+    """Register the 'replay-detector' command."""
+    app.cli.add_command(replay_detector_command)
+
+def parse_setting(value: str):
+    """Parse the value of a `--set KEY=VALUE` option as JSON, falling back to a string."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+@click.command('replay-detector')
+@click.argument('machine_id')
+@click.option('--from', 'start', type=click.DateTime(), default='1970-01-01', help='Start of the replayed range (UTC).')
+@click.option('--to', 'end', type=click.DateTime(), default=None, help='End of the replayed range (UTC), defaults to now.')
+@click.option('--detector', 'names', multiple=True, help='Detector to replay. Can be given multiple times, defaults to all.')
+@click.option('--set', 'settings', multiple=True, metavar='KEY=VALUE', help='Override a config value, e.g. --set RUNNING_THRESHOLD_SECONDS=240.')
+@with_appcontext
+def replay_detector_command(machine_id, start, end, names, settings):
+    """Replay the readings of MACHINE_ID through detectors and print the results as JSON."""
+    config = dict(current_app.config)
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        config[key] = parse_setting(value)
+
+    began = time.perf_counter()
+    t, power = load(config, machine_id, start, end or datetime.utcnow())
+    loaded = time.perf_counter() - began
+
+    try:
+        results = run(config, t, power, list(names) or list(detectors.DETECTORS))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps({'machine_id': machine_id, 'load_seconds': loaded, 'detectors': results}, indent=2))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Startup roles of a process
+
+`create_app` only sets up the subsystems of the roles of the process:
+
+* `api`: Serves the REST API (LDAP pool, request metrics).
+* `poller`: Polls the machines and sends the notifications.
+* `bot`: Receives the commands of the Telegram bot.
+* `cli`: Registers the `flask` commands.
+
+The `poller` and `bot` roles run in the leader only (see `leader`). Their
+libraries (pyHS100, APScheduler, python-telegram-bot) are only imported
+when they are started, ldap3 with the first login, so processes without
+them start faster and don't start any of their threads.
+
+The roles are taken from the `roles` argument of `create_app`, the
+`LAUNDRYMETER_ROLES` environment variable (comma separated) or `ROLES` in
+the config, in this order. Apps loaded by the `flask` command default to
+`cli`, so e.g. `flask init-db` doesn't start to poll. `flask run` serves
+with the `ROLES` of the config like a server. `flask worker` runs the
+background roles in the foreground, next to HTTP-only workers.
+
+"""
+
+from typing import Iterable, Tuple
+import os
+import threading
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+API = 'api'
+POLLER = 'poller'
+BOT = 'bot'
+CLI = 'cli'
+
+ROLES = (API, POLLER, BOT, CLI)
+
+# Roles run in the leader process only
+BACKGROUND = (POLLER, BOT)
+
+ENVIRONMENT = 'LAUNDRYMETER_ROLES'
+
+
+def parse(roles) -> Tuple[str, ...]:
+    """Return the roles given as an iterable or a comma separated string.
+
+    Raises:
+        ValueError: If a role is unknown.
+    """
+    if isinstance(roles, str):
+        roles = roles.split(',')
+    roles = tuple(role.strip() for role in roles if role.strip())
+    unknown = set(roles) - set(ROLES)
+    if unknown:
+        raise ValueError('Unknown roles {} (known: {})'.format(', '.join(sorted(unknown)), ', '.join(ROLES)))
+    return roles
+
+def resolve(config: dict, roles: Iterable[str] = None, cli: bool = False) -> Tuple[str, ...]:
+    """Return the roles of the process (see the module docstring).
+
+    Args:
+        config: The app config.
+        roles: The roles passed to `create_app`, if any.
+        cli: Whether the app is loaded by the `flask` command.
+    """
+    if roles is not None:
+        return parse(roles)
+    if os.environ.get(ENVIRONMENT):
+        return parse(os.environ[ENVIRONMENT])
+    if cli and not serving():
+        return (CLI,)
+    return parse(config['ROLES'])
+
+def serving() -> bool:
+    """Check whether the `flask` command loads the app for `flask run`.
+
+    `run` loads the app within its command, or with the reloader in a
+    background thread without a click context. The other commands load it
+    within their own or the group's context.
+    """
+    ctx = click.get_current_context(silent=True)
+    return ctx is None or ctx.info_name == 'run'
+
+
+@click.command('worker')
+@click.argument('roles', nargs=-1)
+@with_appcontext
+def worker_command(roles):
+    """Run the background ROLES (default: poller bot) until interrupted."""
+    from . import start_background
+    from . import metrics
+
+    try:
+        roles = parse(roles or BACKGROUND)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if set(roles) - set(BACKGROUND):
+        raise click.BadParameter('Only {} run in the background.'.format(' and '.join(BACKGROUND)))
+    app = current_app._get_current_object()
+    metrics.init_app(app)
+    start_background(app, roles)
+    click.echo('Running {} (process {}), press Ctrl+C to stop.'.format(', '.join(roles), os.getpid()))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+def init_app(app) -> None:
+    """Register the 'worker' command."""
+    app.cli.add_command(worker_command)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Tiered storage of readings
+
+Raw readings are only kept for a short window (`RAW_RETENTION_DAYS`). Older
+readings are folded into per minute rollups, which in turn are folded into
+per hour rollups. Each tier is expired with a single range delete, but only
+after it has been folded into the next coarser tier. With `ARCHIVE_READINGS`,
+raw readings are moved to the columnar archive (see `archive`) by the day
+before they are expired.
+
+"""
+
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Iterable, Tuple
+
+from sqlalchemy import desc, func
+
+from .models import WashingMachine, WashingMachineMinute, WashingMachineHour, db
+from . import runs
+from . import archive
+
+
+MINUTE = timedelta(minutes=1)
+HOUR = timedelta(hours=1)
+
+
+def floor_time(timestamp: datetime, resolution: timedelta) -> datetime:
+    """Round a timestamp down to a multiple of the resolution."""
+    seconds = int(resolution.total_seconds())
+    epoch = datetime(1970, 1, 1)
+    offset = int((timestamp - epoch).total_seconds()) // seconds * seconds
+    return epoch + timedelta(seconds=offset)
+
+def watermark(model, machine_id: str, resolution: timedelta) -> datetime:
+    """Return the end of the newest bucket of a rollup tier, None if it is empty."""
+    newest = (db.session.query(func.max(model.timestamp))
+              .filter(model.machine_id == machine_id)
+              .scalar())
+    return newest + resolution if newest else None
+
+def fold(rows: Iterable[Tuple], model, machine_id: str, resolution: timedelta) -> int:
+    """Aggregate rows into buckets of the given resolution and add them to the session.
+
+    Args:
+        rows: Tuples of (timestamp, samples, power_min, power_max, power_mean,
+              energy, running_fraction) ordered by timestamp.
+        model: The rollup model to create.
+        machine_id: The machine the rows belong to.
+        resolution: The size of the buckets.
+
+    Returns:
+        The number of buckets added.
+    """
+    added = 0
+    for bucket, group in groupby(rows, key=lambda row: floor_time(row[0], resolution)):
+        group = list(group)
+        samples = sum(row[1] for row in group)
+        db.session.add(model(
+            machine_id=machine_id,
+            timestamp=bucket,
+            samples=samples,
+            power_min=min(row[2] for row in group),
+            power_max=max(row[3] for row in group),
+            power_mean=sum(row[4] * row[1] for row in group) / samples,
+            energy=sum(row[5] for row in group),
+            running_fraction=sum(row[6] * row[1] for row in group) / samples))
+        added += 1
+    return added
+
+def raw_rows(machine_id: str, start: datetime, end: datetime) -> Iterable[Tuple]:
+    """Yield raw readings in [start, end) in the row format expected by `fold`.
+
+    Runs of change-only storage are expanded into single readings. The
+    energy of a reading is the `total_power` delta to the previous reading.
+    Negative deltas (the plug reset its counter) count as zero.
+    """
+    total = None
+    if start:
+        total = (db.session.query(WashingMachine.total_power)
+                 .filter(WashingMachine.machine_id == machine_id,
+                         WashingMachine.valid_until < start)
+                 .order_by(desc(WashingMachine.timestamp))
+                 .limit(1)
+                 .scalar())
+
+    query = (db.session.query(*[getattr(WashingMachine, column) for column in runs.COLUMNS])
+             .filter(WashingMachine.machine_id == machine_id,
+                     WashingMachine.timestamp < end)
+             .order_by(WashingMachine.timestamp))
+    if start:
+        query = query.filter(WashingMachine.valid_until >= start)
+
+    for row in query.yield_per(1000):
+        row = dict(zip(runs.COLUMNS, row))
+        for reading in runs.expand(row, total):
+            energy = max(reading['total_power'] - total, 0) if total is not None else 0
+            total = reading['total_power']
+            if (start and reading['timestamp'] < start) or reading['timestamp'] >= end:
+                continue
+            power = reading['power']
+            yield (reading['timestamp'], 1, power, power, power, energy, 1.0 if reading['running'] else 0.0)
+
+def minute_rows(machine_id: str, start: datetime, end: datetime) -> Iterable[Tuple]:
+    """Yield minute rollups in [start, end) in the row format expected by `fold`."""
+    query = (db.session.query(WashingMachineMinute.timestamp,
+                              WashingMachineMinute.samples,
+                              WashingMachineMinute.power_min,
+                              WashingMachineMinute.power_max,
+                              WashingMachineMinute.power_mean,
+                              WashingMachineMinute.energy,
+                              WashingMachineMinute.running_fraction)
+             .filter(WashingMachineMinute.machine_id == machine_id,
+                     WashingMachineMinute.timestamp < end)
+             .order_by(WashingMachineMinute.timestamp))
+    if start:
+        query = query.filter(WashingMachineMinute.timestamp >= start)
+    return query.yield_per(1000)
+
+def lag(config: dict) -> timedelta:
+    """Return how long new readings may take to reach the database."""
+    return timedelta(seconds=2 * config['POLL_INTERVAL'] + config['RUN_SYNC_INTERVAL'] + config['WRITE_BUFFER_SECONDS'])
+
+def rollup(machine_id: str, now: datetime, config: dict) -> None:
+    """Fold completed minutes and hours of a machine and expire old rows.
+
+    Readings that may still sit in the write buffer or in an open run are
+    left alone, so they can't be missed.
+    """
+    until_minute = floor_time(now - lag(config), MINUTE)
+    until_hour = floor_time(until_minute, HOUR)
+
+    start = watermark(WashingMachineMinute, machine_id, MINUTE)
+    if not start or start < until_minute:
+        fold(raw_rows(machine_id, start, until_minute), WashingMachineMinute, machine_id, MINUTE)
+        db.session.flush()
+
+    start = watermark(WashingMachineHour, machine_id, HOUR)
+    if not start or start < until_hour:
+        fold(minute_rows(machine_id, start, until_hour), WashingMachineHour, machine_id, HOUR)
+        db.session.flush()
+
+    expire(machine_id, now, config)
+
+def refold(machine_id: str, start: datetime, end: datetime) -> None:
+    """Fold the buckets overlapping [start, end] again, after raw readings were added below the watermarks.
+
+    `rollup` only folds forward, so readings inserted into already folded
+    minutes would be expired without ever being folded. The minute buckets
+    are folded from the raw readings again, which have to be complete in
+    these minutes, the hour buckets from the minute buckets (without
+    committing).
+    """
+    for model, resolution, source in ((WashingMachineMinute, MINUTE, raw_rows),
+                                      (WashingMachineHour, HOUR, minute_rows)):
+        folded_until = watermark(model, machine_id, resolution)
+        first = floor_time(start, resolution)
+        last = min(floor_time(end, resolution) + resolution, folded_until) if folded_until else first
+        if first >= last:
+            continue
+        (model.query
+         .filter(model.machine_id == machine_id, model.timestamp >= first, model.timestamp < last)
+         .delete(synchronize_session=False))
+        fold(source(machine_id, first, last), model, machine_id, resolution)
+        db.session.flush()
+
+def expire(machine_id: str, now: datetime, config: dict) -> None:
+    """Drop rows that are older than their tier's retention and already folded."""
+    tiers = [(WashingMachine, config['RAW_RETENTION_DAYS'], watermark(WashingMachineMinute, machine_id, MINUTE)),
+             (WashingMachineMinute, config['MINUTE_RETENTION_DAYS'], watermark(WashingMachineHour, machine_id, HOUR)),
+             (WashingMachineHour, config['HOUR_RETENTION_DAYS'], None)]
+
+    for model, days, folded_until in tiers:
+        cutoff = now - timedelta(days=days)
+        if model is not WashingMachineHour:
+            if not folded_until:
+                continue
+            cutoff = min(cutoff, folded_until)
+        if model is WashingMachine and config['ARCHIVE_READINGS']:
+            # Keep expired raw readings in the archive
+            cutoff = min(cutoff, archive.archive_days(config, machine_id, cutoff))
+        # Runs of change-only storage may reach past their timestamp
+        end = model.valid_until if model is WashingMachine else model.timestamp
+        (model.query
+         .filter(model.machine_id == machine_id, end < cutoff)
+         .delete(synchronize_session=False))
+
+def history_model(start: datetime, now: datetime, config: dict):
+    """Return the finest tier still holding readings from `start` on."""
+    if start >= now - timedelta(days=config['RAW_RETENTION_DAYS']):
+        return WashingMachine
+    if start >= now - timedelta(days=config['MINUTE_RETENTION_DAYS']):
+        return WashingMachineMinute
+    return WashingMachineHour
+
+def history_stable_until(start: datetime, end: datetime, now: datetime, config: dict) -> datetime:
+    """Return until when the history of [start, end) served now won't change.
+
+    Returns:
+        None if the range isn't complete yet. Otherwise the time the range
+        moves to a coarser tier (or expires).
+    """
+    if end > now - lag(config) - timedelta(seconds=config['ROLLUP_INTERVAL']):
+        return None
+    model = history_model(start, now, config)
+    retention = {WashingMachine: config['RAW_RETENTION_DAYS'],
+                 WashingMachineMinute: config['MINUTE_RETENTION_DAYS'],
+                 WashingMachineHour: config['HOUR_RETENTION_DAYS']}[model]
+    return start + timedelta(days=retention)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Change-only (run-length) storage of readings
+
+With `CHANGE_ONLY_STORAGE` enabled, a reading is only stored as a new row if
+its running state changed or its power or voltage left the deadband around
+the first reading of the current run. Otherwise the current run is extended:
+`valid_until` is set to the time of the latest reading, `repeat_count` is
+increased and `current`/`total_power` are replaced with the latest values.
+
+To keep write I/O low, the open run is only handed to the write buffer
+every `RUN_SYNC_INTERVAL` seconds and when it is closed. `expand` turns runs
+back into a dense series of readings.
+
+"""
+
+from datetime import datetime
+from typing import Iterable, Iterator, List
+
+from sqlalchemy import and_, bindparam
+
+from .models import WashingMachine, db
+
+
+COLUMNS = ('machine_id', 'timestamp', 'running', 'last_changed', 'voltage',
+           'current', 'power', 'total_power', 'valid_until', 'repeat_count')
+
+
+def as_dict(washing_machine: WashingMachine) -> dict:
+    """Return the columns of a reading as a plain dict."""
+    return {column: getattr(washing_machine, column) for column in COLUMNS}
+
+def within_deadband(run: dict, reading: WashingMachine, config: dict) -> bool:
+    """Check whether a reading can extend a run instead of starting a new one."""
+    return (run['running'] == reading.running
+            and abs(run['power'] - reading.power) <= config['DEADBAND_POWER']
+            and abs(run['voltage'] - reading.voltage) <= config['DEADBAND_VOLTAGE'])
+
+def extend(run: dict, reading: WashingMachine) -> None:
+    """Extend a run by a reading within its deadband."""
+    run['valid_until'] = reading.timestamp
+    run['repeat_count'] += 1
+    run['current'] = reading.current
+    run['total_power'] = reading.total_power
+
+def sync(pending: Iterable[dict]) -> None:
+    """Write the extensions of runs back to their rows (without committing)."""
+    table = WashingMachine.__table__
+    statement = table.update().where(and_(table.c.machine_id == bindparam('b_machine_id'),
+                                          table.c.timestamp == bindparam('b_timestamp')))
+    params = [{'b_machine_id': run['machine_id'],
+               'b_timestamp': run['timestamp'],
+               'valid_until': run['valid_until'],
+               'repeat_count': run['repeat_count'],
+               'current': run['current'],
+               'total_power': run['total_power']} for run in pending]
+    if params:
+        db.session.execute(statement, params)
+
+def expand(row: dict, previous_total: float = None) -> Iterator[dict]:
+    """Yield the single readings a row stands for, oldest first.
+
+    The timestamps are spread evenly between `timestamp` and `valid_until`.
+    As only the last `total_power` of a run is known, it is interpolated
+    linearly from the `total_power` of the previous row, if given.
+
+    Args:
+        row: A row of the `washingmachine` table as dict.
+        previous_total: `total_power` of the row before this one.
+    """
+    count = row.get('repeat_count') or 1
+    if count == 1:
+        yield row
+        return
+
+    step = (row['valid_until'] - row['timestamp']) / (count - 1)
+    for k in range(count):
+        timestamp = row['timestamp'] + step * k
+        reading = dict(row, timestamp=timestamp, valid_until=timestamp, repeat_count=1)
+        if previous_total is not None:
+            reading['total_power'] = previous_total + (row['total_power'] - previous_total) * (k + 1) / count
+        yield reading
+
+def expand_newest(rows: Iterable[dict], amount: int, end: datetime = None) -> List[dict]:
+    """Expand rows ordered newest first into the newest `amount` readings before `end`.
+
+    Returns:
+        The readings, newest first.
+    """
+    readings = []
+    rows = iter(rows)
+    row = next(rows, None)
+    while row and len(readings) < amount:
+        older = next(rows, None)
+        readings.extend(reading for reading in reversed(list(expand(row, older['total_power'] if older else None)))
+                        if end is None or reading['timestamp'] < end)
+        row = older
+    return readings[:amount]
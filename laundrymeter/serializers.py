@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Precompiled JSON serializers for rows of plain values
+
+The marshmallow schemas in `models` look up and call a field object for
+every value they dump. For a fixed set of columns, a `Serializer` instead
+compiles a single function turning a row tuple into its JSON object. Rows
+are fetched with column-only queries (`Serializer.query`), so neither ORM
+entities nor intermediate dicts are created.
+
+The output is the same JSON as the `ModelSchema` of the model (checked by
+`tests/test_serializers.py`), with the keys in the order of the columns.
+
+"""
+
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from operator import attrgetter, itemgetter
+from typing import Callable, Iterable, Sequence
+import json
+
+from marshmallow import fields
+
+from .models import User, WashingMachine, WashingMachineMinute, WashingMachineHour, db
+
+
+def encode_float(value: float) -> str:
+    """Encode a float like `json.dumps`."""
+    value = float(value)
+    if value - value == 0: # Not NaN or infinite
+        return float.__repr__(value)
+    return json.dumps(value) # NaN, Infinity
+
+def encode_datetime(value: datetime) -> str:
+    """Encode a datetime like the marshmallow `DateTime` field."""
+    return json.dumps(DATETIME.serialize('value', {'value': value}))
+
+
+DATETIME = fields.DateTime()
+
+# The end of an encoded naive datetime after `isoformat()`, some marshmallow
+# versions (e.g. 3.0.0b16) add the UTC offset
+NAIVE_END = encode_datetime(datetime(2018, 10, 1))[len('"2018-10-01T00:00:00'):]
+
+# Expressions encoding the (not None) value `{v}` of a column by its Python type
+EXPRESSIONS = {
+    str: 'escape({v} if {v}.__class__ is str else str({v}))',
+    float: 'repr({v}) if {v}.__class__ is float and {v} - {v} == 0 else encode_float({v})',
+    int: 'repr({v} if {v}.__class__ is int else int({v}))',
+    bool: '"true" if {v} else "false"',
+    datetime: 'quote + {v}.isoformat() + naive_end if {v}.tzinfo is None else encode_datetime({v})',
+}
+
+
+def compile_dump(columns: Sequence[str], types: Sequence[type]) -> Callable[[tuple], str]:
+    """Compile a function dumping a row tuple to a JSON object with the given keys."""
+    template = '{' + ', '.join(encode_basestring_ascii(column).replace('%', '%%') + ': %s'
+                               for column in columns) + '}'
+    variables = ['v{}'.format(i) for i in range(len(columns))]
+    values = ['"null" if {0} is None else ({1})'.format(name, EXPRESSIONS[kind].format(v=name))
+              for name, kind in zip(variables, types)]
+    source = 'def dump(row):\n    {}, = row\n    return {!r} % ({},)\n'.format(
+        ', '.join(variables), template, ', '.join(values))
+    namespace = {'escape': encode_basestring_ascii, 'encode_float': encode_float,
+                 'encode_datetime': encode_datetime, 'quote': '"', 'naive_end': NAIVE_END}
+    exec(source, namespace)
+    return namespace['dump']
+
+
+def extend(dumped: str, **fields) -> str:
+    """Append fields to a dumped JSON object, encoding the values with `json.dumps`."""
+    return dumped[:-1] + ''.join(', {}: {}'.format(encode_basestring_ascii(name), json.dumps(value))
+                                 for name, value in fields.items()) + '}'
+
+
+class Serializer:
+    """JSON serializer of a fixed set of columns of a model.
+
+    Args:
+        model: The model the columns belong to.
+        columns: Names of the serialized columns, all columns if None.
+    """
+
+    def __init__(self, model, columns: Sequence[str] = None) -> None:
+        self.model = model
+        self.columns = tuple(columns or (column.key for column in model.__table__.columns))
+        self.entities = [getattr(model, column) for column in self.columns]
+        self.dump = compile_dump(self.columns, [model.__table__.columns[column].type.python_type
+                                                for column in self.columns])
+        # itemgetter/attrgetter of a single name don't return a tuple
+        self._items = itemgetter(*self.columns) if len(self.columns) > 1 else lambda row: (row[self.columns[0]],)
+        self._attributes = attrgetter(*self.columns) if len(self.columns) > 1 else lambda obj: (getattr(obj, self.columns[0]),)
+
+    def query(self):
+        """Return a query fetching the columns as plain tuples (needs an app context)."""
+        return db.session.query(*self.entities)
+
+    def dumps(self, rows: Iterable[tuple], many: bool = False) -> str:
+        """Dump a row tuple, or a list of them with `many`."""
+        if many:
+            return '[' + ', '.join(map(self.dump, rows)) + ']'
+        return self.dump(rows)
+
+    def dump_dict(self, row: dict) -> str:
+        """Dump a row given as dict with (at least) all columns."""
+        return self.dump(self._items(row))
+
+    def dumps_dicts(self, rows: Iterable[dict]) -> str:
+        """Dump a list of rows given as dicts."""
+        return '[' + ', '.join(self.dump(self._items(row)) for row in rows) + ']'
+
+    def dump_object(self, obj) -> str:
+        """Dump a model instance."""
+        return self.dump(self._attributes(obj))
+
+
+wm_status = Serializer(WashingMachine, ('machine_id', 'timestamp', 'running', 'last_changed'))
+wm_debug = Serializer(WashingMachine)
+minute = Serializer(WashingMachineMinute)
+hour = Serializer(WashingMachineHour)
+user_names = Serializer(User, ('name',))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Simulated smart plugs for development and benchmarks
+
+A `SimulatedPlug` answers `get_emeter_realtime` like a `pyHS100.SmartPlug`,
+replaying a power trace one reading per call. Latency and failures can be
+injected. Configure a machine with an ip of `sim:<trace>` to poll one:
+
+* `sim:synthetic` replays generated wash cycles (see `synthetic_trace`).
+* `sim:/path/to/trace.csv` replays a recorded trace with the power in Watts
+  in the last column of every line (lines that don't parse are skipped).
+
+"""
+
+from typing import List, Sequence, Tuple
+import random
+import time
+
+import numpy as np
+
+
+class SimulatedPlug:
+    """Fake smart plug replaying a power trace.
+
+    Args:
+        trace: Power readings in Watts, replayed in a loop.
+        interval: Seconds between readings, used to integrate `total_wh`.
+        latency: Seconds every query takes.
+        jitter: Additional random latency of up to this many seconds.
+        failure_rate: Probability of a query failing with a communication error.
+        timeout_rate: Probability of a query hanging for `timeout` seconds.
+        timeout: Seconds a hanging query takes before it fails.
+        seed: Seed of the random failures and jitter.
+    """
+
+    def __init__(self, trace: Sequence[float], interval: float = 5, latency: float = 0, jitter: float = 0,
+                 failure_rate: float = 0, timeout_rate: float = 0, timeout: float = 10, seed: int = None) -> None:
+        self.trace = np.asarray(trace, dtype=float)
+        self.interval = interval
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.position = 0
+        self.total_wh = 0.0
+        self.queries = 0
+
+    def get_emeter_realtime(self) -> dict:
+        from pyHS100 import SmartDeviceException
+
+        self.queries += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            time.sleep(self.timeout)
+            raise SmartDeviceException('Communication error')
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise SmartDeviceException('Communication error')
+
+        power = float(self.trace[self.position % len(self.trace)])
+        self.position += 1
+        self.total_wh += power * self.interval / 3600
+        voltage = 230 + self.random.uniform(-1, 1)
+        return {'power_mw': int(power * 1000),
+                'voltage_mv': int(voltage * 1000),
+                'current_ma': int(power / voltage * 1000),
+                'total_wh': int(self.total_wh)}
+
+
+def synthetic_trace(cycles: int, interval: float = 5, idle_minutes: float = 60,
+                    seed: int = 0) -> Tuple[np.ndarray, List[Tuple[int, int]]]:
+    """Generate a power trace of wash cycles separated by idle periods.
+
+    Every cycle heats up, washes with pauses of a few minutes below 10 Watts
+    (which a detector must not take for the end), and spins. Cycle lengths
+    and power levels vary randomly.
+
+    Returns:
+        The power in Watts per reading and the (first, last) reading index
+        of every cycle.
+    """
+    rng = np.random.default_rng(seed)
+    steps = lambda minutes: max(1, int(minutes * 60 / interval))
+    parts, cycle_bounds, position = [], [], 0
+
+    def add(power: np.ndarray) -> None:
+        nonlocal position
+        parts.append(power)
+        position += len(power)
+
+    for _ in range(cycles):
+        add(rng.uniform(0.3, 1.5, steps(idle_minutes * rng.uniform(0.5, 1.5))))
+        start = position
+        add(rng.uniform(1800, 2200, steps(rng.uniform(8, 20)))) # Heat up
+        for _ in range(rng.integers(2, 6)):
+            add(rng.uniform(120, 500, steps(rng.uniform(5, 15)))) # Wash
+            add(rng.uniform(1, 8, steps(rng.uniform(1, 4)))) # Pause, machine still running
+        add(rng.uniform(300, 600, steps(rng.uniform(5, 12)))) # Spin
+        cycle_bounds.append((start, position - 1))
+    add(rng.uniform(0.3, 1.5, steps(idle_minutes)))
+    return np.concatenate(parts), cycle_bounds
+
+def load_trace(path: str) -> np.ndarray:
+    """Load a recorded power trace from a CSV file (power in the last column)."""
+    power = []
+    with open(path) as f:
+        for line in f:
+            try:
+                power.append(float(line.rstrip().split(',')[-1]))
+            except ValueError:
+                continue # Header
+    return np.array(power)
+
+def plug(ip: str, config: dict) -> SimulatedPlug:
+    """Create the simulated plug for a `sim:` ip."""
+    source = ip[len('sim:'):]
+    trace = synthetic_trace(24, config['POLL_INTERVAL'])[0] if source == 'synthetic' else load_trace(source)
+    return SimulatedPlug(trace, interval=config['POLL_INTERVAL'])
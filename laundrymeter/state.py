@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""In-memory cache of the newest reading of every machine
+
+The poller publishes every committed reading here, so status reads from
+the REST API and the Telegram bot don't need to query the database. Next
+to a plain copy of the reading, the snapshot holds the JSON responses of
+the status and debug endpoints, serialized once per tick. The status
+includes the predicted seconds until a running cycle ends (`remaining`, see
+`profiles`), null if unknown.
+
+Only the leader process polls (see `leader`). It also writes every snapshot
+to a small JSON file in `STATE_PATH`, which the other processes reload when
+its modification time changes. A `stat` per read keeps their status as fresh
+as the leader's without querying the database.
+
+Clients can `wait` for a newer snapshot. In the leader they are woken the
+moment a snapshot is published, in the other processes within
+`STATE_CHECK_INTERVAL` seconds.
+
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from threading import Condition, Lock
+from typing import List
+from sqlalchemy import desc
+import json
+import os
+import time
+
+from .models import WashingMachine
+from . import serializers
+
+
+Snapshot = namedtuple('Snapshot', ['reading', 'status_json', 'debug_json', 'remaining'])
+
+COLUMNS = ('machine_id', 'timestamp', 'running', 'last_changed',
+           'voltage', 'current', 'power', 'total_power')
+
+
+def plug_config(config: dict) -> List[dict]:
+    """Return the list of smart plugs to poll as `{'id': ..., 'ip': ...}` dicts.
+
+    Falls back to a single machine with the id 'default' on `SMART_PLUG_IP`
+    if `SMART_PLUGS` is not configured.
+    """
+    if config.get('SMART_PLUGS'):
+        return list(config['SMART_PLUGS'])
+    return [{'id': 'default', 'ip': config['SMART_PLUG_IP']}]
+
+def snapshot(washing_machine: WashingMachine, remaining: float = None) -> Snapshot:
+    """Create a snapshot of a reading that is independent of the session.
+
+    Args:
+        washing_machine: The reading.
+        remaining: Predicted seconds until the running cycle ends, None if unknown.
+    """
+    remaining = round(remaining) if remaining is not None else None
+    return Snapshot(reading={column: getattr(washing_machine, column) for column in COLUMNS},
+                    status_json=serializers.extend(serializers.wm_status.dump_object(washing_machine),
+                                                   remaining=remaining),
+                    debug_json=serializers.wm_debug.dump_object(washing_machine),
+                    remaining=remaining)
+
+
+def dump_snapshot(snapshot: Snapshot) -> str:
+    """Serialize a snapshot for sharing it with other processes."""
+    reading = {column: value.isoformat() if isinstance(value, datetime) else value
+               for column, value in snapshot.reading.items()}
+    return json.dumps({'reading': reading,
+                       'status_json': snapshot.status_json,
+                       'debug_json': snapshot.debug_json,
+                       'remaining': snapshot.remaining})
+
+def load_snapshot(data: str) -> Snapshot:
+    """Deserialize a snapshot written by `dump_snapshot`."""
+    shared = json.loads(data)
+    reading = shared['reading']
+    for column in ('timestamp', 'last_changed'):
+        if reading[column]:
+            reading[column] = datetime.fromisoformat(reading[column])
+    return Snapshot(reading, shared['status_json'], shared['debug_json'], shared.get('remaining'))
+
+
+class LatestState:
+    """Thread safe store of the newest snapshot per machine.
+
+    Args:
+        path: Directory to share the snapshots with other processes in,
+              None to keep them in this process only.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self.check_interval = 0.5
+        self._lock = Lock()
+        self._published_event = Condition()
+        self._snapshots = {}
+        self._published = set() # Machines polled by this process
+        self._mtimes = {} # Modification times of the loaded shared snapshots
+
+    def publish(self, snapshot: Snapshot) -> None:
+        """Replace the snapshot of the machine the snapshot was taken from."""
+        machine_id = snapshot.reading['machine_id']
+        with self._lock:
+            self._snapshots[machine_id] = snapshot
+            self._published.add(machine_id)
+        if self.path:
+            filename = self.filename(machine_id)
+            with open(filename + '.tmp', 'w') as f:
+                f.write(dump_snapshot(snapshot))
+            os.replace(filename + '.tmp', filename) # Readers never see a partial file
+        with self._published_event:
+            self._published_event.notify_all()
+
+    def get(self, machine_id: str) -> Snapshot:
+        """Return the newest snapshot of a machine.
+
+        Snapshots published by another process are taken from the shared
+        files. Falls back to the database (needs an app context) if nothing
+        has been published for the machine yet and caches the result.
+
+        Returns:
+            The snapshot, None if there is no reading of the machine at all.
+        """
+        with self._lock:
+            cached = self._snapshots.get(machine_id)
+            if machine_id in self._published or (cached and not self.path):
+                return cached
+        if self.path:
+            shared = self.load(machine_id)
+            if shared:
+                return shared
+        if cached:
+            return cached
+
+        washing_machine = (WashingMachine.query
+                           .filter_by(machine_id=machine_id)
+                           .order_by(desc('timestamp'))
+                           .first())
+        if not washing_machine:
+            return None
+
+        loaded = snapshot(washing_machine)
+        with self._lock:
+            # Don't overwrite a newer snapshot published in the meantime
+            return self._snapshots.setdefault(machine_id, loaded)
+
+    def wait(self, machine_id: str, newer_than: datetime = None, column: str = 'timestamp',
+             timeout: float = 30) -> Snapshot:
+        """Wait for a snapshot of a machine whose `column` is newer than `newer_than`.
+
+        Args:
+            machine_id: The machine to wait for.
+            newer_than: Returns right away if None.
+            column: 'timestamp' to wait for a new reading, 'last_changed' to
+                    wait for the running state to change.
+            timeout: Seconds to wait at most.
+
+        Returns:
+            The snapshot, None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.get(machine_id)
+            if snapshot and (newer_than is None or
+                             (snapshot.reading[column] and snapshot.reading[column] > newer_than)):
+                return snapshot
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self._published_event:
+                self._published_event.wait(min(remaining, self.check_interval))
+
+    def filename(self, machine_id: str) -> str:
+        """Return the file the snapshot of a machine is shared in."""
+        return os.path.join(self.path, machine_id + '.json')
+
+    def load(self, machine_id: str) -> Snapshot:
+        """Return the shared snapshot of a machine, reloading it only if it changed."""
+        try:
+            mtime = os.stat(self.filename(machine_id)).st_mtime_ns
+            with self._lock:
+                if self._mtimes.get(machine_id) == mtime:
+                    return self._snapshots[machine_id]
+            with open(self.filename(machine_id)) as f:
+                loaded = load_snapshot(f.read())
+        except (OSError, ValueError):
+            return None
+
+        with self._lock:
+            if machine_id in self._published:
+                return self._snapshots[machine_id]
+            self._snapshots[machine_id] = loaded
+            self._mtimes[machine_id] = mtime
+        return loaded
+
+
+def init_app(app) -> None:
+    """Share the snapshots with the other processes through `STATE_PATH`."""
+    os.makedirs(app.config['STATE_PATH'], exist_ok=True)
+    latest.path = app.config['STATE_PATH']
+    latest.check_interval = app.config['STATE_CHECK_INTERVAL']
+
+
+latest = LatestState()
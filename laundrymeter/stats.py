@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""Usage statistics of the machines
+
+The poller adds every reading to hourly aggregates in the `usage_hour`
+table (see `UsageHour`): observed and running time, energy and finished
+cycles. Statistics over any range are computed from at most one row per
+machine and hour (a year are less than 9000 rows), grouped in SQL:
+
+* `summary`: totals of a range,
+* `daily`: energy, cycles and running time per day,
+* `occupancy`: how often the machine is running per hour of the week.
+
+Days and hours of the week are in the local time of the server, like the
+times in notifications. As the hours are stored as hours since the epoch,
+they are grouped by adding the UTC offset, once per range of a constant
+offset (i.e. between daylight saving time changes).
+
+The deltas are collected in memory and written together with the write
+buffer (see `write_buffer`), so the aggregates lag behind the readings by
+at most `WRITE_BUFFER_SECONDS`. `rebuild` recomputes the aggregates from the
+stored history (raw readings, archive and rollups) with NumPy, e.g. after
+the poller was killed before flushing.
+
+"""
+
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Tuple
+import time
+
+import numpy as np
+from sqlalchemy import and_, bindparam, func
+
+from .models import Cycle, UsageHour, WashingMachine, WashingMachineMinute, WashingMachineHour, db
+from . import detectors
+from . import history
+from . import archive
+from . import rollup
+
+
+FIELDS = ('seconds', 'running_seconds', 'energy', 'cycles', 'cycle_seconds')
+
+HOUR = 3600
+DAY = 86400
+WEEK = 168 # Hours
+
+# The epoch was a Thursday, hours of the week start on Monday
+EPOCH_WEEK_HOUR = 3 * 24
+
+# Raw readings are rebuilt a week at a time
+CHUNK = timedelta(days=7)
+
+# A coarser tier only replaces an hour if it covers 5 minutes more of it
+COVERAGE_TOLERANCE = 300
+
+
+class Usage:
+    """Thread safe accumulator of usage not written to the `usage_hour` table yet."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._deltas = OrderedDict() # (machine_id, hour since the epoch) -> deltas of FIELDS
+        self._last = {} # machine_id -> (timestamp, total_power) of the previous reading
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._deltas)
+
+    def _delta(self, machine_id: str, timestamp: datetime) -> list:
+        key = (machine_id, int(detectors.seconds(timestamp) // HOUR))
+        delta = self._deltas.get(key)
+        if delta is None:
+            delta = self._deltas[key] = [0.0, 0.0, 0.0, 0, 0.0]
+        return delta
+
+    def add_reading(self, machine_id: str, timestamp: datetime, running: bool,
+                    total_power: float, max_gap: float) -> None:
+        """Add the interval since the previous reading to the hour of `timestamp`.
+
+        Intervals longer than `max_gap` seconds (e.g. while the plug didn't
+        answer) count as not observed, the energy consumed meanwhile is
+        counted nevertheless. Negative energy deltas (the plug reset its
+        counter) count as zero.
+        """
+        with self._lock:
+            last = self._last.get(machine_id)
+            self._last[machine_id] = (timestamp, total_power)
+            if last is None:
+                return
+            elapsed = (timestamp - last[0]).total_seconds()
+            if elapsed > max_gap:
+                elapsed = 0
+            delta = self._delta(machine_id, timestamp)
+            delta[0] += elapsed
+            if running:
+                delta[1] += elapsed
+            delta[2] += max(total_power - last[1], 0)
+
+    def add_cycle(self, cycle: dict) -> None:
+        """Count a finished cycle in the hour it started."""
+        with self._lock:
+            delta = self._delta(cycle['machine_id'], cycle['start'])
+            delta[3] += 1
+            delta[4] += cycle['duration']
+
+    def take(self) -> OrderedDict:
+        """Take the collected deltas out of the accumulator to write them."""
+        with self._lock:
+            deltas, self._deltas = self._deltas, OrderedDict()
+        return deltas
+
+    def restore(self, deltas: OrderedDict) -> None:
+        """Add deltas back after their write failed."""
+        with self._lock:
+            for key, delta in self._deltas.items():
+                if key in deltas:
+                    deltas[key] = [a + b for a, b in zip(deltas[key], delta)]
+                else:
+                    deltas[key] = delta
+            self._deltas = deltas
+
+    def write(self, deltas: OrderedDict) -> int:
+        """Add taken deltas to their rows (needs an app context, doesn't commit).
+
+        Returns:
+            The number of hours written.
+        """
+        if not deltas:
+            return 0
+
+        existing = set()
+        for machine_id in {machine_id for machine_id, _ in deltas}:
+            hours = [hour for key, hour in deltas if key == machine_id]
+            existing.update((machine_id, hour) for hour, in
+                            db.session.query(UsageHour.hour)
+                            .filter(UsageHour.machine_id == machine_id, UsageHour.hour.in_(hours)))
+
+        table = UsageHour.__table__
+        inserts = [dict(zip(FIELDS, delta), machine_id=key[0], hour=key[1])
+                   for key, delta in deltas.items() if key not in existing]
+        updates = [dict(zip(['d_' + field for field in FIELDS], delta), b_machine_id=key[0], b_hour=key[1])
+                   for key, delta in deltas.items() if key in existing]
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            statement = (table.update()
+                         .where(and_(table.c.machine_id == bindparam('b_machine_id'),
+                                     table.c.hour == bindparam('b_hour')))
+                         .values({field: table.c[field] + bindparam('d_' + field) for field in FIELDS}))
+            db.session.execute(statement, updates)
+        return len(deltas)
+
+
+#################
+##### Query #####
+#################
+
+def hour_range(start: datetime, end: datetime) -> Tuple[int, int]:
+    """Return the first and the end of the hours (since the epoch) starting in [start, end)."""
+    return int(-(-detectors.seconds(start) // HOUR)), int(-(-detectors.seconds(end) // HOUR))
+
+def offsets(first: int, last: int) -> List[Tuple[int, int, int]]:
+    """Split the hours [first, last) into ranges of a constant UTC offset of the local time.
+
+    The offset is checked once a week and searched by the hour where it
+    changed.
+
+    Returns:
+        (first, last, offset in seconds) of the ranges, oldest first.
+    """
+    offset = time.localtime(first * HOUR).tm_gmtoff
+    ranges = []
+    hour = first
+    while hour < last:
+        step = min(hour + WEEK, last)
+        if time.localtime(step * HOUR).tm_gmtoff != offset:
+            while time.localtime(hour * HOUR).tm_gmtoff == offset:
+                hour += 1
+            ranges.append((first, hour, offset))
+            first, offset = hour, time.localtime(hour * HOUR).tm_gmtoff
+            continue
+        hour = step
+    ranges.append((first, last, offset))
+    return ranges
+
+def grouped(machine_id: str, start: datetime, end: datetime, key, columns) -> list:
+    """Sum up the columns of the hours in [start, end) grouped by a key in local time.
+
+    Args:
+        key: Function returning the SQL expression to group by from the
+             local time of an hour in seconds since the epoch.
+        columns: Names of the summed up columns.
+
+    Returns:
+        (key, sums...) tuples, once per range of a constant UTC offset.
+    """
+    rows = []
+    for first, last, offset in offsets(*hour_range(start, end)):
+        group = key(UsageHour.hour * HOUR + offset)
+        rows += (db.session.query(group, *[func.sum(getattr(UsageHour, column)) for column in columns])
+                 .filter(UsageHour.machine_id == machine_id,
+                         UsageHour.hour >= first,
+                         UsageHour.hour < last)
+                 .group_by(group)
+                 .all())
+    return rows
+
+def summarize(machine_id: str, seconds: float, running_seconds: float, energy: float,
+              cycles: int, cycle_seconds: float) -> dict:
+    """Return the statistics of summed up hours."""
+    return {'machine_id': machine_id,
+            'energy': energy,
+            'cycles': cycles,
+            'running_hours': running_seconds / HOUR,
+            'observed_hours': seconds / HOUR,
+            'occupancy': running_seconds / seconds if seconds else None,
+            'mean_cycle_minutes': cycle_seconds / cycles / 60 if cycles else None}
+
+def summary(machine_id: str, start: datetime, end: datetime) -> dict:
+    """Return the totals of a machine in [start, end) (needs an app context).
+
+    Energy is in kWh, `occupancy` is the fraction of the observed time the
+    machine was running.
+    """
+    first, last = hour_range(start, end)
+    totals = (db.session.query(*[func.sum(getattr(UsageHour, field)) for field in FIELDS])
+              .filter(UsageHour.machine_id == machine_id,
+                      UsageHour.hour >= first,
+                      UsageHour.hour < last)
+              .one())
+    return summarize(machine_id, *[value or 0 for value in totals])
+
+def daily(machine_id: str, start: datetime, end: datetime) -> List[dict]:
+    """Return the totals of a machine per local day in [start, end), oldest first."""
+    days = {}
+    for day, *values in grouped(machine_id, start, end, lambda seconds: seconds / DAY, FIELDS):
+        totals = days.setdefault(day, [0.0, 0.0, 0.0, 0, 0.0])
+        for i, value in enumerate(values):
+            totals[i] += value or 0
+    return [dict(summarize(machine_id, *days[day]), date=(date(1970, 1, 1) + timedelta(days=day)).isoformat())
+            for day in sorted(days)]
+
+def occupancy(machine_id: str, start: datetime, end: datetime) -> List[dict]:
+    """Return how often a machine was running per local hour of the week in [start, end).
+
+    Returns:
+        168 dicts, starting with Monday 0:00 (`weekday` 0, `hour` 0). The
+        `occupancy` is None for hours never observed.
+    """
+    observed = [0.0] * WEEK
+    running = [0.0] * WEEK
+    key = lambda seconds: (seconds / HOUR + EPOCH_WEEK_HOUR) % WEEK
+    for i, seconds, running_seconds in grouped(machine_id, start, end, key, ('seconds', 'running_seconds')):
+        observed[i] += seconds or 0
+        running[i] += running_seconds or 0
+    return [{'weekday': i // 24,
+             'hour': i % 24,
+             'occupancy': running[i] / observed[i] if observed[i] else None,
+             'observed_hours': observed[i] / HOUR} for i in range(WEEK)]
+
+
+###################
+##### Rebuild #####
+###################
+
+def empty() -> Dict[str, np.ndarray]:
+    """Return hourly columns without hours."""
+    return {'hour': np.empty(0, np.int64), 'seconds': np.empty(0), 'running_seconds': np.empty(0),
+            'energy': np.empty(0)}
+
+def per_hour(timestamps: np.ndarray, **columns: np.ndarray) -> Dict[str, np.ndarray]:
+    """Sum up columns by the hour (since the epoch) of the timestamps (in seconds since the epoch)."""
+    hours, inverse = np.unique((timestamps // HOUR).astype(np.int64), return_inverse=True)
+    sums = {name: np.bincount(inverse, column, len(hours)) for name, column in columns.items()}
+    return dict(sums, hour=hours)
+
+def hourly(seconds: np.ndarray, running: np.ndarray, total: np.ndarray,
+           previous: Tuple[float, float], max_gap: float) -> Dict[str, np.ndarray]:
+    """Aggregate readings per hour, just like `Usage.add_reading`.
+
+    Args:
+        seconds: Timestamps of the readings in seconds since the epoch, oldest first.
+        running: Running state of the readings.
+        total: `total_power` of the readings.
+        previous: (seconds, total_power) of the reading before, None if there is none.
+        max_gap: Longer intervals between readings count as not observed.
+    """
+    if not len(seconds):
+        return empty()
+    if previous is None:
+        previous = (seconds[0], total[0])
+    elapsed = np.diff(seconds, prepend=previous[0])
+    elapsed[elapsed > max_gap] = 0
+    energy = np.maximum(np.diff(total, prepend=previous[1]), 0)
+    return per_hour(seconds, seconds=elapsed, running_seconds=elapsed * running, energy=energy)
+
+def database_columns(machine_id: str, start: datetime, end: datetime, batch: int) -> Tuple[np.ndarray, ...]:
+    """Return seconds, running and total_power of the raw readings in the database in [start, end)."""
+    rows = np.array([(detectors.seconds(reading['timestamp']), bool(reading['running']), reading['total_power'])
+                     for reading in history.iter_database_readings(machine_id, start, end, batch)],
+                    dtype=np.float64).reshape(-1, 3)
+    return rows[:, 0], rows[:, 1] > 0, rows[:, 2]
+
+def reading_columns(config: dict, machine_id: str, start: datetime, end: datetime) -> Tuple[np.ndarray, ...]:
+    """Return seconds, running and total_power of the raw readings in [start, end).
+
+    Archived ranges are read from the memory-mapped archive, the rest from
+    the database.
+    """
+    parts = []
+    cursor = start
+    for segment in archive.segments(config, machine_id):
+        if segment.end <= cursor or segment.start >= end:
+            continue
+        if cursor < segment.start:
+            parts.append(database_columns(machine_id, cursor, segment.start, config['HISTORY_BATCH_SIZE']))
+        columns = archive.load(config, machine_id, max(cursor, segment.start), min(end, segment.end))
+        parts.append((columns['timestamp'].astype('M8[us]').astype(np.int64) / 1e6,
+                      columns['running'].astype(bool),
+                      columns['total_power'].astype(np.float64)))
+        cursor = segment.end
+    if cursor < end:
+        parts.append(database_columns(machine_id, cursor, end, config['HISTORY_BATCH_SIZE']))
+    if not parts:
+        return np.empty(0), np.empty(0, bool), np.empty(0)
+    return tuple(np.concatenate([part[i] for part in parts]) for i in range(3))
+
+def raw_hourly(config: dict, machine_id: str, start: datetime, end: datetime) -> Dict[str, np.ndarray]:
+    """Aggregate the raw readings (including archived ones) in [start, end) per hour."""
+    before = history.latest(WashingMachine, machine_id, 1, end=start)
+    previous = (detectors.seconds(before[0]['timestamp']), before[0]['total_power']) if before else None
+
+    parts = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + CHUNK, end)
+        seconds, running, total = reading_columns(config, machine_id, chunk_start, chunk_end)
+        parts.append(hourly(seconds, running, total, previous, config['STATS_MAX_GAP']))
+        if len(seconds):
+            previous = (seconds[-1], total[-1])
+        chunk_start = chunk_end
+    # Chunks are whole hours apart, so no hour is split
+    return {name: np.concatenate([part[name] for part in parts]) for name in empty()} if parts else empty()
+
+def rollup_hourly(config: dict, model, machine_id: str, start: datetime, end: datetime) -> Dict[str, np.ndarray]:
+    """Aggregate the rows of a rollup tier in [start, end) per hour.
+
+    The observed time is estimated as `samples * POLL_INTERVAL`, at most
+    the length of the bucket.
+    """
+    resolution = (rollup.MINUTE if model is WashingMachineMinute else rollup.HOUR).total_seconds()
+    rows = (db.session.query(model.timestamp, model.samples, model.energy, model.running_fraction)
+            .filter(model.machine_id == machine_id, model.timestamp >= start, model.timestamp < end)
+            .all())
+    if not rows:
+        return empty()
+    seconds = np.array([detectors.seconds(row[0]) for row in rows])
+    samples, energy, fraction = np.nan_to_num(np.array([row[1:] for row in rows], dtype=np.float64)).T
+    observed = np.minimum(samples * config['POLL_INTERVAL'], resolution)
+    return per_hour(seconds, seconds=observed, running_seconds=observed * fraction, energy=energy)
+
+def merge(sources: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Combine hourly columns of several tiers, finest first.
+
+    An hour is taken from the finest tier holding it, unless a coarser tier
+    covers more of it (e.g. raw readings that were partially expired).
+    """
+    result = sources[0]
+    for source in sources[1:]:
+        _, i, j = np.intersect1d(result['hour'], source['hour'], assume_unique=True, return_indices=True)
+        better = source['seconds'][j] > result['seconds'][i] + COVERAGE_TOLERANCE
+        new = ~np.isin(source['hour'], result['hour'], assume_unique=True)
+        for name in result:
+            result[name][i[better]] = source[name][j[better]]
+        result = {name: np.concatenate([result[name], source[name][new]]) for name in result}
+    order = np.argsort(result['hour'], kind='stable')
+    return {name: column[order] for name, column in result.items()}
+
+def cycle_hourly(machine_id: str, start: datetime, end: datetime) -> Dict[str, np.ndarray]:
+    """Count the finished cycles of the `cycles` table in [start, end) per hour they started."""
+    rows = (db.session.query(Cycle.start, Cycle.duration)
+            .filter(Cycle.machine_id == machine_id, Cycle.start >= start, Cycle.start < end,
+                    Cycle.end.isnot(None))
+            .all())
+    if not rows:
+        return {'hour': np.empty(0, np.int64), 'cycles': np.empty(0), 'cycle_seconds': np.empty(0)}
+    seconds = np.array([detectors.seconds(row[0]) for row in rows])
+    durations = np.array([row[1] or 0 for row in rows], dtype=np.float64)
+    return per_hour(seconds, cycles=np.ones(len(rows)), cycle_seconds=durations)
+
+def rebuild(config: dict, machine_id: str, start: datetime, end: datetime) -> int:
+    """Recompute the hourly aggregates of a machine in [start, end) from the history.
+
+    Raw readings (including archived ones) are preferred, hours whose raw
+    readings have expired are taken from the minute or hour rollups. Cycles
+    are counted from the `cycles` table (see `cycles.backfill`). Existing
+    rows in the range are replaced, without committing.
+
+    Returns:
+        The number of hours written.
+    """
+    start = rollup.floor_time(start, rollup.HOUR)
+    first, last = hour_range(start, end)
+    usage = merge([raw_hourly(config, machine_id, start, end),
+                   rollup_hourly(config, WashingMachineMinute, machine_id, start, end),
+                   rollup_hourly(config, WashingMachineHour, machine_id, start, end)])
+    counted = cycle_hourly(machine_id, start, end)
+
+    hours = np.union1d(usage['hour'], counted['hour'])
+    columns = {field: np.zeros(len(hours)) for field in FIELDS}
+    i = np.searchsorted(hours, usage['hour'])
+    for field in ('seconds', 'running_seconds', 'energy'):
+        columns[field][i] = usage[field]
+    i = np.searchsorted(hours, counted['hour'])
+    for field in ('cycles', 'cycle_seconds'):
+        columns[field][i] = counted[field]
+
+    (UsageHour.query
+     .filter(UsageHour.machine_id == machine_id, UsageHour.hour >= first, UsageHour.hour < last)
+     .delete(synchronize_session=False))
+    rows = [{'machine_id': machine_id,
+             'hour': hour,
+             'seconds': seconds,
+             'running_seconds': running_seconds,
+             'energy': energy,
+             'cycles': int(cycles),
+             'cycle_seconds': cycle_seconds}
+            for hour, seconds, running_seconds, energy, cycles, cycle_seconds
+            in zip(hours.tolist(), *[columns[field].tolist() for field in FIELDS])]
+    if rows:
+        db.session.execute(UsageHour.__table__.insert(), rows)
+    return len(rows)
+
+
+usage = Usage()
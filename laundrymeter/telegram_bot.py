@@ -5,16 +5,31 @@ Defines callbacks to Telegram commands, providing a subset of the REST Api.
 Authentication is provided via a start token that has to be obtained via
 the REST API first.
 
+By default, the leader process long-polls Telegram for new messages. With
+`TELEGRAM_WEBHOOK_URL` set, Telegram posts them to the webhook endpoint of
+the REST API instead, where any process answers them right away.
+
+The bot (and python-telegram-bot) is only loaded when it is first used, so
+processes that never receive or send a message don't pay for it.
+
 """
 
 from __future__ import annotations
 from flask import g
-from sqlalchemy import desc
-from telegram.ext import Updater, CommandHandler
 from functools import wraps
+from threading import Lock
+from typing import TYPE_CHECKING, List
+import hashlib
 import atexit
 
-from .models import User, WashingMachine, WashingMachineSchema
+from .models import User
+from . import state
+from . import recent
+from . import cycles
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from telegram.ext import Updater
 
 
 def telegram_auth_required(func):
@@ -22,7 +37,7 @@ def telegram_auth_required(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         with app.app_context():
-            user = User.query.filter_by(telegram_chat_id=update.message.chat_id).one()
+            user = User.verify_telegram_chat(update.message.chat_id)
             if not user:
                 app.logger.info('Unauthorized Telegram message received from %d', update.message.chat_id)
                 update.message.reply_text("Unauthorized. Please authenticate first.")
@@ -71,41 +86,126 @@ def notify(bot, update):
 
 @telegram_auth_required
 def status(bot, update):
-    """Telegram callback for `/status` to query the current simple status of the washing machine."""
+    """Telegram callback for `/status` to query the current simple status of the washing machines."""
     try:
-        washing_machine = WashingMachine.query.order_by(desc('timestamp')).first()
-        app.logger.debug('User %s (%s) successfully called status(). Current Wasching Machine status was returned: %s', g.user.username, g.user.name, washing_machine.running)
-        update.message.reply_text("The Washing Machine is currently " + ("Running" if washing_machine.running else "Stopped"))
+        lines = []
+        for machine_id in machine_ids():
+            snapshot = state.latest.get(machine_id)
+            running = snapshot.reading['running']
+            app.logger.debug('User %s (%s) successfully called status(). Current Wasching Machine status of %s was returned: %s', g.user.username, g.user.name, machine_id, running)
+            if running and snapshot.remaining is not None:
+                text = "Running (about {:.0f} min left)".format(snapshot.remaining / 60)
+            else:
+                text = "Running" if running else "Stopped"
+            lines.append(describe(machine_id, text))
+        update.message.reply_text("\n".join(lines))
     except Exception as e:
         app.logger.exception("User %s (%s) raised an exception on status(). Couldn't retrieve it from the Database.", g.user.username, g.user.name)
         update.message.reply_text("Couldn't retrieve the current machine status.")
 
 @telegram_auth_required
-def debug(bot, update):
-    """Telegram callback for `/debug` to query the current extended status of the washing machine."""
+def debug(bot, update, args):
+    """Telegram callback for `/debug [amount]` to query the current extended status of the washing machines.
+
+    With an amount, the power of the last `amount` readings (at most
+    `TELEGRAM_DEBUG_READINGS`) is listed as well.
+    """
     try:
-        washing_machine = WashingMachine.query.order_by(desc('timestamp')).first()
-        wm_debug_schema = WashingMachineSchema()
-        app.logger.debug('User %s (%s) successfully called debug(). Current Wasching Machine status was returned: %s', g.user.username, g.user.name, wm_debug_schema)
-        update.message.reply_text(wm_debug_schema.dumps(washing_machine))
+        amount = min(int(args[0]), app.config['TELEGRAM_DEBUG_READINGS']) if args else 0
+        lines = []
+        for machine_id in machine_ids():
+            lines.append(state.latest.get(machine_id).debug_json)
+            for reading in recent.latest(machine_id, amount, app.config['HISTORY_BATCH_SIZE']):
+                lines.append("{:%H:%M:%S} {:7.1f} W {}".format(reading['timestamp'], reading['power'],
+                                                                "running" if reading['running'] else "off"))
+        app.logger.debug('User %s (%s) successfully called debug(). Current Wasching Machine status was returned: %s', g.user.username, g.user.name, lines)
+        update.message.reply_text("\n".join(lines))
     except Exception as e:
         app.logger.exception("User %s (%s) raised an exception on debug(). Couldn't retrieve it from the Database.", g.user.username, g.user.name)
         update.message.reply_text("Couldn't retrieve the current machine status.")
 
-def init_app(flask_app: Flask) -> None:
-    """Initializing the telegram app with app context and registering callbacks"""
-    flask_app.logger.debug('Initializing Telegram Bot...')
+@telegram_auth_required
+def cycle(bot, update):
+    """Telegram callback for `/cycle` to query the last wash cycle of the washing machines."""
+    try:
+        lines = []
+        for machine_id in machine_ids():
+            last = cycles.latest(machine_id, 1).first()
+            if not last:
+                text = "No cycle recorded yet."
+            elif last.end is None:
+                text = "Running since {:%Y-%m-%d %H:%M} UTC, peak {:.0f} W.".format(last.start, last.peak_power)
+            else:
+                text = "Last cycle {:%Y-%m-%d %H:%M} - {:%H:%M} UTC ({:.0f} min), peak {:.0f} W, {:.2f} kWh.".format(
+                    last.start, last.end, last.duration / 60, last.peak_power, last.energy)
+            lines.append(text if len(machine_ids()) == 1 else "{}: {}".format(machine_id, text))
+        app.logger.debug('User %s (%s) successfully called cycle(): %s', g.user.username, g.user.name, lines)
+        update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        app.logger.exception("User %s (%s) raised an exception on cycle(). Couldn't retrieve it from the Database.", g.user.username, g.user.name)
+        update.message.reply_text("Couldn't retrieve the last cycle.")
+
+def machine_ids() -> List[str]:
+    """Return the ids of all polled machines."""
+    return [plug['id'] for plug in state.plug_config(app.config)]
+
+def describe(machine_id: str, text: str) -> str:
+    """Prefix a status text with the machine id if more than one machine is polled."""
+    if len(machine_ids()) > 1:
+        return "{}: {}".format(machine_id, text)
+    return "The Washing Machine is currently " + text
+
+def webhook_secret(config: dict) -> str:
+    """Return the secret last part of the webhook path."""
+    return config['TELEGRAM_WEBHOOK_SECRET'] or hashlib.sha256(config['TELEGRAM_BOT_TOKEN'].encode()).hexdigest()[:32]
+
+def process_update(data: dict) -> None:
+    """Answer an update received through the webhook (in the calling thread)."""
+    from telegram import Update
+    bot_updater = get_updater()
+    bot_updater.dispatcher.process_update(Update.de_json(data, bot_updater.bot))
+
+def get_updater() -> Updater:
+    """Return the bot with the callbacks registered, creating it on first use."""
+    global updater
+    with lock:
+        if updater is None:
+            from telegram.ext import Updater, CommandHandler
+            created = Updater(app.config['TELEGRAM_BOT_TOKEN'], base_url=app.config['TELEGRAM_API_URL'])
+            created.dispatcher.add_handler(CommandHandler('notify', notify))
+            created.dispatcher.add_handler(CommandHandler('start', start, pass_args=True))
+            created.dispatcher.add_handler(CommandHandler('status', status))
+            created.dispatcher.add_handler(CommandHandler('debug', debug, pass_args=True))
+            created.dispatcher.add_handler(CommandHandler('cycle', cycle))
+            updater = created
+    return updater
+
+def configure(flask_app: Flask) -> None:
+    """Set the app the bot answers for, the bot itself is created on first use."""
     global updater
     global app
-    updater = Updater(flask_app.config['TELEGRAM_BOT_TOKEN'])
-    app = flask_app
+    with lock:
+        updater = None
+        app = flask_app
 
-    updater.dispatcher.add_handler(CommandHandler('notify', notify))
-    updater.dispatcher.add_handler(CommandHandler('start', start, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('status', status))
-    updater.dispatcher.add_handler(CommandHandler('debug', debug))
-
-    flask_app.logger.debug('Starting Telegram Message Poller...')
-    updater.start_polling()
-    atexit.register(lambda: updater.stop())
+def init_app(flask_app: Flask) -> None:
+    """Initializing the telegram app with app context and start receiving updates"""
+    flask_app.logger.debug('Initializing Telegram Bot...')
+    if app is not flask_app:
+        configure(flask_app)
+    bot_updater = get_updater()
+
+    if flask_app.config['TELEGRAM_WEBHOOK_URL']:
+        flask_app.logger.debug('Registering Telegram Webhook...')
+        url = '{}/{}'.format(flask_app.config['TELEGRAM_WEBHOOK_URL'].rstrip('/'), webhook_secret(flask_app.config))
+        bot_updater.bot.set_webhook(url=url)
+    else:
+        flask_app.logger.debug('Starting Telegram Message Poller...')
+        bot_updater.start_polling()
+        atexit.register(lambda: bot_updater.stop())
     flask_app.logger.debug('Finished setting up Telegram Bot.')
+
+
+updater = None
+app = None
+lock = Lock() # Guards creating the bot
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""Bulk export and import of readings
+
+`flask export-readings` writes the raw readings of machines, archived ones
+included, to CSV or NDJSON (one JSON object per line). `flask
+import-readings` reads such a file into the `washingmachine` table. Both
+stream the rows through generators in chunks of `TRANSFER_BATCH_SIZE`, so
+memory use stays flat for files of any size:
+
+* Exported rows are read with Core queries and keyset pagination (archived
+  ones straight from the memory-mapped columns). The times are fetched as
+  stored (text on SQLite) and copied to the file as they are, formatting
+  datetimes would take longer than the rest of the export.
+* Imported chunks are converted column by column, the times with NumPy.
+  Each chunk is inserted with one executemany INSERT, on SQLite through
+  the DBAPI cursor with the values in SQLAlchemy's storage format (its
+  per-row processing would take most of the time otherwise). Every
+  `TRANSFER_COMMIT_ROWS` rows are committed.
+
+Files hold the columns of the `washingmachine` table, runs of change-only
+storage are kept as they are. Files ending in `.gz` are compressed. Only
+`timestamp` and `power` are required on import: `valid_until` defaults to
+`timestamp`, `repeat_count` to 1 and a missing `total_power` is integrated
+from the power. With `detect`, `running` and `last_changed` are recomputed
+by the configured detector (see `detectors`), e.g. for recorded traces or
+after changing the detector. The detector sees every row as one reading at
+its `timestamp`. The readings of each machine have to be in time order.
+
+Readings inserted into minutes the rollup already folded are folded again
+right away (see `rollup.refold`). Readings that would be expired without
+being folded (older than `RAW_RETENTION_DAYS` and the folded minutes) or
+that fall into the archive are refused. Readings older than
+`RAW_RETENTION_DAYS` are only kept until the next rollup folded them,
+unless `ARCHIVE_READINGS` archives them. The cycles, profiles and
+statistics aren't updated, rebuild them with the backfill commands before.
+
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice, repeat
+from typing import Callable, Dict, IO, Iterable, Iterator, List
+import csv
+import gzip
+import json
+import sys
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import String, select, type_coerce
+from sqlalchemy.exc import DBAPIError
+
+from .models import WashingMachine, WashingMachineMinute, db
+from . import archive
+from . import detectors
+from . import rollup
+from . import serializers
+
+
+FORMATS = ('csv', 'ndjson')
+
+# Exported columns, in the order of the table
+COLUMNS = serializers.wm_debug.columns
+
+TIMES = ('timestamp', 'last_changed', 'valid_until')
+
+# Dumps a row with the times as fetched (text or datetime)
+dump = serializers.compile_dump(COLUMNS, [str if column in TIMES else WashingMachine.__table__.columns[column].type.python_type
+                                          for column in COLUMNS])
+
+
+def guess_format(path: str) -> str:
+    """Return the format of a file by its extension (CSV unless it is .ndjson/.jsonl)."""
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+@contextmanager
+def open_file(path: str, mode: str) -> Iterator[IO]:
+    """Open a file for text reading ('r') or writing ('w'), '-' is stdin/stdout (left open)."""
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    if path.endswith('.gz'):
+        f = gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    else:
+        f = open(path, mode, encoding='utf-8', newline='')
+    with f:
+        yield f
+
+def chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yield lists of `size` items of an iterable (the last one may be shorter)."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def format_times(times: np.ndarray) -> list:
+    """Return 'M8[us]' times as text in SQLAlchemy's SQLite storage format, NaT as None."""
+    texts = np.datetime_as_string(times, unit='us')
+    if len(texts):
+        texts.view('U1').reshape(len(texts), -1)[:, 10] = ' ' # 'T' separator
+    texts = texts.tolist()
+    missing = np.isnat(times)
+    if missing.any():
+        for i in np.flatnonzero(missing).tolist():
+            texts[i] = None
+    return texts
+
+
+##################
+##### Export #####
+##################
+
+def export_chunks(config: dict, machine_id: str, start: datetime, end: datetime, batch: int) -> Iterator[List[tuple]]:
+    """Yield the rows of a machine starting in [start, end) in chunks of tuples (`COLUMNS`), oldest first.
+
+    Archived ranges are read from the archive, the remainder from the database.
+    """
+    cursor = start
+    for segment in archive.segments(config, machine_id):
+        if segment.end <= start or segment.start >= end:
+            continue
+        if cursor < segment.start:
+            yield from database_chunks(machine_id, cursor, segment.start, batch)
+        yield from archive_chunks(config, machine_id, max(cursor, segment.start), min(end, segment.end), batch)
+        cursor = segment.end
+    if cursor < end:
+        yield from database_chunks(machine_id, cursor, end, batch)
+
+def database_chunks(machine_id: str, start: datetime, end: datetime, batch: int) -> Iterator[list]:
+    """Yield the rows stored in the database starting in [start, end) in chunks, oldest first."""
+    table = WashingMachine.__table__
+    # Coerced to String, the times aren't converted to datetimes (on SQLite)
+    columns = [type_coerce(table.c[column], String) if column in TIMES else table.c[column] for column in COLUMNS]
+    timestamp = COLUMNS.index('timestamp')
+    cursor = None
+    while True:
+        query = select(columns).where(table.c.machine_id == machine_id).where(table.c.timestamp < end)
+        if cursor:
+            query = query.where(columns[timestamp] > cursor)
+        else:
+            query = query.where(table.c.timestamp >= start)
+        rows = db.session.execute(query.order_by(table.c.timestamp).limit(batch)).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < batch:
+            return
+        cursor = rows[-1][timestamp]
+
+def archive_chunks(config: dict, machine_id: str, start: datetime, end: datetime, batch: int) -> Iterator[List[tuple]]:
+    """Yield the archived readings in [start, end) as rows in chunks, oldest first."""
+    columns = archive.load(config, machine_id, start, end)
+    for lo in range(0, len(columns['timestamp']), batch):
+        timestamps = format_times(columns['timestamp'][lo:lo + batch].astype('M8[us]'))
+        values = {'machine_id': repeat(machine_id),
+                  'timestamp': timestamps,
+                  'running': columns['running'][lo:lo + batch].tolist(),
+                  'last_changed': repeat(None), # Not archived
+                  'voltage': columns['voltage'][lo:lo + batch].tolist(),
+                  'current': columns['current'][lo:lo + batch].tolist(),
+                  'power': columns['power'][lo:lo + batch].tolist(),
+                  'total_power': columns['total_power'][lo:lo + batch].tolist(),
+                  'valid_until': timestamps,
+                  'repeat_count': repeat(1)}
+        yield list(zip(*(values[column] for column in COLUMNS)))
+
+def write_csv(rows: Iterable[List[tuple]], out: IO) -> int:
+    """Write chunks of rows as CSV with a header line.
+
+    Returns:
+        The number of rows written.
+    """
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    count = 0
+    for chunk in rows:
+        writer.writerows(chunk)
+        count += len(chunk)
+    return count
+
+def write_ndjson(rows: Iterable[List[tuple]], out: IO) -> int:
+    """Write chunks of rows as one JSON object per line.
+
+    Returns:
+        The number of rows written.
+    """
+    count = 0
+    for chunk in rows:
+        out.write(''.join([dump(row) + '\n' for row in chunk]))
+        count += len(chunk)
+    return count
+
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson}
+
+
+##################
+##### Import #####
+##################
+
+def read_csv(f: IO, size: int) -> Iterator[Dict[str, list]]:
+    """Yield the columns of chunks of `size` records of a CSV file with a header line."""
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    count = 0
+    for chunk in chunks(reader, size):
+        invalid = next((i for i, record in enumerate(chunk) if len(record) != len(header)), None)
+        if invalid is not None:
+            raise ValueError('Record {} has {} fields instead of {}.'.format(count + invalid + 1, len(chunk[invalid]), len(header)))
+        count += len(chunk)
+        yield dict(zip(header, map(list, zip(*chunk))))
+
+def read_ndjson(f: IO, size: int) -> Iterator[Dict[str, list]]:
+    """Yield the columns of chunks of `size` records of a file with one JSON object per line."""
+    for chunk in chunks((json.loads(line) for line in f if line.strip()), size):
+        yield {key: [record.get(key) for record in chunk] for key in set().union(*chunk)}
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+BOOLEANS = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False,
+            True: True, False: False}
+
+def parse_bool(value) -> bool:
+    """Parse a boolean as written by the export (True/False) or as 1/0, yes/no."""
+    try:
+        return BOOLEANS[value.lower() if isinstance(value, str) else value]
+    except (KeyError, TypeError):
+        raise ValueError('Invalid boolean {!r}'.format(value))
+
+def convert(values: list, parse: Callable) -> list:
+    """Parse the values of a column, missing values (None or '') become None."""
+    if None in values or '' in values:
+        return [parse(value) if value is not None and value != '' else None for value in values]
+    return list(map(parse, values))
+
+# Parsers of the columns, except for the times
+PARSERS = {'machine_id': str, 'running': parse_bool, 'voltage': float, 'current': float, 'power': float,
+           'total_power': float, 'repeat_count': int}
+
+def parse(columns: Dict[str, list], machine_id: str = None) -> Dict[str, list]:
+    """Return the columns of the `washingmachine` table for a chunk of imported records.
+
+    The times are returned as 'M8[us]' arrays (NaT if missing), the other
+    columns as lists.
+
+    Args:
+        columns: The columns as read from the file, unknown ones are ignored.
+        machine_id: Overrides the machine of the records.
+
+    Raises:
+        ValueError: If a record is invalid.
+    """
+    size = len(next(iter(columns.values())))
+    rows = {}
+    for column in COLUMNS:
+        values = columns.get(column)
+        try:
+            if column in TIMES:
+                rows[column] = np.array(values if values is not None else [None] * size, dtype='M8[us]')
+            else:
+                rows[column] = convert(values, PARSERS[column]) if values is not None else [None] * size
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid {}: {}'.format(column, e))
+    if machine_id:
+        rows['machine_id'] = [machine_id] * size
+    if None in rows['machine_id'] or None in rows['power'] or np.isnat(rows['timestamp']).any():
+        raise ValueError('machine_id, timestamp and power are required.')
+    rows['valid_until'] = np.where(np.isnat(rows['valid_until']), rows['timestamp'], rows['valid_until'])
+    if None in rows['repeat_count']:
+        rows['repeat_count'] = [count if count is not None else 1 for count in rows['repeat_count']]
+    return rows
+
+def split(rows: Dict[str, list]) -> Iterator[Dict[str, list]]:
+    """Yield the columns of the rows of each machine."""
+    ids = rows['machine_id']
+    if ids.count(ids[0]) == len(ids):
+        yield rows
+        return
+    indices = {}
+    for i, machine_id in enumerate(ids):
+        indices.setdefault(machine_id, []).append(i)
+    for index in indices.values():
+        yield {column: values[index] if isinstance(values, np.ndarray) else [values[i] for i in index]
+               for column, values in rows.items()}
+
+
+class Machine:
+    """State of the import of a machine, carried from chunk to chunk."""
+
+    def __init__(self, machine_id: str, config: dict, detect: bool, now: datetime) -> None:
+        self.id = machine_id
+        self.detector = detectors.create(config) if detect else None
+        self.running = None # Running state and last change of the previous row
+        self.last_changed = np.datetime64('NaT', 'us')
+        self.last = None # Time, power and total power of the previous row
+        self.cutoff = now - timedelta(days=config['RAW_RETENTION_DAYS'])
+        self.folded_until = rollup.watermark(WashingMachineMinute, machine_id, rollup.MINUTE)
+        self.archived_until = archive.archived_until(config, machine_id)
+        self.archive = config['ARCHIVE_READINGS']
+        self.refold = None # Range of uncommitted rows in folded minutes
+        self.expiring = 0 # Rows dropped by the next rollup
+
+    def prepare(self, rows: Dict[str, list]) -> None:
+        """Fill in `running`/`last_changed` (with a detector) and missing `total_power` of rows in time order."""
+        t = rows['timestamp'].astype(np.int64) / 1e6
+        if (self.last and t[0] < self.last[0]) or np.any(np.diff(t) < 0):
+            raise ValueError('The readings of {} are not in time order.'.format(self.id))
+        power = np.array(rows['power'])
+
+        if self.detector:
+            running = self.detector.replay(t, power)
+            previous = np.concatenate(([self.running if self.running is not None else not running[0]], running[:-1]))
+            changed = np.maximum.accumulate(np.where(running != previous, np.arange(len(t)), -1))
+            rows['running'] = running.tolist()
+            rows['last_changed'] = np.where(changed >= 0, rows['timestamp'][changed], self.last_changed)
+            self.running = rows['running'][-1]
+            self.last_changed = rows['last_changed'][-1]
+        elif None in rows['running']:
+            raise ValueError('Readings of {} without running state, import them with the detector.'.format(self.id))
+
+        totals = rows['total_power']
+        if None in totals:
+            known = np.array([total is not None for total in totals])
+            if self.last is None:
+                total = 0.0 if known[0] else previous_total(self.id, rows['timestamp'][0].item())
+                self.last = (t[0], power[0], total)
+            seconds, last_power, total = self.last
+            # Energy since the previous row, summed up from the last known total
+            energy = np.cumsum(np.diff(t, prepend=seconds) * np.concatenate(([last_power], power[:-1])) / 3600 / 1000)
+            anchor = np.maximum.accumulate(np.where(known, np.arange(len(t)), -1))
+            anchor_total = np.array([value if value is not None else 0.0 for value in totals])[anchor]
+            integrated = np.where(anchor >= 0, anchor_total - energy[anchor], total) + energy
+            rows['total_power'] = np.where(known, anchor_total, integrated).tolist()
+        self.last = (t[-1], power[-1], rows['total_power'][-1])
+
+    def check(self, rows: Dict[str, list]) -> None:
+        """Refuse rows in time order that wouldn't be folded or archived and remember the ones to fold again."""
+        first, last = rows['timestamp'][0].item(), rows['timestamp'][-1].item()
+        if self.archived_until and first < self.archived_until:
+            raise ValueError('The readings of {} before {:%Y-%m-%d %H:%M:%S} are archived already.'.format(
+                self.id, self.archived_until))
+        if self.folded_until and first < min(self.folded_until, self.cutoff):
+            raise ValueError('The readings of {} before {:%Y-%m-%d %H:%M:%S} are older than RAW_RETENTION_DAYS '
+                             'and the folded minutes, the next rollup would drop them unfolded.'.format(
+                                 self.id, min(self.folded_until, self.cutoff)))
+        if self.folded_until and first < self.folded_until:
+            self.refold = (self.refold[0] if self.refold else first, min(last, self.folded_until))
+        if not self.archive and first < self.cutoff:
+            self.expiring += int(np.count_nonzero(rows['timestamp'] < np.datetime64(self.cutoff, 'us')))
+
+def previous_total(machine_id: str, timestamp: datetime) -> float:
+    """Return the `total_power` (kWh) of the last row of a machine before timestamp, 0 if there is none."""
+    total = (db.session.query(WashingMachine.total_power)
+             .filter(WashingMachine.machine_id == machine_id, WashingMachine.timestamp < timestamp)
+             .order_by(WashingMachine.timestamp.desc())
+             .limit(1)
+             .scalar())
+    return total or 0.0
+
+def delete_range(rows: Dict[str, list]) -> int:
+    """Delete the stored rows of a machine in the time range of the rows (without committing).
+
+    Returns:
+        The number of deleted rows.
+    """
+    table = WashingMachine.__table__
+    return db.session.execute(table.delete().where(table.c.machine_id == rows['machine_id'][0])
+                                            .where(table.c.timestamp >= rows['timestamp'][0].item())
+                                            .where(table.c.timestamp <= rows['timestamp'][-1].item())).rowcount
+
+def insert(rows: Dict[str, list]) -> None:
+    """Insert rows given as parsed columns with one executemany (without committing)."""
+    table = WashingMachine.__table__
+    dialect = db.session.get_bind().dialect
+    if dialect.name == 'sqlite':
+        values = [format_times(rows[column]) if column in TIMES else rows[column] for column in COLUMNS]
+        statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            dialect.identifier_preparer.quote(table.name),
+            ', '.join(map(dialect.identifier_preparer.quote, COLUMNS)), ', '.join('?' * len(COLUMNS)))
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.executemany(statement, zip(*values))
+        except dialect.dbapi.Error as e:
+            # Raised as SQLAlchemy's exceptions, like on other databases
+            raise DBAPIError.instance(statement, None, e, dialect.dbapi.Error)
+        finally:
+            cursor.close()
+    else:
+        values = [rows[column].tolist() if column in TIMES else rows[column] for column in COLUMNS]
+        db.session.execute(table.insert(), [dict(zip(COLUMNS, row)) for row in zip(*values)])
+
+def import_rows(config: dict, batches: Iterable[Dict[str, list]], machine_id: str = None, detect: bool = False,
+                replace: bool = False) -> int:
+    """Insert imported records into the `washingmachine` table (needs an app context).
+
+    Every `TRANSFER_COMMIT_ROWS` rows are committed, an error leaves the
+    rows committed before. Rows in minutes the rollup already folded are
+    folded again before each commit.
+
+    Args:
+        config: The app config.
+        batches: The columns of chunks of records as yielded by a reader.
+        machine_id: Overrides the machine of the records.
+        detect: Recompute `running` and `last_changed` with the detector.
+        replace: Replace stored rows overlapping the imported ones instead
+                 of failing on duplicates.
+
+    Returns:
+        The number of inserted rows.
+
+    Raises:
+        ValueError: On invalid rows or rows that would be dropped unfolded
+                    (see the module docstring).
+    """
+    now = datetime.utcnow()
+    machines = {} # type: Dict[str, Machine]
+    count = uncommitted = 0
+    for columns in batches:
+        try:
+            rows = parse(columns, machine_id)
+        except ValueError as e:
+            raise ValueError('Invalid readings {}-{}: {}'.format(count + 1, count + len(next(iter(columns.values()))), e))
+        for machine_rows in split(rows):
+            machine = machines.get(machine_rows['machine_id'][0])
+            if machine is None:
+                machine = machines[machine_rows['machine_id'][0]] = Machine(machine_rows['machine_id'][0], config,
+                                                                            detect, now)
+            machine.prepare(machine_rows)
+            machine.check(machine_rows)
+            if replace:
+                delete_range(machine_rows)
+            insert(machine_rows)
+        size = len(rows['timestamp'])
+        count += size
+        uncommitted += size
+        if uncommitted >= config['TRANSFER_COMMIT_ROWS']:
+            commit(machines.values())
+            uncommitted = 0
+    commit(machines.values())
+
+    for machine in machines.values():
+        if machine.expiring:
+            current_app.logger.warning('%d readings of %s are older than RAW_RETENTION_DAYS and only kept until '
+                                       'the next rollup folded them (set ARCHIVE_READINGS to keep them).',
+                                       machine.expiring, machine.id)
+    return count
+
+def commit(machines: Iterable[Machine]) -> None:
+    """Fold the uncommitted rows of the machines in already folded minutes again and commit."""
+    for machine in machines:
+        if machine.refold:
+            rollup.refold(machine.id, *machine.refold)
+            machine.refold = None
+    db.session.commit()
@@ -4,193 +4,328 @@
 This module provides the background process to query the status of the 
 washing machine and writing the results to the database as well as
 notifying the users when the washing machine is detected as not running.
+Several machines can be polled concurrently by configuring `SMART_PLUGS`,
+each with its own running detector (see `detectors`). pyHS100 and
+APScheduler are only imported once polling starts.
 
 """
 
-from sqlalchemy import asc, desc, func
-from pyHS100 import SmartPlug, SmartDeviceException
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
-import smtplib
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import atexit
+import time
 
-from .models import User, WashingMachine, db
-from . import telegram_bot as tb
+from .models import WashingMachine, db
+from . import notifications
+from . import rollup
+from . import state
+from .state import plug_config
+from . import recent
+from . import runs
+from . import write_buffer
+from . import detectors
+from . import cycles
+from . import profiles
+from . import stats
+from . import metrics
+from . import simulation
 
 
-def notify_all() -> None:
-    """Notifies all users which are registered to be notified in the database."""
-    # Email
-    app.logger.debug('Notifying users by email...')
-    try:
-        users_email = User.query.filter_by(notify_email=True)
-    except:
-        app.logger.exception("There was an error querying users to be notified via email.")
-        users_email = None
-
-    if users_email:
-        app.logger.debug('Trying to notify %d users via email.', users_email.count())
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
-            try:
-                server.starttls() # Starts the connection
-                server.login(app.config['SMTP_EMAIL'], app.config['SMTP_PASSWORD'])
-                
-                msg = 'Subject: {}\n\n{}'.format(
-                    "The laundry is ready!",
-                    "The time was: {}.\n\n\n---\nThis service is kindly provided by your friendly neighbourhood programmer.".format(datetime.now()))
-                for user in users_email:
-                    try:
-                        server.sendmail(app.config['SMTP_EMAIL'], user.email, msg)
-                        user.notify_email = False # Only notify once     
-                    except smtplib.SMTPRecipientsRefused as e:
-                        app.logger.excpetion("Recipient refused. Is the Email of user %s (%s) correct? %s", user.username, user.name, user.email)
-                db.session.commit()
-            except smtplib.SMTPHeloError as e:
-                app.logger.exception("Couldn't start a connection with the SMTP server!")
-            except smtplib.SMTPAuthenticationError as e:
-                app.logger.exception("SMTP credentials are wrong! %s:%s", app.config['SMTP_EMAIL'], app.config['SMTP_PASSWORD'])
-            except Exception as e:
-                app.logger.exception("There was an unexpected exception while sending notification emails!")
-    else:
-        app.logger.debug('No user wanted to be notified via email.')
+# Plugs have to answer within this fraction of POLL_INTERVAL, leaving the
+# rest of the tick for writing the readings, so the next tick isn't skipped
+PLUG_TIMEOUT = 0.8
+
+
+def notify_all(machine: Machine = None) -> None:
+    """Queues a notification for all users registered to be notified in the database.
+
+    The notifications are sent by the dispatcher in the background (see
+    `notifications`), so polling isn't held up by slow SMTP or Telegram
+    servers.
+
+    Args:
+        machine: The machine that finished. Its id is mentioned in the
+                 notification if more than one machine is polled.
+    """
+    ready = "The laundry is ready!"
+    if machine and len(machines) > 1:
+        ready = "The laundry in {} is ready!".format(machine.id)
 
-    # Telegram
     try:
-        users_telegram = User.query.filter_by(notify_telegram=True)
+        count = notifications.enqueue(ready, datetime.utcnow(), app.config)
+        app.logger.debug('Queued %d notifications.', count)
     except Exception as e:
-        app.logger.exception("There was an error querying users to be notified via telegram.")
-        users_telegram = None
+        db.session.rollback()
+        app.logger.exception("There was an error queueing the notifications.")
+    notifications.dispatcher.wake()
 
-    if users_telegram:
-        app.logger.debug("Trying to notify %d users via telegram...", users_telegram.count())
-        for user in users_telegram:
-            try:
-                tb.updater.bot.send_message(chat_id=user.telegram_chat_id, text="The laundry is ready!")
-                user.notify_telegram = False # Only notify once
-            except:
-                app.logger.exception("There was an error sending telegram notifications to %s (%s)!", user.username, user.name)
-        try:
-            db.session.commit()
-        except:
-            app.logger.exception("There was an error writing to the database.")
+class Machine:
+    """A single polled washing machine with its own running detection state."""
+
+    def __init__(self, machine_id: str, ip: str) -> None:
+        self.id = machine_id
+        self.ip = ip
+        if ip.startswith('sim:'):
+            self.plug = simulation.plug(ip, app.config)
+        else:
+            from pyHS100 import SmartPlug
+            self.plug = SmartPlug(ip)
+        self.detector = detectors.create(app.config)
+        self.cycles = cycles.CycleTracker(machine_id, app.config['RUNNING_THRESHOLD_POWER'])
+        self.trace = None # Power trace of the running cycle (see `profiles`)
+        self.changed = False # Running state changed with the latest reading
+        self.stopped = False # Detected as stopped with the latest reading
+        self.pending = None # Future of a plug query that has not finished yet
+        self.run = None # Newest row of the machine, extended with change-only storage
+        self.run_synced = None # Time the extension of the run was last written back
+        self.interval = app.config['POLL_INTERVAL'] # Seconds until the next query (adaptive polling)
+        self.next_poll = None # Time of the next query, None to query on the next tick
+
+    @property
+    def running(self) -> bool:
+        return self.detector.running
+
+    def schedule(self, now: datetime, power: float) -> None:
+        """Choose when to query the plug next.
+
+        With `ADAPTIVE_POLLING`, the interval grows by `POLL_BACKOFF` with
+        every idle reading up to `POLL_INTERVAL_MAX`. It drops back to
+        `POLL_INTERVAL` while the machine is running or the power is near
+        `RUNNING_THRESHOLD_POWER`.
+        """
+        config = app.config
+        if (not config['ADAPTIVE_POLLING'] or self.running
+                or power >= config['RUNNING_THRESHOLD_POWER'] * config['POLL_NEAR_THRESHOLD']):
+            self.interval = config['POLL_INTERVAL']
+        else:
+            self.interval = min(self.interval * config['POLL_BACKOFF'], config['POLL_INTERVAL_MAX'])
+        # Ticks are POLL_INTERVAL apart, take the first tick after the interval has (almost) passed
+        self.next_poll = now + timedelta(seconds=self.interval - config['POLL_INTERVAL'] / 2)
+
+    def due(self, now: datetime) -> bool:
+        """Check whether the plug should be queried in the tick at `now`."""
+        return self.next_poll is None or now >= self.next_poll
+
+    def query(self) -> dict:
+        """Query the emeter of the plug (runs in a worker thread)."""
+        with metrics.plug_seconds.time(self.id):
+            return self.plug.get_emeter_realtime()
+
+    def detect(self, now: datetime, power: float) -> None:
+        """Update the running state with a new power reading (in Watts)."""
+        was_running = self.running
+        self.detector.update(detectors.seconds(now), power)
+        if self.running != was_running:
+            app.logger.debug("Washing Machine %s was thought of as %s, but is actually %s.", self.id,
+                             "running" if was_running else "turned off",
+                             "running" if self.running else "turned off")
+        else:
+            app.logger.debug("Washing Machine %s is thought of as %s (Power %.1f W).", self.id,
+                             "running" if self.running else "turned off", power)
+
+
+def update_machine(machine: Machine, now: datetime, emeter: dict) -> state.Snapshot:
+    """Update the detector state of a machine with a reading and buffer it.
+
+    Returns:
+        The snapshot of the new reading.
+    """
+    machine.detect(now, emeter['power_mw']/1000)
+    machine.schedule(now, emeter['power_mw']/1000)
+
+    last = state.latest.get(machine.id)
+    last = last.reading if last else None
+    if last and last['running'] == machine.running and last['last_changed']:
+        last_changed = last['last_changed']
     else:
-        app.logger.debug("No user wanted to be notified via telegram.")
-
-def createEmptyWashingMachine(now: datetime) -> WashingMachine:
-    """Creates an default entry for the Database with the given timestamp."""
-    return WashingMachine(timestamp=now,
-                          running=False,
-                          last_changed=None,
-                          voltage=0,
-                          current=0,
-                          power=0,
-                          total_power=0)
+        last_changed = now
+
+    washing_machine = WashingMachine(machine_id=machine.id,
+                                     timestamp=now,
+                                     running=machine.running,
+                                     last_changed=last_changed,
+                                     voltage=emeter['voltage_mv']/1000,
+                                     current=emeter['current_ma']/1000,
+                                     power=emeter['power_mw']/1000,
+                                     total_power=emeter['total_wh']/1000,
+                                     valid_until=now,
+                                     repeat_count=1)
+
+    if app.config['CHANGE_ONLY_STORAGE'] and machine.run and runs.within_deadband(machine.run, washing_machine, app.config):
+        runs.extend(machine.run, washing_machine)
+        if (now - machine.run_synced).total_seconds() >= app.config['RUN_SYNC_INTERVAL']:
+            write_buffer.buffer.update(machine.run)
+            machine.run_synced = now
+        app.logger.debug("Extended current run of %s to %d readings.", machine.id, machine.run['repeat_count'])
+    else:
+        if machine.run:
+            write_buffer.buffer.update(machine.run) # Close the previous run
+        machine.run = runs.as_dict(washing_machine)
+        machine.run_synced = now
+        write_buffer.buffer.insert(machine.run)
+        app.logger.debug("Successfully buffered emeter measurement of %s: %s", machine.id, washing_machine)
+
+    stats.usage.add_reading(machine.id, now, machine.running, washing_machine.total_power,
+                            app.config['STATS_MAX_GAP'])
+    event = machine.cycles.update(now, washing_machine.power, washing_machine.total_power, machine.running)
+    if event:
+        cycles.record(event)
+        kind, cycle = event
+        if kind == cycles.STARTED:
+            machine.trace = profiles.begin(cycle, app.config)
+        else:
+            stats.usage.add_cycle(cycle)
+            if machine.trace:
+                profiles.record(machine.trace, cycle, app.config)
+            machine.trace = None
+
+    remaining = None
+    if machine.trace:
+        machine.trace.add(now, washing_machine.power)
+        remaining = profiles.remaining(machine.id, machine.trace, now, app.config)
+
+    machine.changed = bool(last and last['running'] != machine.running) or bool(event)
+    machine.stopped = bool(last and last['running'] == True != machine.running)
+    return state.snapshot(washing_machine, remaining)
 
 def update_washing_mashine() -> None:
-    """Querying the washing machine to get the current status and update the
-    database with the new values."""
+    """Querying all washing machines to get their current status and update the
+    database with the new values.
+
+    The smart plugs are queried concurrently, so a slow or unreachable plug
+    doesn't delay the readings of the other machines. Plugs that don't
+    answer within `PLUG_TIMEOUT * POLL_INTERVAL` are treated as failed for
+    this tick (their query is picked up in a later one). With
+    adaptive polling, only the machines that are due are queried.
+    """
+    from pyHS100 import SmartDeviceException
+
+    started = time.perf_counter()
     with app.app_context():
-        global counter
-        global running
         now = datetime.utcnow()
-        last = None
+        snapshots = {}
 
-        # Try to get a reading. If it fails, enter default values into the database.
-        try:
-            # TODO: Log when no connection.
-            app.logger.debug('Querying emeter of TP-Link Smartplug...')
-            emeter = plug.get_emeter_realtime()
-            app.logger.debug('Finished querying emeter: %s', emeter)
-            if running:
-                app.logger.debug("Washing Machine is thought as running...")
-                if emeter['power_mw']/1000 < app.config['RUNNING_THRESHOLD_POWER']: # Threshold for running/idle
-                    counter += 1
-                    app.logger.debug("Washing Machine is not running at this very moment (Power below threshold). Increasing counter by 1. Current counter: %d", counter)
-                else:
-                    counter = 0
-                    app.logger.debug("Washing Machine is running at this very moment (Power above threshold). Resetting counter: %d", counter)
-
-                if counter > app.config['RUNNING_THRESHOLD_TICKS']: # Washing machine inactive for more than RUNNING_THRESHOLD_TICKS measurments (4 min)
-                    counter = 0
-                    running = False
-                    app.logger.debug("Washing Machine was thought of running, but is actually turned off. Counter %d. Running %s.", counter, running)
-                
+        polled = [machine for machine in machines.values() if machine.pending is not None or machine.due(now)]
+        app.logger.debug('Querying emeters of %d TP-Link Smartplugs...', len(polled))
+        for machine in polled:
+            if machine.pending is None:
+                machine.pending = executor.submit(machine.query)
             else:
-                app.logger.debug("Washing Machine is thought of as turned off...")
-                if emeter['power_mw']/1000 > app.config['RUNNING_THRESHOLD_POWER']:
-                    running = True
-                    app.logger.debug("Washing Machine was thought of as turned off, but is actually running. Running %s", running)
-                else:
-                    app.logger.debug("Washing machine is off at this very moment (Power below threshold).")
+                app.logger.warning("Previous query of TP-Link Smartplug %s on %s hasn't finished yet.", machine.id, machine.ip)
+        wait([m.pending for m in polled], timeout=app.config['POLL_INTERVAL'] * PLUG_TIMEOUT)
 
-            last = WashingMachine.query.order_by(desc('timestamp')).first()
-            if last and last.running == running and last.last_changed:
-                last_changed = last.last_changed
-            else:
-                last_changed = now
-
-            washing_machine = WashingMachine(timestamp=now,
-                                            running=running,
-                                            last_changed=last_changed,
-                                            voltage=emeter['voltage_mv']/1000,
-                                            current=emeter['current_ma']/1000,
-                                            power=emeter['power_mw']/1000,
-                                            total_power=emeter['total_wh']/1000)
-
-            db.session.add(washing_machine)
-            db.session.flush()
-            app.logger.debug("Successfully added emeter measurement to the database: %s", washing_machine)
-
-        except SmartDeviceException as e:
-            if e.args and e.args[0] == 'Communication error':
-                app.logger.error("Couldn't connect to TP-Link Smartplug on %s", app.config['SMART_PLUG_IP'])
-            else:
-                app.logger.exception('Error querying the emeter of the TP-Link Smartplug.')
-            washing_machine = createEmptyWashingMachine(now)
+        for machine in polled:
+            if not machine.pending.done():
+                app.logger.error("TP-Link Smartplug %s on %s didn't answer in time.", machine.id, machine.ip)
+                metrics.plug_errors.inc(machine.id, 'timeout')
+                continue
 
-        except Exception as e:
-            app.logger.exception('Error adding emeter measurement to the database.')
-            washing_machine = createEmptyWashingMachine(now)
+            future, machine.pending = machine.pending, None
+            # Try to get a reading. If it fails, no entry is added to the database.
+            try:
+                emeter = future.result()
+                app.logger.debug('Finished querying emeter of %s: %s', machine.id, emeter)
+                snapshots[machine.id] = update_machine(machine, now, emeter)
 
-        # Restrict size of db
-        count = db.session.query(func.count(WashingMachine.timestamp)).scalar()
+            except SmartDeviceException as e:
+                if e.args and e.args[0] == 'Communication error':
+                    app.logger.error("Couldn't connect to TP-Link Smartplug %s on %s", machine.id, machine.ip)
+                    metrics.plug_errors.inc(machine.id, 'communication')
+                else:
+                    app.logger.exception('Error querying the emeter of the TP-Link Smartplug %s.', machine.id)
+                    metrics.plug_errors.inc(machine.id, 'device')
+
+            except Exception as e:
+                app.logger.exception('Error adding emeter measurement of %s to the database.', machine.id)
 
-        if count > 6307200: # delete oldest, when limit (one year; 6.307.200 rows (5sec interval), 50MB?) is reached
-            washing_machine = WashingMachine.query.order_by(asc('timestamp')).first()
-            db.session.delete(washing_machine)
-        
-        if count > 6400000: # Just to be sure..?
-            db.session.query(WashingMachine).delete()
+        for snapshot in snapshots.values():
+            state.latest.publish(snapshot)
+            recent.append(snapshot.reading)
 
-        db.session.commit()
+        # Write the buffered readings in bulk, right away on state changes
+        write_buffer.buffer.tick(now)
+        changed = any(machines[machine_id].changed for machine_id in snapshots)
+        if changed or write_buffer.buffer.due(now, app.config):
+            flush_buffer()
 
         # Notify when Washing Mashine is finished
-        if last and last.running == True != running:
-            notify_all()
+        for machine_id in snapshots:
+            if machines[machine_id].stopped:
+                notify_all(machines[machine_id])
 
-def init_app(flask_app):
-    """Initialize the background poller and start the scheduler."""
-    flask_app.logger.debug("Setting up wm_poller...")
+    elapsed = time.perf_counter() - started
+    metrics.tick_seconds.observe(elapsed)
+    if elapsed > app.config['POLL_INTERVAL']:
+        app.logger.warning('Poll tick took %.1fs, longer than the poll interval.', elapsed)
+        metrics.tick_overruns.inc()
+
+def update_rollups() -> None:
+    """Fold older readings into the rollup tiers and expire old rows."""
+    with app.app_context():
+        now = datetime.utcnow()
+        for machine in machines.values():
+            try:
+                rollup.rollup(machine.id, now, app.config)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception('Error rolling up the readings of %s.', machine.id)
+
+def flush_buffer() -> None:
+    """Write all buffered readings and usage statistics to the database."""
+    with app.app_context():
+        rows = write_buffer.buffer.take()
+        deltas = stats.usage.take()
+        try:
+            hours = stats.usage.write(deltas) # Committed together with the readings
+            count = write_buffer.buffer.write(rows)
+            db.session.commit()
+            app.logger.debug("Wrote %d buffered readings and %d hours of statistics to the database.", count, hours)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Error writing buffered readings to the database, retrying with the next tick.")
+            stats.usage.restore(deltas)
+            dropped = write_buffer.buffer.restore(rows, app.config['WRITE_BUFFER_MAX_ROWS'])
+            if dropped:
+                app.logger.error("Dropped the %d oldest buffered readings, the buffer is full.", dropped)
+
+def shutdown() -> None:
+    """Hand the open runs of all machines to the buffer and flush it."""
+    for machine in machines.values():
+        if machine.run:
+            write_buffer.buffer.update(machine.run)
+    flush_buffer()
+
+def configure(flask_app) -> None:
+    """Set up the machines to poll without starting the scheduler (e.g. for benchmarks)."""
     global app
     app = flask_app
 
-    global plug
-    plug = SmartPlug(flask_app.config['SMART_PLUG_IP'])
+    global machines
+    machines = OrderedDict((plug['id'], Machine(plug['id'], plug['ip']))
+                           for plug in plug_config(flask_app.config))
 
-    global counter
-    counter = 0
+    global executor
+    executor = ThreadPoolExecutor(max_workers=min(flask_app.config['POLL_WORKERS'], len(machines)))
 
-    global running
-    running = False
+def init_app(flask_app):
+    """Initialize the background poller and start the scheduler."""
+    flask_app.logger.debug("Setting up wm_poller...")
+    configure(flask_app)
 
-    # Run update task in the background
-    # TODO: Run this only once, even when run with multiple worker threads in gunicorn
-    flask_app.logger.debug("Starting wm_poller background task...")
+    # Run update task in the background (only in the leader process, see `leader`)
+    from apscheduler.schedulers.background import BackgroundScheduler
+    flask_app.logger.debug("Starting wm_poller background task for %d machines...", len(machines))
     scheduler = BackgroundScheduler()
     scheduler.add_job(func=update_washing_mashine, trigger="interval", seconds=flask_app.config['POLL_INTERVAL'])
+    scheduler.add_job(func=update_rollups, trigger="interval", seconds=flask_app.config['ROLLUP_INTERVAL'])
     scheduler.start()
     flask_app.logger.debug("Started wm_poller background task.")
 
-    # Shut down the scheduler when exiting the app
+    # Shut down the scheduler when exiting the app, then flush the buffered readings
+    atexit.register(shutdown)
     atexit.register(lambda: scheduler.shutdown())
-    flask_app.logger.debug("Setup wm_poller.")
\ No newline at end of file
+    atexit.register(lambda: executor.shutdown(wait=False))
+    flask_app.logger.debug("Setup wm_poller.")
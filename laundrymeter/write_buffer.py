@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Write-behind buffer for readings
+
+Instead of committing every reading on its own, the poller collects new rows
+and run extensions here and writes them with a single bulk insert/update per
+flush. The poller flushes every `WRITE_BUFFER_TICKS` ticks, after
+`WRITE_BUFFER_SECONDS` seconds, on every running/stopped transition and on
+shutdown. Notifications and status reads use the in-memory state, so they
+aren't delayed by the buffer. If a write fails (e.g. the database is
+locked), the rows are put back and written with the next tick, keeping at
+most `WRITE_BUFFER_MAX_ROWS` new rows.
+
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+from .models import WashingMachine, db
+from . import runs
+
+
+class WriteBuffer:
+    """Thread safe buffer of rows and run extensions not written yet."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._inserts = OrderedDict()
+        self._updates = OrderedDict()
+        self._ticks = 0
+        self._since = None
+        self._retry = False # The last write failed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._inserts) + len(self._updates)
+
+    def insert(self, row: dict) -> None:
+        """Buffer a new row of the `washingmachine` table."""
+        with self._lock:
+            self._inserts[(row['machine_id'], row['timestamp'])] = dict(row)
+
+    def update(self, run: dict) -> None:
+        """Buffer the extension of a run, replacing earlier extensions of it."""
+        key = (run['machine_id'], run['timestamp'])
+        with self._lock:
+            if key in self._inserts:
+                # The run hasn't been inserted yet, so insert it extended.
+                self._inserts[key].update(run)
+            else:
+                self._updates[key] = dict(run)
+
+    def tick(self, now: datetime) -> None:
+        """Count a poll tick for the flush policy."""
+        with self._lock:
+            self._ticks += 1
+            if self._since is None:
+                self._since = now
+
+    def due(self, now: datetime, config: dict) -> bool:
+        """Check whether the buffer should be flushed according to the config."""
+        with self._lock:
+            if not self._inserts and not self._updates:
+                return False
+            return (self._retry or self._ticks >= config['WRITE_BUFFER_TICKS']
+                    or (now - self._since).total_seconds() >= config['WRITE_BUFFER_SECONDS'])
+
+    def take(self) -> tuple:
+        """Take all buffered rows out of the buffer to write them.
+
+        Returns:
+            The inserted rows and the run extensions, to be passed to
+            `write` and, if that fails, to `restore`.
+        """
+        with self._lock:
+            inserts, self._inserts = self._inserts, OrderedDict()
+            updates, self._updates = self._updates, OrderedDict()
+            self._ticks = 0
+            self._since = None
+            self._retry = False
+        return inserts, updates
+
+    def write(self, rows: tuple) -> int:
+        """Write rows taken from the buffer (needs an app context, doesn't commit).
+
+        Returns:
+            The number of rows inserted or updated.
+        """
+        inserts, updates = rows
+        if inserts:
+            db.session.execute(WashingMachine.__table__.insert(), list(inserts.values()))
+        runs.sync(list(updates.values()))
+        return len(inserts) + len(updates)
+
+    def restore(self, rows: tuple, max_rows: int) -> int:
+        """Put rows back in front of the buffer after their write failed, to retry with the next tick.
+
+        If more than `max_rows` new rows are buffered then (the database has
+        been failing for a while), the oldest ones are dropped.
+
+        Returns:
+            The number of dropped rows.
+        """
+        inserts, updates = rows
+        with self._lock:
+            for key, row in self._inserts.items():
+                inserts[key] = row
+            for key, run in self._updates.items():
+                if key in inserts:
+                    inserts[key].update(run) # Extension of a run whose insert failed
+                else:
+                    updates[key] = run
+            dropped = 0
+            while len(inserts) > max_rows:
+                inserts.popitem(last=False)
+                dropped += 1
+            self._inserts, self._updates = inserts, updates
+            self._retry = True
+        return dropped
+
+buffer = WriteBuffer()
@@ -1,4 +1,5 @@
 #!/bin/bash
 export FLASK_ENV=development
 export FLASK_APP=laundrymeter
+export LAUNDRYMETER_ROLES=api,poller,bot
 pipenv run flask run --no-reload -p 8000
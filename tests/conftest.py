@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""Fixtures shared by the tests of the storage modules"""
+
+import pytest
+
+from laundrymeter import create_app, db_helper
+
+
+@pytest.fixture
+def app(tmpdir):
+    """An app without any roles on an empty database, within an app context."""
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmpdir / 'db.sqlite'),
+                      'ARCHIVE_PATH': str(tmpdir / 'archive'),
+                      'STATE_PATH': str(tmpdir / 'state'),
+                      'METRICS_PATH': str(tmpdir / 'metrics'),
+                      'TESTING': True}, roles=())
+    with app.app_context():
+        db_helper.init_db()
+        yield app
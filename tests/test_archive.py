@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Segments of the columnar archive"""
+
+from datetime import datetime, timedelta
+import os
+
+from laundrymeter import archive
+from laundrymeter.models import WashingMachine, db
+
+
+START = datetime(2018, 10, 1)
+END = START + timedelta(hours=1)
+
+
+def add_readings(count):
+    for i in range(count):
+        timestamp = START + timedelta(seconds=5 * i)
+        db.session.add(WashingMachine(machine_id='default', timestamp=timestamp, running=False, last_changed=START,
+                                      voltage=230, current=0.1, power=float(i), total_power=0.001 * i,
+                                      valid_until=timestamp, repeat_count=1))
+    db.session.commit()
+
+
+def test_interrupted_archive(app):
+    add_readings(100)
+    segment = archive.archive(app.config, 'default', START, END)
+    os.rename(segment.path, segment.path + '.tmp') # Crashed right before the rename
+
+    assert archive.segments(app.config, 'default') == []
+    assert archive.archived_until(app.config, 'default') is None
+
+    segment = archive.archive(app.config, 'default', START, END)
+    assert segment.count == 100
+    assert not os.path.exists(segment.path + '.tmp')
+    assert [s.path for s in archive.segments(app.config, 'default')] == [segment.path]
+    assert archive.load(app.config, 'default', START, END)['power'].tolist() == list(range(100))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Sharing the ring buffer of the newest readings between processes"""
+
+from datetime import datetime, timedelta
+import multiprocessing
+
+import pytest
+
+from laundrymeter import recent
+
+
+START = datetime(2018, 10, 1, 12)
+
+
+def reading(i):
+    return {'machine_id': 'default', 'timestamp': START + timedelta(seconds=10 * i), 'running': i % 2,
+            'last_changed': None, 'voltage': 230.0, 'current': 0.5, 'power': float(i), 'total_power': 7.0}
+
+def poll(count):
+    for i in range(count):
+        recent.append(reading(i))
+
+
+@pytest.fixture
+def shared(tmpdir, monkeypatch):
+    monkeypatch.setattr(recent, 'path', str(tmpdir))
+    monkeypatch.setattr(recent, 'capacity', 8)
+    monkeypatch.setattr(recent, 'buffers', {})
+
+
+def test_other_process(shared):
+    process = multiprocessing.get_context('fork').Process(target=poll, args=(20,))
+    process.start()
+    process.join()
+
+    assert [r['power'] for r in recent.get('default').newest(3)] == [19.0, 18.0, 17.0]
+    readings, complete = recent.get('default').between(START + timedelta(seconds=150))
+    assert [r['power'] for r in readings] == [15.0, 16.0, 17.0, 18.0, 19.0]
+    assert complete
+    assert not recent.get('default').between(START)[1]
+
+def test_new_poller(shared):
+    poll(3)
+    attached = recent.RingBuffer.attach('default', recent.filename('default'))
+    assert len(attached) == 3
+
+    recent.buffers = {'default': attached}
+    recent.append(reading(5)) # Took over polling, starts with an empty buffer
+    assert not attached.current()
+    assert [r['power'] for r in recent.get('default').newest(8)] == [5.0]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Query parameters of the REST API"""
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+import json
+
+import pytest
+
+from laundrymeter import create_app, db_helper
+from laundrymeter.models import User, WashingMachine, db
+
+
+HEADERS = {'Authorization': 'Basic ' + b64encode(b'token-alice:unused').decode()}
+START = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1) # Raw readings are only served while retained
+
+
+@pytest.fixture
+def client(tmpdir):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmpdir / 'db.sqlite'),
+                      'ARCHIVE_PATH': str(tmpdir / 'archive'),
+                      'STATE_PATH': str(tmpdir / 'state'),
+                      'METRICS_PATH': str(tmpdir / 'metrics'),
+                      'TESTING': True}, roles=('api',))
+    with app.app_context():
+        db_helper.init_db()
+        db.session.add(User(username='alice', name='Alice', email='alice@example.org', auth_token='token-alice'))
+        db.session.commit()
+    return app.test_client()
+
+
+@pytest.mark.parametrize('path', ['/api/machine/history', '/api/stats/', '/api/stats/daily'])
+@pytest.mark.parametrize('start', ['2018-10-01T00:00:00+02:00', '2018-10-01T00:00:00Z', '2018-10-01 00:00:00'])
+def test_timestamps(client, path, start):
+    response = client.get(path, query_string={'from': start, 'to': '2018-10-02T00:00:00+00:00'}, headers=HEADERS)
+    assert response.status_code == 200
+
+def test_unencoded_offset(client):
+    response = client.get('/api/machine/history?from=2018-10-01T00:00:00+02:00', headers=HEADERS)
+    assert response.status_code == 200
+
+def test_invalid_timestamp(client):
+    response = client.get('/api/machine/history', query_string={'from': 'yesterday'}, headers=HEADERS)
+    assert response.status_code == 400
+
+
+def add_readings(client, count):
+    with client.application.app_context():
+        for i in range(count):
+            timestamp = START + timedelta(seconds=10 * i)
+            db.session.add(WashingMachine(machine_id='default', timestamp=timestamp, running=False,
+                                          last_changed=START, voltage=230, current=0.1, power=float(i),
+                                          total_power=0.001 * i, valid_until=timestamp, repeat_count=1))
+        db.session.commit()
+
+def history(client, **params):
+    params = {key: value.isoformat() if isinstance(value, datetime) else value for key, value in params.items()}
+    response = client.get('/api/machine/history', query_string=params, headers=HEADERS)
+    assert response.status_code == 200
+    return response
+
+def test_history_range(client):
+    add_readings(client, 30)
+    rows = json.loads(history(client, **{'from': START + timedelta(seconds=50),
+                                         'to': START + timedelta(seconds=100)}).get_data(as_text=True))
+    assert [row['power'] for row in rows] == [5.0, 6.0, 7.0, 8.0, 9.0]
+    assert rows[0]['timestamp'].startswith((START + timedelta(seconds=50)).isoformat()) # Older marshmallow adds +00:00
+
+def test_history_continuation(client):
+    add_readings(client, 30)
+    powers = []
+    after = None
+    while True:
+        params = {'from': START, 'to': START + timedelta(minutes=10), 'limit': 7}
+        if after:
+            params['after'] = after
+        rows = json.loads(history(client, **params).get_data(as_text=True))
+        if not rows:
+            break
+        assert len(rows) <= 7
+        powers += [row['power'] for row in rows]
+        after = rows[-1]['timestamp']
+    assert powers == [float(i) for i in range(30)]
+
+def test_history_ndjson(client):
+    add_readings(client, 3)
+    response = history(client, **{'from': START, 'to': START + timedelta(minutes=1), 'format': 'ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    body = response.get_data(as_text=True)
+    assert body.endswith('\n')
+    rows = [json.loads(line) for line in body.splitlines()]
+    assert [row['power'] for row in rows] == [0.0, 1.0, 2.0]
+    assert rows[0]['machine_id'] == 'default'
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Folding raw readings into minute and hour rollups"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from laundrymeter import rollup
+from laundrymeter.models import WashingMachine, WashingMachineMinute, WashingMachineHour, db
+
+
+START = datetime(2018, 10, 1)
+
+
+def add_readings(count, first=0):
+    """Add readings every 10 s with power i, running from reading 200 on and 1 Wh per reading."""
+    for i in range(first, first + count):
+        timestamp = START + timedelta(seconds=10 * i)
+        db.session.add(WashingMachine(machine_id='default', timestamp=timestamp, running=i >= 200,
+                                      last_changed=START, voltage=230, current=0.1, power=float(i),
+                                      total_power=0.001 * i, valid_until=timestamp, repeat_count=1))
+    db.session.commit()
+
+def buckets(model):
+    return {row.timestamp: row for row in model.query.filter_by(machine_id='default')}
+
+
+def test_rollup(app):
+    add_readings(720) # Two hours
+    rollup.rollup('default', START + timedelta(hours=3), app.config)
+
+    minutes = buckets(WashingMachineMinute)
+    assert len(minutes) == 120
+    minute = minutes[START + timedelta(minutes=33)] # Readings 198 to 203
+    assert (minute.samples, minute.power_min, minute.power_max) == (6, 198, 203)
+    assert minute.power_mean == pytest.approx(200.5)
+    assert minute.energy == pytest.approx(0.006)
+    assert minute.running_fraction == pytest.approx(4 / 6)
+    assert minutes[START].energy == pytest.approx(0.005) # No reading before the first one
+
+    hours = buckets(WashingMachineHour)
+    assert sorted(hours) == [START, START + timedelta(hours=1)]
+    assert (hours[START].samples, hours[START].power_min, hours[START].power_max) == (360, 0, 359)
+    assert hours[START].power_mean == pytest.approx(179.5)
+    assert hours[START].energy == pytest.approx(0.359)
+    assert hours[START].running_fraction == pytest.approx(160 / 360)
+    assert hours[START + timedelta(hours=1)].running_fraction == pytest.approx(1.0)
+
+def test_lag(app):
+    add_readings(720)
+    now = START + timedelta(hours=1)
+    rollup.rollup('default', now, app.config)
+
+    # Readings that may still be buffered aren't folded, the hour isn't complete
+    assert rollup.watermark(WashingMachineMinute, 'default', rollup.MINUTE) == rollup.floor_time(
+        now - rollup.lag(app.config), rollup.MINUTE)
+    assert not buckets(WashingMachineHour)
+
+def test_expire_unfolded(app):
+    add_readings(300)
+    # A change-only run reaching past the folded minutes
+    db.session.add(WashingMachine(machine_id='default', timestamp=START + timedelta(seconds=3000), running=True,
+                                  last_changed=START, voltage=230, current=0.1, power=300.0, total_power=0.4,
+                                  valid_until=START + timedelta(seconds=3600), repeat_count=61))
+    db.session.commit()
+    rollup.rollup('default', START + timedelta(hours=1), app.config)
+    folded_until = rollup.watermark(WashingMachineMinute, 'default', rollup.MINUTE)
+    minutes = len(buckets(WashingMachineMinute))
+
+    rollup.expire('default', START + timedelta(days=100), app.config) # Past the retention of every tier
+    db.session.commit()
+
+    remaining = WashingMachine.query.order_by(WashingMachine.timestamp).all()
+    assert remaining and all(row.valid_until >= folded_until for row in remaining)
+    assert remaining[0].timestamp == START + timedelta(seconds=3000)
+    assert len(buckets(WashingMachineMinute)) == minutes # No hour folded yet
+
+def test_refold(app):
+    add_readings(30, first=0)
+    add_readings(30, first=31) # Reading 30 is missing
+    rollup.rollup('default', START + timedelta(hours=1), app.config)
+    assert buckets(WashingMachineMinute)[START + timedelta(minutes=5)].samples == 5
+
+    add_readings(1, first=30)
+    rollup.refold('default', START + timedelta(seconds=300), START + timedelta(seconds=300))
+    minute = buckets(WashingMachineMinute)[START + timedelta(minutes=5)]
+    assert minute.samples == 6
+    assert minute.power_mean == pytest.approx(32.5)
+    assert minute.energy == pytest.approx(0.006)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Change-only storage of readings"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from laundrymeter import history, rollup, runs, write_buffer
+from laundrymeter.models import WashingMachine, WashingMachineMinute, WashingMachineHour, db
+
+
+START = datetime(2018, 10, 1)
+STEP = timedelta(seconds=10)
+
+
+def readings(machine_id):
+    """Two hours of readings: idle, a cycle at 500 W and 800 W, idle again."""
+    total = 1.0
+    last_changed = START
+    for i in range(720):
+        power = 500.0 if 200 <= i < 300 else 800.0 if 300 <= i < 500 else 0.0
+        total += power * STEP.total_seconds() / 3600 / 1000
+        if i in (200, 500):
+            last_changed = START + STEP * i
+        yield {'machine_id': machine_id, 'timestamp': START + STEP * i, 'running': power > 10,
+               'last_changed': last_changed, 'voltage': 230.0, 'current': power / 230, 'power': power,
+               'total_power': total, 'valid_until': START + STEP * i, 'repeat_count': 1}
+
+def store(machine_id, config, change_only):
+    """Store the readings like the poller does, flushing the write buffer every minute."""
+    buffer = write_buffer.WriteBuffer()
+    run = None
+    for i, reading in enumerate(readings(machine_id)):
+        washing_machine = WashingMachine(**reading)
+        if change_only and run and runs.within_deadband(run, washing_machine, config):
+            runs.extend(run, washing_machine)
+            buffer.update(run)
+        else:
+            if run:
+                buffer.update(run)
+            run = runs.as_dict(washing_machine)
+            buffer.insert(run)
+        if i % 6 == 5:
+            buffer.write(buffer.take())
+            db.session.commit()
+    buffer.update(run)
+    buffer.write(buffer.take())
+    db.session.commit()
+
+def values(row):
+    return {column: value for column, value in row.items() if column != 'machine_id'}
+
+def rollups(model, machine_id):
+    return [(row.timestamp, row.samples, row.power_min, row.power_max, row.power_mean, row.running_fraction,
+             row.energy) for row in model.query.filter_by(machine_id=machine_id).order_by(model.timestamp)]
+
+def approx_energy(rows):
+    return [row[:-1] + (pytest.approx(row[-1]),) for row in rows]
+
+
+@pytest.fixture
+def stored(app):
+    store('runs', app.config, change_only=True)
+    store('dense', app.config, change_only=False)
+
+def test_expand(stored):
+    rows = WashingMachine.query.filter_by(machine_id='runs').order_by(WashingMachine.timestamp).all()
+    assert [row.repeat_count for row in rows] == [200, 100, 200, 220]
+
+    expanded = []
+    previous_total = 1.0
+    for row in rows:
+        expanded.extend(runs.expand(runs.as_dict(row), previous_total))
+        previous_total = row.total_power
+    original = list(readings('runs'))
+    assert [dict(reading, total_power=pytest.approx(reading['total_power'])) for reading in expanded] == original
+
+def test_same_as_dense(app, stored):
+    end = START + timedelta(hours=3)
+    dense = [values(reading) for reading in history.iter_readings(WashingMachine, 'dense', START, end)]
+    assert len(dense) == 720
+    assert [values(reading) for reading in history.iter_readings(WashingMachine, 'runs', START, end)] == [
+        dict(reading, total_power=pytest.approx(reading['total_power'])) for reading in dense]
+
+    for machine_id in ('runs', 'dense'):
+        rollup.rollup(machine_id, end, app.config)
+    db.session.commit()
+    for model, count in ((WashingMachineMinute, 120), (WashingMachineHour, 2)):
+        dense = rollups(model, 'dense')
+        assert len(dense) == count
+        assert rollups(model, 'runs') == approx_energy(dense)
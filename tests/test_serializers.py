@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Compatibility of the precompiled serializers with the marshmallow schemas"""
+
+from datetime import datetime, timedelta, timezone
+import json
+
+import pytest
+
+from laundrymeter import serializers
+from laundrymeter.models import (User, UserSchema,
+                                 WashingMachine, WashingMachineSchema,
+                                 WashingMachineMinute, WashingMachineMinuteSchema,
+                                 WashingMachineHour, WashingMachineHourSchema)
+
+
+READINGS = [
+    WashingMachine(machine_id='default', timestamp=datetime(2018, 10, 1, 12, 0, 5, 123456), running=True,
+                   last_changed=datetime(2018, 10, 1, 11, 30), voltage=230.4, current=8.7, power=1987.25,
+                   total_power=1234.5, valid_until=datetime(2018, 10, 1, 12, 0, 5, 123456), repeat_count=1),
+    WashingMachine(machine_id='keller "2"', timestamp=datetime(2018, 10, 1), running=False,
+                   last_changed=None, voltage=230, current=0, power=0, total_power=7,
+                   valid_until=datetime(2018, 10, 1, 0, 5), repeat_count=61),
+    WashingMachine(machine_id='wäsche', timestamp=datetime(2018, 10, 1), running=None, last_changed=None,
+                   voltage=None, current=None, power=1e-7, total_power=1e12, valid_until=None, repeat_count=None),
+    WashingMachine(machine_id='default', timestamp=datetime(2018, 10, 1, 14, tzinfo=timezone(timedelta(hours=2))),
+                   running=False, last_changed=datetime(2018, 10, 1, 12, tzinfo=timezone.utc), voltage=230,
+                   current=0, power=0, total_power=7, valid_until=None, repeat_count=1),
+]
+
+ROLLUPS = [
+    dict(machine_id='default', timestamp=datetime(2018, 10, 1, 12), samples=720, power_min=0.5,
+         power_max=2150.0, power_mean=412.3333333333333, energy=0.8, running_fraction=0.25),
+    dict(machine_id='default', timestamp=datetime(2018, 10, 1, 13), samples=0, power_min=None,
+         power_max=None, power_mean=None, energy=0, running_fraction=None),
+]
+
+USERS = [User(username='alice', name='Alice'), User(username='bob', name='Bob "the Builder" Ü'),
+         User(username='carol', name=None)]
+
+
+def as_tuple(obj, columns):
+    return tuple(getattr(obj, column) for column in columns)
+
+
+@pytest.mark.parametrize('reading', READINGS)
+def test_washing_machine(reading):
+    serializer = serializers.wm_debug
+    expected = json.loads(WashingMachineSchema().dumps(reading))
+    assert json.loads(serializer.dump(as_tuple(reading, serializer.columns))) == expected
+    assert json.loads(serializer.dump_object(reading)) == expected
+    assert json.loads(serializer.dump_dict({c: getattr(reading, c) for c in serializer.columns})) == expected
+
+@pytest.mark.parametrize('reading', READINGS)
+def test_washing_machine_status(reading):
+    serializer = serializers.wm_status
+    expected = WashingMachineSchema(only=('machine_id', 'timestamp', 'running', 'last_changed')).dumps(reading)
+    assert json.loads(serializer.dump_object(reading)) == json.loads(expected)
+
+def test_washing_machine_many():
+    rows = [as_tuple(reading, serializers.wm_debug.columns) for reading in READINGS]
+    expected = WashingMachineSchema().dumps(READINGS, many=True)
+    assert json.loads(serializers.wm_debug.dumps(rows, many=True)) == json.loads(expected)
+    assert serializers.wm_debug.dumps([], many=True) == '[]'
+
+@pytest.mark.parametrize('model, schema, serializer', [
+    (WashingMachineMinute, WashingMachineMinuteSchema(), serializers.minute),
+    (WashingMachineHour, WashingMachineHourSchema(), serializers.hour),
+])
+def test_rollups(model, schema, serializer):
+    rows = [model(**row) for row in ROLLUPS]
+    assert json.loads(serializer.dumps_dicts(ROLLUPS)) == json.loads(schema.dumps(rows, many=True))
+
+def test_user_names():
+    rows = [(user.name,) for user in USERS]
+    expected = UserSchema(only=['name'], many=True).dumps(USERS)
+    assert json.loads(serializers.user_names.dumps(rows, many=True)) == json.loads(expected)
+
+def test_special_floats():
+    serializer = serializers.Serializer(WashingMachine, ('machine_id', 'power'))
+    assert serializer.dump(('a', float('nan'))) == '{"machine_id": "a", "power": NaN}'
+    assert serializer.dump(('a', float('inf'))) == '{"machine_id": "a", "power": Infinity}'
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Telegram bot commands received through the webhook, against a local stand-in for the Bot API"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from urllib.parse import parse_qsl
+import json
+
+import pytest
+from sqlalchemy import event
+
+from laundrymeter import create_app, db_helper, leader, models, telegram_bot
+from laundrymeter.cache import LRUCache
+from laundrymeter.models import User, db
+
+
+BOT_TOKEN = '123456:stand-in'
+WEBHOOK_URL = 'https://laundry.example.org/api/telegram/webhook'
+
+
+class BotApi:
+    """Local stand-in for the Telegram Bot API, recording the called methods."""
+
+    def __init__(self) -> None:
+        self.calls = []
+        calls = self.calls
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = dict(parse_qsl(body))
+                calls.append((method, params))
+
+                if method == 'getMe':
+                    result = {'id': 1, 'is_bot': True, 'first_name': 'Laundry', 'username': 'laundrymeter_bot'}
+                elif method == 'getMyCommands':
+                    result = []
+                elif method == 'sendMessage':
+                    result = {'message_id': len(calls), 'date': 0, 'text': params['text'],
+                              'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+                else:
+                    result = True
+                data = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/bot'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def replies(self, chat_id: int) -> list:
+        return [params['text'] for method, params in self.calls
+                if method == 'sendMessage' and int(params['chat_id']) == chat_id]
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def bot_api():
+    api = BotApi()
+    yield api
+    api.close()
+
+@pytest.fixture
+def app(tmpdir, bot_api):
+    # Holding the leader lock keeps the app a follower: no poller, no notifications
+    lock = leader.FileLock(str(tmpdir / 'leader.lock'))
+    lock.acquire()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmpdir / 'db.sqlite'),
+                      'ARCHIVE_PATH': str(tmpdir / 'archive'),
+                      'STATE_PATH': str(tmpdir / 'state'),
+                      'METRICS_PATH': str(tmpdir / 'metrics'),
+                      'LEADER_LOCK_PATH': str(tmpdir / 'leader.lock'),
+                      'LEADER_RETRY_INTERVAL': 3600,
+                      'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+                      'TELEGRAM_API_URL': bot_api.url,
+                      'TELEGRAM_WEBHOOK_URL': WEBHOOK_URL,
+                      'TESTING': True})
+    models.chat_cache.clear()
+    with app.app_context():
+        db_helper.init_db()
+        db.session.add(User(username='alice', name='Alice', email='alice@example.org', notify_email=False,
+                            notify_telegram=False, telegram_token='start-alice'))
+        db.session.commit()
+    yield app
+    lock.release()
+
+def send(app, chat_id: int, text: str, secret: str = None):
+    """Post a message from a chat to the webhook."""
+    command = text.split()[0]
+    update = {'update_id': 1,
+              'message': {'message_id': 1, 'date': 0, 'text': text,
+                          'chat': {'id': chat_id, 'type': 'private'},
+                          'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Alice'},
+                          'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}}
+    secret = secret or telegram_bot.webhook_secret(app.config)
+    return app.test_client().post('/api/telegram/webhook/' + secret, json=update)
+
+
+def test_wrong_secret(app, bot_api):
+    assert send(app, 42, '/notify', secret='wrong').status_code == 404
+    assert bot_api.replies(42) == []
+
+def test_unknown_chat(app, bot_api):
+    assert send(app, 42, '/notify').status_code == 200
+    assert bot_api.replies(42) == ["Unauthorized. Please authenticate first."]
+
+def test_start_and_notify(app, bot_api):
+    send(app, 42, '/start start-alice')
+    send(app, 42, '/notify')
+    assert bot_api.replies(42) == ["Successfully authenticated!",
+                                   "You will be notified as soon as the laundry is ready."]
+    with app.app_context():
+        assert User.query.get('alice').notify_telegram
+
+def test_chat_cache(app, bot_api):
+    send(app, 42, '/start start-alice')
+    send(app, 42, '/cycle')
+    assert models.chat_cache.get(42) == ('alice', 'Alice')
+
+    statements = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        send(app, 42, '/cycle')
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    assert bot_api.replies(42)[-1] == "No cycle recorded yet."
+    assert not [statement for statement in statements if 'telegram_chat_id' in statement]
+
+    # Notification changes evict the chat
+    send(app, 42, '/notify')
+    assert models.chat_cache.get(42) is None
+
+def test_authenticating_another_chat(app, bot_api):
+    send(app, 42, '/start start-alice')
+    send(app, 42, '/cycle')
+    with app.app_context():
+        User.query.get('alice').generate_telegram_token()
+        token = User.query.get('alice').telegram_token
+    send(app, 43, '/start ' + token)
+    send(app, 42, '/cycle')
+    assert bot_api.replies(43) == ["Successfully authenticated!"]
+    assert bot_api.replies(42)[-1] == "Unauthorized. Please authenticate first."
+
+def test_logout_in_other_workers(app, bot_api):
+    send(app, 42, '/start start-alice')
+    other = LRUCache(16, 300) # The chat cache of another worker
+    other.share(models.chat_cache.path)
+    other.set(42, ('alice', 'Alice'))
+    with app.app_context():
+        User.query.get('alice').generate_telegram_token()
+        token = User.query.get('alice').telegram_token
+    send(app, 43, '/start ' + token)
+    assert other.get(42) is None
+
+def test_set_webhook(app, bot_api):
+    telegram_bot.init_app(app)
+    url = WEBHOOK_URL + '/' + telegram_bot.webhook_secret(app.config)
+    assert ('setWebhook', {'url': url}) in [(method, {'url': params.get('url')}) for method, params in bot_api.calls]
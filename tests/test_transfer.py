@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Export and import of readings"""
+
+from datetime import datetime, timedelta
+import io
+import shutil
+
+import pytest
+
+from laundrymeter import archive, transfer
+from laundrymeter.models import WashingMachine, db
+
+
+START = datetime(2018, 10, 1)
+ARCHIVED = START + timedelta(days=1)
+END = START + timedelta(days=2)
+
+
+def add(timestamp, power, total_power, repeat_count=1, step=timedelta(seconds=10)):
+    db.session.add(WashingMachine(machine_id='default', timestamp=timestamp, running=power > 10,
+                                  last_changed=START, voltage=230, current=power / 230, power=power,
+                                  total_power=total_power, valid_until=timestamp + step * (repeat_count - 1),
+                                  repeat_count=repeat_count))
+
+def export(config, format):
+    out = io.StringIO()
+    transfer.WRITERS[format](transfer.export_chunks(config, 'default', START, END, 7), out)
+    return out.getvalue()
+
+def columns(**values):
+    """Columns of a chunk of records as read from a file."""
+    size = len(values['timestamp'])
+    values.setdefault('machine_id', ['default'] * size)
+    values.setdefault('running', ['False'] * size)
+    return values
+
+
+@pytest.mark.parametrize('format', transfer.FORMATS)
+def test_round_trip(app, format):
+    for i in range(20):
+        add(START + timedelta(seconds=10 * i), float(i), 0.001 * i)
+    add(START + timedelta(seconds=200), 500.0, 0.1, repeat_count=6) # Run archived as single readings
+    for i in range(20):
+        add(ARCHIVED + timedelta(seconds=10 * i), 100.0 + i, 1.0 + 0.001 * i)
+    add(ARCHIVED + timedelta(seconds=200), 2000.0, 1.5, repeat_count=6) # Run kept as it is
+    add(ARCHIVED + timedelta(seconds=260), 3.0, 1.6)
+    db.session.commit()
+    archive.archive(app.config, 'default', START, ARCHIVED)
+    WashingMachine.query.filter(WashingMachine.timestamp < ARCHIVED).delete() # Expired after archiving
+    db.session.commit()
+
+    exported = export(app.config, format)
+    WashingMachine.query.delete()
+    db.session.commit()
+    shutil.rmtree(app.config['ARCHIVE_PATH'])
+
+    count = transfer.import_rows(app.config, transfer.READERS[format](io.StringIO(exported), 8))
+    assert count == 20 + 6 + 20 + 1 + 1
+    assert export(app.config, format) == exported
+    run = WashingMachine.query.filter_by(power=2000.0).one()
+    assert (run.repeat_count, run.valid_until) == (6, ARCHIVED + timedelta(seconds=250))
+
+def test_integrate_total_power(app):
+    timestamps = [(START + timedelta(seconds=10 * i)).isoformat() for i in range(5)]
+    transfer.import_rows(app.config, [columns(timestamp=timestamps[:3], power=['360'] * 3,
+                                              total_power=['', '', '5.0']),
+                                      columns(timestamp=timestamps[3:], power=['360'] * 2)])
+
+    totals = [row.total_power for row in WashingMachine.query.order_by(WashingMachine.timestamp)]
+    assert totals == pytest.approx([0.0, 0.001, 5.0, 5.001, 5.002]) # 360 W for 10 s is 0.001 kWh
+
+def test_out_of_order(app):
+    with pytest.raises(ValueError, match='time order'):
+        transfer.import_rows(app.config, [columns(timestamp=['2018-10-01T00:00:10', '2018-10-01T00:00:00'],
+                                                  power=['1', '2'], total_power=['1', '1'])])
+    with pytest.raises(ValueError, match='time order'):
+        transfer.import_rows(app.config, [columns(timestamp=['2018-10-01T00:00:10'], power=['1'], total_power=['1']),
+                                          columns(timestamp=['2018-10-01T00:00:00'], power=['2'], total_power=['1'])])
+
+def test_archived(app):
+    add(START, 1.0, 0.5)
+    db.session.commit()
+    archive.archive(app.config, 'default', START, ARCHIVED)
+
+    with pytest.raises(ValueError, match='archived already'):
+        transfer.import_rows(app.config, [columns(timestamp=[(START + timedelta(hours=1)).isoformat()],
+                                                  power=['1'], total_power=['1'])])
+    assert WashingMachine.query.count() == 1